@@ -1,14 +1,238 @@
 import json
 import os
+import sys
+import threading
 import time
+from collections import deque
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, TextIO
 
+OVERFLOW_POLICIES = ("drop_oldest", "drop_new", "block")
 
-def audit_log(event: str, **fields: object) -> None:
-    if os.getenv("AUDIT_ENABLED", "false").lower() != "true":
-        return
-    payload = {
-        "ts": int(time.time()),
-        "event": event,
-        **fields,
-    }
-    print(json.dumps(payload, sort_keys=True), flush=True)
+
+@dataclass(slots=True)
+class LogRecord:
+    ts: float
+    event: str
+    message: str | None = None
+    fields: dict = field(default_factory=dict)
+
+    def text(self) -> str:
+        if self.message is not None:
+            return f"[dvpn] {self.message}"
+        return " ".join(["[dvpn]", self.event, *(f"{key}={value}" for key, value in self.fields.items())])
+
+    def json(self) -> str:
+        payload = {"ts": int(self.ts), "event": self.event, **self.fields}
+        if self.message is not None:
+            payload["message"] = self.message
+        return json.dumps(payload, sort_keys=True)
+
+
+class StdoutSink:
+    def __init__(self, fmt: str = "text", stream: TextIO | None = None) -> None:
+        self.fmt = fmt
+        self.stream = stream
+
+    def write(self, records: list[LogRecord]) -> None:
+        stream = self.stream or sys.stdout
+        # One write and one flush per batch rather than per line.
+        stream.write("".join((record.json() if self.fmt == "json" else record.text()) + "\n" for record in records))
+        stream.flush()
+
+
+class RotatingFileSink:
+    def __init__(self, path: Path, max_bytes: int = 10_000_000, backups: int = 3, fmt: str = "json") -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.fmt = fmt
+        self._handle: TextIO | None = None
+        self._size = 0
+
+    def _open(self) -> TextIO:
+        if self._handle is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._handle = self.path.open("a", encoding="utf-8")
+            self._size = self._handle.tell()
+        return self._handle
+
+    def _rotate(self) -> None:
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+        for index in range(self.backups - 1, 0, -1):
+            older = self.path.with_name(f"{self.path.name}.{index}")
+            if older.exists():
+                os.replace(older, self.path.with_name(f"{self.path.name}.{index + 1}"))
+        if self.backups > 0:
+            os.replace(self.path, self.path.with_name(f"{self.path.name}.1"))
+        else:
+            self.path.unlink()
+
+    def write(self, records: list[LogRecord]) -> None:
+        data = "".join((record.json() if self.fmt == "json" else record.text()) + "\n" for record in records)
+        handle = self._open()
+        if self._size and self._size + len(data) > self.max_bytes:
+            self._rotate()
+            handle = self._open()
+        handle.write(data)
+        handle.flush()
+        self._size += len(data)
+
+    def close(self) -> None:
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+
+
+class RingSink:
+    # Written on the caller's thread, so /logs shows a line as soon as it is logged.
+    inline = True
+
+    def __init__(self, maxlen: int = 200) -> None:
+        self.lines: deque[str] = deque(maxlen=maxlen)
+
+    def write(self, records: list[LogRecord]) -> None:
+        self.lines.extend(record.text() for record in records)
+
+
+class LogPipeline:
+    def __init__(
+        self,
+        sinks: list,
+        capacity: int = 4096,
+        policy: str = "drop_oldest",
+        batch_size: int = 256,
+        flush_interval: float = 0.2,
+        block_seconds: float = 0.05,
+        on_drop: Callable[[int], None] | None = None,
+    ) -> None:
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"unknown log overflow policy: {policy}")
+        self.sinks = sinks
+        self._inline = [sink for sink in sinks if getattr(sink, "inline", False)]
+        self._queued = [sink for sink in sinks if not getattr(sink, "inline", False)]
+        self.capacity = max(capacity, 1)
+        self.policy = policy
+        self.batch_size = max(batch_size, 1)
+        self.flush_interval = flush_interval
+        self.block_seconds = block_seconds
+        self.on_drop = on_drop
+        # deque.append/popleft are atomic, so callers enqueue without taking a lock.
+        self._queue: deque[LogRecord | threading.Event] = deque()
+        self._wakeup = threading.Event()
+        self._drained = threading.Condition()
+        self._thread: threading.Thread | None = None
+        self._start_lock = threading.Lock()
+        self._closed = False
+        self.dropped = 0
+        self.sink_errors = 0
+
+    def emit(self, event: str, message: str | None = None, **fields: object) -> bool:
+        if self._closed or not self.sinks:
+            return False
+        record = LogRecord(time.time(), event, message, fields)
+        self._write(self._inline, [record])
+        if not self._queued:
+            return True
+        if len(self._queue) >= self.capacity and not self._make_room():
+            return False
+        self._queue.append(record)
+        if self._thread is None:
+            self._start()
+        if len(self._queue) >= self.batch_size:
+            self._wakeup.set()
+        return True
+
+    def _make_room(self) -> bool:
+        if self.policy == "block":
+            # Bounded backpressure: wait briefly for the writer, then drop rather than stall the caller.
+            self._wakeup.set()
+            with self._drained:
+                self._drained.wait_for(lambda: len(self._queue) < self.capacity, timeout=self.block_seconds)
+            if len(self._queue) < self.capacity:
+                return True
+        elif self.policy == "drop_oldest":
+            # Evict the oldest record; flush() markers ahead of it go back in front, or their
+            # callers would wait out the whole timeout.
+            markers: list[threading.Event] = []
+            while True:
+                try:
+                    item = self._queue.popleft()
+                except IndexError:
+                    break
+                if isinstance(item, LogRecord):
+                    self._dropped(1)
+                    break
+                markers.append(item)
+            if markers:
+                self._queue.extendleft(reversed(markers))
+                self._wakeup.set()
+            return True
+        self._dropped(1)
+        return False
+
+    def _dropped(self, count: int) -> None:
+        self.dropped += count
+        if self.on_drop is not None:
+            self.on_drop(count)
+
+    def _start(self) -> None:
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="dvpn-log-writer", daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self._drain()
+            if self._closed and not self._queue:
+                return
+
+    def _drain(self) -> None:
+        while self._queue:
+            batch: list[LogRecord] = []
+            markers: list[threading.Event] = []
+            while self._queue and len(batch) < self.batch_size:
+                item = self._queue.popleft()
+                if isinstance(item, threading.Event):
+                    markers.append(item)
+                else:
+                    batch.append(item)
+            with self._drained:
+                self._drained.notify_all()
+            if batch:
+                self._write(self._queued, batch)
+            for marker in markers:
+                marker.set()
+
+    def _write(self, sinks: list, records: list[LogRecord]) -> None:
+        for sink in sinks:
+            try:
+                sink.write(records)
+            except Exception:
+                # A broken sink must not take the others (or the service) down with it.
+                self.sink_errors += 1
+
+    def flush(self, timeout: float = 5.0) -> bool:
+        # Queues a marker the writer sets once everything ahead of it has reached the sinks.
+        if self._thread is None or not self._thread.is_alive():
+            return not self._queue
+        done = threading.Event()
+        self._queue.append(done)
+        self._wakeup.set()
+        return done.wait(timeout)
+
+    def close(self, timeout: float = 5.0) -> None:
+        self._closed = True
+        if self._thread is not None:
+            self._wakeup.set()
+            self._thread.join(timeout)
+        for sink in self.sinks:
+            close = getattr(sink, "close", None)
+            if close is not None:
+                close()
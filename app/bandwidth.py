@@ -1,46 +1,269 @@
 import ssl
+import subprocess
 import threading
 import time
 import urllib.request
+from dataclasses import dataclass, field
+from typing import Callable
 
+from app.shaping import TcShaper
 
-def measure_throughput_mbps(test_url: str, timeout: int = 8, sample_seconds: int = 4) -> float:
-    context = ssl.create_default_context()
-    context.minimum_version = ssl.TLSVersion.TLSv1_2
-    start = time.time()
-    total = 0
-    with urllib.request.urlopen(test_url, timeout=timeout, context=context) as response:
-        while time.time() - start < sample_seconds:
-            chunk = response.read(64 * 1024)
-            if not chunk:
-                break
-            total += len(chunk)
-    duration = max(time.time() - start, 0.001)
-    bits_per_second = (total * 8) / duration
-    return bits_per_second / 1_000_000
+READ_BUFFER_BYTES = 256 * 1024
+
+
+@dataclass
+class ThroughputEstimate:
+    mbps: float
+    elapsed: float
+    converged: bool
+    streams: int
+    samples: list[float] = field(default_factory=list)
+
+
+def _stream_worker(
+    url: str,
+    timeout: float,
+    context: ssl.SSLContext | None,
+    counts: list[int],
+    slot: int,
+    stop: threading.Event,
+    errors: list[Exception],
+) -> None:
+    # Each stream reads into one preallocated buffer; only the byte count is kept.
+    buffer = bytearray(READ_BUFFER_BYTES)
+    view = memoryview(buffer)
+    try:
+        with urllib.request.urlopen(url, timeout=timeout, context=context) as response:
+            remaining = response.length
+            fp = getattr(response, "fp", None)
+            # HTTPResponse.readinto blocks until the whole buffer is full; readinto1 on the
+            # underlying stream returns whatever has arrived, so per-interval counts stay accurate.
+            partial = remaining is not None and not getattr(response, "chunked", False) and hasattr(fp, "readinto1")
+            while not stop.is_set():
+                if partial:
+                    if remaining <= 0:
+                        break
+                    read = fp.readinto1(view[: min(len(view), remaining)])
+                    remaining -= read
+                else:
+                    read = response.readinto(view)
+                if not read:
+                    break
+                counts[slot] += read
+    except Exception as err:
+        errors.append(err)
+
+
+def _converged(window: list[float], tolerance: float) -> bool:
+    mean = sum(window) / len(window)
+    return mean > 0 and (max(window) - min(window)) / mean <= tolerance
+
+
+def estimate_throughput(
+    test_url: str,
+    timeout: float = 8,
+    sample_seconds: float = 4,
+    streams: int = 4,
+    interval: float = 0.25,
+    tolerance: float = 0.1,
+    window: int = 4,
+    warmup_seconds: float = 0.5,
+) -> ThroughputEstimate:
+    context = None
+    if test_url.lower().startswith("https:"):
+        context = ssl.create_default_context()
+        context.minimum_version = ssl.TLSVersion.TLSv1_2
+    streams = max(streams, 1)
+    window = max(window, 2)
+    counts = [0] * streams
+    errors: list[Exception] = []
+    stop = threading.Event()
+    workers = [
+        threading.Thread(target=_stream_worker, args=(test_url, timeout, context, counts, slot, stop, errors), daemon=True)
+        for slot in range(streams)
+    ]
+    start = time.monotonic()
+    for worker in workers:
+        worker.start()
+
+    # Several streams fill high-BDP links a single TCP connection cannot. The first interval
+    # after warmup discards connection setup and slow start; after that the estimate stops as
+    # soon as the last `window` samples agree within `tolerance`.
+    samples: list[float] = []
+    converged = False
+    last_total = 0
+    last_at = start
+    measured_bytes = 0
+    measured_seconds = 0.0
+    deadline = start + sample_seconds
+    while True:
+        time.sleep(max(min(interval, deadline - time.monotonic()), 0))
+        now = time.monotonic()
+        total = sum(counts)
+        if now - start > warmup_seconds:
+            samples.append((total - last_total) * 8 / max(now - last_at, 0.001) / 1_000_000)
+            measured_bytes += total - last_total
+            measured_seconds += now - last_at
+        last_total, last_at = total, now
+        if len(samples) >= window and _converged(samples[-window:], tolerance):
+            converged = True
+            break
+        if now >= deadline or not any(worker.is_alive() for worker in workers):
+            break
+    stop.set()
+    for worker in workers:
+        worker.join(timeout=0.1)
+    elapsed = time.monotonic() - start
+
+    if errors and len(errors) == streams:
+        raise errors[0]
+    if converged:
+        mbps = sum(samples[-window:]) / window
+    elif measured_seconds > 0:
+        mbps = measured_bytes * 8 / measured_seconds / 1_000_000
+    else:
+        # Finished (or failed) before warmup ended: fall back to the whole run.
+        mbps = last_total * 8 / max(elapsed, 0.001) / 1_000_000
+    return ThroughputEstimate(mbps=mbps, elapsed=elapsed, converged=converged, streams=streams, samples=samples)
+
+
+def measure_throughput_mbps(test_url: str, timeout: int = 8, sample_seconds: int = 4, streams: int = 4) -> float:
+    return estimate_throughput(test_url, timeout=timeout, sample_seconds=sample_seconds, streams=streams).mbps
 
 
 class BandwidthAllocator:
-    def __init__(self, total_mbps: float, fraction_per_connection: float = 0.5) -> None:
+    def __init__(
+        self,
+        total_mbps: float,
+        fraction_per_connection: float = 0.5,
+        shaper: TcShaper | None = None,
+        on_shaping_error: Callable[[Exception], None] | None = None,
+    ) -> None:
         self.total_mbps = max(total_mbps, 0.1)
         self.fraction_per_connection = max(min(fraction_per_connection, 1.0), 0.01)
+        self.shaper = shaper
+        self.on_shaping_error = on_shaping_error
         self._lock = threading.Lock()
-        self._active: dict[str, float] = {}
+        # Explicit demands per connection; None means the default share of the total.
+        self._demands: dict[str, float | None] = {}
+        self._addresses: dict[str, str] = {}
+        self._grants: dict[str, float] = {}
+        # Running totals keep admission O(1) while the link is not oversubscribed.
+        self._explicit_demand = 0.0
+        self._default_count = 0
+        self._granted_total = 0.0
+        # Set after a failed tc batch: the shaper starts over, so every grant has to be sent again.
+        self._resync = False
 
     @property
     def active_count(self) -> int:
         with self._lock:
-            return len(self._active)
+            return len(self._grants)
 
-    def open_connection(self, connection_id: str) -> float:
+    @property
+    def granted_total_mbps(self) -> float:
         with self._lock:
-            # Per request: allocate 1/2 total bandwidth per new connection event.
-            requested = self.total_mbps * self.fraction_per_connection
-            remaining = max(self.total_mbps - sum(self._active.values()), 0.0)
-            granted = min(requested, remaining)
-            self._active[connection_id] = granted
-            return granted
+            return self._granted_total
+
+    def grants(self) -> dict[str, float]:
+        with self._lock:
+            return dict(self._grants)
+
+    def _default_demand(self) -> float:
+        return self.total_mbps * self.fraction_per_connection
+
+    def _demand(self, connection_id: str) -> float:
+        demand = self._demands[connection_id]
+        return self._default_demand() if demand is None else demand
+
+    def _demand_total(self) -> float:
+        return self._explicit_demand + self._default_count * self._default_demand()
+
+    def _rebalance(self) -> list[str]:
+        # Max-min fair: serve the smallest demands in full, split what is left evenly among the rest.
+        ordered = sorted(self._demands, key=self._demand)
+        remaining = self.total_mbps
+        changed: list[str] = []
+        for index, connection_id in enumerate(ordered):
+            grant = min(self._demand(connection_id), remaining / (len(ordered) - index))
+            remaining -= grant
+            if self._grants.get(connection_id) != grant:
+                self._granted_total += grant - self._grants.get(connection_id, 0.0)
+                self._grants[connection_id] = grant
+                changed.append(connection_id)
+        return changed
+
+    def _shape(self, changed: list[str], removed: list[str], refresh: bool = False) -> None:
+        if self.shaper is None:
+            return
+        if self._resync:
+            changed = list(self._grants)
+        grants = {cid: (self._addresses[cid], self._grants[cid]) for cid in changed if cid in self._addresses}
+        removed = [cid for cid in removed if cid in self.shaper.classes]
+        if not grants and not removed and not (refresh and self.shaper.classes):
+            return
+        try:
+            self.shaper.update(self.total_mbps, grants, removed)
+        except (subprocess.SubprocessError, OSError, RuntimeError, ValueError) as err:
+            self._resync = True
+            if self.on_shaping_error is not None:
+                self.on_shaping_error(err)
+        else:
+            self._resync = False
+
+    def set_total(self, total_mbps: float) -> None:
+        with self._lock:
+            self.total_mbps = max(total_mbps, 0.1)
+            # The parent class follows the new total even when no grant moves.
+            self._shape(self._rebalance(), [], refresh=True)
+
+    def open_connection(self, connection_id: str, address: str | None = None, demand_mbps: float | None = None) -> float:
+        return self.open_connections([(connection_id, address)], demand_mbps)[0]
+
+    def open_connections(self, connections: list[tuple[str, str | None]], demand_mbps: float | None = None) -> list[float]:
+        with self._lock:
+            for connection_id, address in connections:
+                self._release(connection_id)
+                self._demands[connection_id] = demand_mbps
+                if demand_mbps is None:
+                    self._default_count += 1
+                else:
+                    self._explicit_demand += demand_mbps
+                if address:
+                    self._addresses[connection_id] = address
+            if self._demand_total() <= self.total_mbps:
+                # Nothing is oversubscribed, so no existing grant moves.
+                changed = [connection_id for connection_id, _ in connections]
+                for connection_id in changed:
+                    grant = self._demand(connection_id)
+                    self._grants[connection_id] = grant
+                    self._granted_total += grant
+            else:
+                changed = self._rebalance()
+            self._shape(changed, [])
+            return [self._grants[connection_id] for connection_id, _ in connections]
+
+    def _release(self, connection_id: str) -> bool:
+        if connection_id not in self._demands:
+            return False
+        demand = self._demands.pop(connection_id)
+        if demand is None:
+            self._default_count -= 1
+        else:
+            self._explicit_demand -= demand
+        self._granted_total -= self._grants.pop(connection_id, 0.0)
+        self._addresses.pop(connection_id, None)
+        return True
 
     def close_connection(self, connection_id: str) -> None:
+        self.close_connections([connection_id])
+
+    def close_connections(self, connection_ids: list[str]) -> None:
         with self._lock:
-            self._active.pop(connection_id, None)
+            oversubscribed = self._demand_total() > self.total_mbps
+            released = [cid for cid in connection_ids if self._release(cid)]
+            if not released:
+                return
+            # Freed capacity only moves other grants if some of them were being squeezed.
+            changed = self._rebalance() if oversubscribed else []
+            self._shape(changed, released)
@@ -0,0 +1,239 @@
+import base64
+import http.client
+import io
+import json
+import select
+import ssl
+import threading
+import time
+import urllib.error
+import urllib.request
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Callable, Iterator
+from urllib.parse import urlsplit
+
+# Errors that mean a pooled keep-alive connection was closed by the peer while idle.
+_RESET_ERRORS = (
+    http.client.RemoteDisconnected,
+    http.client.BadStatusLine,
+    ConnectionResetError,
+    BrokenPipeError,
+    ConnectionAbortedError,
+)
+
+# A reset can also arrive after the server processed the request, so only these are replayed.
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE", "TRACE"})
+
+
+@dataclass
+class HTTPResponse:
+    status: int
+    headers: dict[str, str]
+    body: bytes = field(repr=False)
+
+    def json(self):
+        return json.loads(self.body.decode("utf-8"))
+
+
+def default_ssl_context() -> ssl.SSLContext:
+    context = ssl.create_default_context()
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    return context
+
+
+class _ResumableHTTPSConnection(http.client.HTTPSConnection):
+    def __init__(self, host: str, port: int | None, timeout: float, context: ssl.SSLContext, sessions: dict) -> None:
+        super().__init__(host, port, timeout=timeout, context=context)
+        self._ssl_context = context
+        self._sessions = sessions
+
+    @property
+    def _origin(self) -> tuple[str, int]:
+        # Through a proxy the TLS peer is the tunnel target, not the host we connect to.
+        if self._tunnel_host:
+            return self._tunnel_host, self._tunnel_port
+        return self.host, self.port
+
+    def connect(self) -> None:
+        # Same as HTTPSConnection.connect, but offers the last TLS session for this host so
+        # reconnects can use an abbreviated handshake.
+        http.client.HTTPConnection.connect(self)
+        host, port = self._origin
+        self.sock = self._ssl_context.wrap_socket(self.sock, server_hostname=host, session=self._sessions.get((host, port)))
+
+    def remember_session(self) -> None:
+        if isinstance(self.sock, ssl.SSLSocket) and self.sock.session is not None:
+            self._sessions[self._origin] = self.sock.session
+
+
+def _dropped(conn: http.client.HTTPConnection) -> bool:
+    # An idle keep-alive socket has nothing to read; readable means the server closed it.
+    if conn.sock is None:
+        return True
+    try:
+        readable, _, _ = select.select([conn.sock], [], [], 0)
+    except (OSError, ValueError):
+        return True
+    return bool(readable)
+
+
+class HTTPSession:
+    def __init__(
+        self,
+        ssl_context: ssl.SSLContext | None = None,
+        timeout: float = 5,
+        max_per_host: int = 4,
+        idle_timeout: float = 30.0,
+        user_agent: str = "DVPN/1.0",
+        on_request: Callable[[str, str, float], None] | None = None,
+        proxies: dict[str, str] | None = None,
+    ) -> None:
+        self.ssl_context = ssl_context or default_ssl_context()
+        self.timeout = timeout
+        self.max_per_host = max(1, max_per_host)
+        self.idle_timeout = idle_timeout
+        self.user_agent = user_agent
+        self.on_request = on_request
+        # Same sources urllib uses: http_proxy/https_proxy/no_proxy from the environment.
+        self.proxies = urllib.request.getproxies() if proxies is None else proxies
+        self._lock = threading.Lock()
+        self._idle: dict[tuple[str, str, int], list[tuple[http.client.HTTPConnection, float]]] = {}
+        self._tls_sessions: dict = {}
+
+    def _proxy(self, scheme: str, host: str) -> tuple[str, int, dict[str, str]] | None:
+        proxy = self.proxies.get(scheme)
+        if not proxy or urllib.request.proxy_bypass(host):
+            return None
+        parts = urlsplit(proxy if "://" in proxy else f"http://{proxy}")
+        if not parts.hostname:
+            return None
+        headers = {}
+        if parts.username:
+            credentials = f"{parts.username}:{parts.password or ''}".encode("utf-8")
+            headers["Proxy-Authorization"] = "Basic " + base64.b64encode(credentials).decode("ascii")
+        return parts.hostname, parts.port or 80, headers
+
+    def _new_connection(self, scheme: str, host: str, port: int, timeout: float) -> http.client.HTTPConnection:
+        proxy = self._proxy(scheme, host)
+        if scheme == "https":
+            if proxy is None:
+                return _ResumableHTTPSConnection(host, port, timeout, self.ssl_context, self._tls_sessions)
+            conn = _ResumableHTTPSConnection(proxy[0], proxy[1], timeout, self.ssl_context, self._tls_sessions)
+            conn.set_tunnel(host, port, headers=proxy[2])
+            return conn
+        if proxy is None:
+            return http.client.HTTPConnection(host, port, timeout=timeout)
+        return http.client.HTTPConnection(proxy[0], proxy[1], timeout=timeout)
+
+    def _acquire(self, key: tuple[str, str, int], timeout: float) -> tuple[http.client.HTTPConnection, bool]:
+        now = time.monotonic()
+        with self._lock:
+            idle = self._idle.get(key, [])
+            expired = [candidate for candidate, last_used in idle if now - last_used > self.idle_timeout]
+            fresh = [(candidate, last_used) for candidate, last_used in idle if now - last_used <= self.idle_timeout]
+            conn = fresh.pop()[0] if fresh else None
+            self._idle[key] = fresh
+        for stale in expired:
+            stale.close()
+        if conn is not None and _dropped(conn):
+            conn.close()
+            conn = None
+        if conn is not None:
+            conn.timeout = timeout
+            try:
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                return conn, True
+            except OSError:
+                conn.close()
+        return self._new_connection(key[0], key[1], key[2], timeout), False
+
+    def _release(self, key: tuple[str, str, int], conn: http.client.HTTPConnection) -> None:
+        if isinstance(conn, _ResumableHTTPSConnection):
+            conn.remember_session()
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_per_host:
+                idle.append((conn, time.monotonic()))
+                return
+        conn.close()
+
+    @contextmanager
+    def stream(
+        self,
+        method: str,
+        url: str,
+        body: bytes | None = None,
+        headers: dict[str, str] | None = None,
+        timeout: float | None = None,
+    ) -> Iterator[http.client.HTTPResponse]:
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+        if scheme not in ("http", "https") or not parts.hostname:
+            raise ValueError(f"Unsupported URL: {url}")
+        port = parts.port or (443 if scheme == "https" else 80)
+        key = (scheme, parts.hostname, port)
+        path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+        request_headers = {"User-Agent": self.user_agent, "Connection": "keep-alive"}
+        proxy = self._proxy(scheme, parts.hostname) if scheme == "http" else None
+        if proxy is not None:
+            # Plain HTTP goes to the proxy as an absolute-form request; HTTPS is tunnelled instead.
+            path = f"http://{parts.netloc.rpartition('@')[2]}{path}"
+            request_headers.update(proxy[2])
+        if headers:
+            request_headers.update(headers)
+        timeout = timeout if timeout is not None else self.timeout
+
+        started = time.perf_counter()
+        conn, reused = self._acquire(key, timeout)
+        try:
+            try:
+                conn.request(method, path, body=body, headers=request_headers)
+                response = conn.getresponse()
+            except _RESET_ERRORS:
+                conn.close()
+                if not reused or method.upper() not in IDEMPOTENT_METHODS:
+                    raise
+                # The server closed our idle keep-alive socket; retry once on a fresh connection.
+                conn = self._new_connection(scheme, parts.hostname, port, timeout)
+                conn.request(method, path, body=body, headers=request_headers)
+                response = conn.getresponse()
+            if response.status >= 400:
+                data = response.read()
+                raise urllib.error.HTTPError(url, response.status, response.reason, response.msg, io.BytesIO(data))
+            yield response
+        except BaseException:
+            conn.close()
+            raise
+
+        if response.length == 0 and not response.isclosed():
+            response.read()
+        # Only a fully consumed body leaves the connection at a clean request boundary.
+        if response.will_close or not response.isclosed():
+            conn.close()
+        else:
+            self._release(key, conn)
+        if self.on_request is not None:
+            self.on_request(method, parts.hostname, time.perf_counter() - started)
+
+    def request(
+        self,
+        method: str,
+        url: str,
+        body: bytes | None = None,
+        headers: dict[str, str] | None = None,
+        timeout: float | None = None,
+    ) -> HTTPResponse:
+        with self.stream(method, url, body=body, headers=headers, timeout=timeout) as response:
+            data = response.read()
+            response_headers = {name.lower(): value for name, value in response.getheaders()}
+        return HTTPResponse(status=response.status, headers=response_headers, body=data)
+
+    def close(self) -> None:
+        with self._lock:
+            pools = list(self._idle.values())
+            self._idle.clear()
+        for idle in pools:
+            for conn, _ in idle:
+                conn.close()
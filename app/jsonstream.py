@@ -0,0 +1,105 @@
+import codecs
+import json
+from typing import Callable, Iterator
+
+_WHITESPACE = " \t\r\n"
+_DECODER = json.JSONDecoder()
+
+
+class _TextBuffer:
+    def __init__(self, read: Callable[[int], bytes], chunk_size: int) -> None:
+        self.read = read
+        self.chunk_size = chunk_size
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.text = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self) -> bool:
+        if self.eof:
+            return False
+        chunk = self.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            self.text = self.text[self.pos :] + self.decoder.decode(b"", final=True)
+        else:
+            # Drop everything already consumed so the buffer never grows past one item plus a chunk.
+            self.text = self.text[self.pos :] + self.decoder.decode(chunk)
+        self.pos = 0
+        return True
+
+    def skip_whitespace(self) -> str:
+        while True:
+            while self.pos < len(self.text) and self.text[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+            if not self.fill():
+                return ""
+
+    def decode_value(self) -> object:
+        self.skip_whitespace()
+        while True:
+            try:
+                value, end = _DECODER.raw_decode(self.text, self.pos)
+            except json.JSONDecodeError:
+                if not self.fill():
+                    raise
+                continue
+            if end == len(self.text) and not self.eof and not isinstance(value, (dict, list, str)):
+                # A bare number or literal at the buffer edge may continue in the next chunk.
+                if self.fill():
+                    continue
+            self.pos = end
+            return value
+
+
+def _iter_array(buf: _TextBuffer) -> Iterator[object]:
+    if buf.skip_whitespace() != "[":
+        raise ValueError("Expected a JSON array")
+    buf.pos += 1
+    if buf.skip_whitespace() == "]":
+        return
+    while True:
+        yield buf.decode_value()
+        separator = buf.skip_whitespace()
+        buf.pos += 1
+        if separator == "]":
+            return
+        if separator != ",":
+            raise ValueError("Malformed JSON array")
+
+
+def iter_json_array(read: Callable[[int], bytes], chunk_size: int = 64 * 1024) -> Iterator[object]:
+    return _iter_array(_TextBuffer(read, chunk_size))
+
+
+def iter_ndjson(read: Callable[[int], bytes], chunk_size: int = 64 * 1024) -> Iterator[object]:
+    pending = b""
+    while True:
+        chunk = read(chunk_size)
+        if not chunk:
+            break
+        pending += chunk
+        lines = pending.split(b"\n")
+        pending = lines.pop()
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+    if pending.strip():
+        yield json.loads(pending)
+
+
+def decode_stream(
+    read: Callable[[int], bytes],
+    ndjson: bool = False,
+    chunk_size: int = 64 * 1024,
+) -> tuple[Iterator[object] | None, object]:
+    # Arrays and NDJSON come back as a lazy item iterator; any other document (e.g. a small
+    # delta envelope) is decoded whole and returned as the second element.
+    if ndjson:
+        return iter_ndjson(read, chunk_size), None
+    buf = _TextBuffer(read, chunk_size)
+    if buf.skip_whitespace() == "[":
+        return _iter_array(buf), None
+    return None, buf.decode_value()
@@ -1,24 +1,34 @@
+import asyncio
+import math
 import os
 import random
 import shutil
 import subprocess
 import threading
 import time
-from collections import deque
-from ipaddress import ip_address
 from pathlib import Path
 
-from app.audit import audit_log
+from app.audit import LogPipeline, RingSink, RotatingFileSink, StdoutSink
 from app.bandwidth import BandwidthAllocator, measure_throughput_mbps
 from app.control import ControlServer
 from app.fallback import FallbackProvisioner
+from app.http_session import HTTPSession
 from app.metrics import Metrics
-from app.network import auto_network_config, derive_wg_public_key
-from app.payment import PaymentVerifier
-from app.pool import PoolClient, Provider, fastest_provider, mesh_cycle
+from app.network import PublicIPDetector, derive_wg_public_key, detect_local_ip, is_cgnat_suspected
+from app.payment import CachedPaymentVerifier, PaymentVerifier
+from app.peers import PeerLease, PeerLifecycle
+from app.portmap import PortMapper, PortMapping
+from app.pool import PoolClient, Provider, fastest_provider, provider_check
+from app.probe import EchoResponder
+from app.runtime import ServiceRuntime, StartupTrace
+from app.scoreboard import ProviderScoreboard
 from app.security import SecureTokenStore
+from app.shaping import DryRunShaper, TcShaper
+from app.stun import NatDiscovery, StunDetector
+from app.telemetry import TunnelTelemetry
 from app.startup import StartupManager
 from app.tray import run_tray
+from app.wireguard import SESSION_LIFETIME_SECONDS, Peer, WireGuardInterface
 
 
 class RotationRequested(Exception):
@@ -86,51 +96,71 @@ def render_danted_config(danted_template_path: Path, danted_config_path: Path) -
     danted_config_path.write_text(content)
 
 
-def run(cmd: list[str]) -> None:
-    subprocess.run(cmd, check=True)
-
-
-def endpoint_host(endpoint: str) -> str:
-    if endpoint.startswith("["):
-        host, remainder = endpoint.split("]", 1)
-        if not remainder.startswith(":"):
-            raise ValueError("Invalid endpoint format")
-        return host[1:]
-    host, _ = endpoint.rsplit(":", 1)
-    return host
-
-
-def ensure_wg_private_key() -> None:
+def provider_rejection(provider: Provider, my_public_ip: str | None, my_local_ip: str | None) -> str | None:
+    check = provider_check(provider)
+    if check.host is None:
+        return None
+    if my_public_ip and check.host == my_public_ip:
+        return "same_public_ip"
+    if my_local_ip and check.host == my_local_ip:
+        return "same_local_ip"
+    if check.non_public_ip:
+        return "non_public_ip"
+    # Hostname or public IP: allow unless explicitly same as local/public.
+    return None
+
+
+def eligible_providers(
+    providers: list[Provider], node_id: str, my_public_ip: str | None, my_local_ip: str | None
+) -> tuple[list[int], list[str]]:
+    # Indices into `providers`, so large pools are filtered without being copied.
+    eligible: list[int] = []
+    rejected: list[str] = []
+    for index, provider in enumerate(providers):
+        if provider.id == node_id:
+            continue
+        reason = provider_rejection(provider, my_public_ip, my_local_ip)
+        if reason:
+            rejected.append(f"{provider.id}:{reason}")
+            continue
+        eligible.append(index)
+    return eligible, rejected
+
+
+def ensure_wg_private_key() -> str | None:
+    # Validating the key with `wg pubkey` already yields the public key, so callers reuse it
+    # instead of spawning `wg` a second time.
     key = os.getenv("WG_PRIVATE_KEY", "")
-    valid = False
     if key:
-        try:
-            subprocess.run(
-                ["wg", "pubkey"],
-                input=key,
-                text=True,
-                capture_output=True,
-                check=True,
-                timeout=3,
-            )
-            valid = True
-        except Exception:
-            valid = False
-    if valid:
-        return
+        public_key = derive_wg_public_key(key)
+        if public_key:
+            return public_key
     generated = subprocess.run(["wg", "genkey"], capture_output=True, text=True, check=True, timeout=3).stdout.strip()
     if not generated:
         raise RuntimeError("Unable to generate WireGuard private key")
     os.environ["WG_PRIVATE_KEY"] = generated
+    return derive_wg_public_key(generated)
 
 
 class DVPNService:
     def __init__(self) -> None:
+        self.startup_trace = StartupTrace()
         self.wg_enabled = env("ENABLE_WIREGUARD", "true").lower() == "true"
         self.socks_enabled = env("ENABLE_SOCKS", "true").lower() == "true"
         self.wg_quick_cmd = env("WG_QUICK_CMD", "wg-quick")
         self.danted_cmd = env("DANTED_CMD", "danted")
         self.wg_config_path = Path(env("WG_CONFIG_PATH", "/tmp/dvpn/wg0.conf"))
+        # wg-quick names the interface after the config file, so wg0.conf drives `wg0`.
+        self.wg = WireGuardInterface(
+            self.wg_config_path.stem,
+            self.wg_config_path,
+            wg_cmd=env("WG_CMD", "wg"),
+            wg_quick_cmd=self.wg_quick_cmd,
+        )
+        self.wg_incremental = env("WG_INCREMENTAL", "true").lower() == "true"
+        self.telemetry_interval_seconds = float(env("TELEMETRY_INTERVAL_SECONDS", "10"))
+        self.telemetry = TunnelTelemetry(self.wg.peers, history=int(env("TELEMETRY_HISTORY", "60")))
+        self.wg_client_address: str | None = None
         self.danted_template_path = Path(env("DANTED_TEMPLATE_PATH", "scripts/danted.conf.template"))
         self.danted_config_path = Path(env("DANTED_CONFIG_PATH", "/tmp/dvpn/danted.conf"))
 
@@ -138,12 +168,34 @@ class DVPNService:
         passphrase = env("TOKEN_STORE_PASSPHRASE", env("PAYMENT_TOKEN", "local-dev-token"))
         self.token_store = SecureTokenStore(Path(env("TOKEN_STORE_PATH", "/tmp/dvpn/token.store")), passphrase)
         loaded = self.token_store.load_token() or env("PAYMENT_TOKEN", "")
+        # Pool and payment calls usually hit the same control-plane host, so they share one keep-alive pool.
+        self.http = HTTPSession(
+            timeout=int(env("CONNECT_TIMEOUT_SECONDS", "5")),
+            max_per_host=int(env("HTTP_MAX_CONNECTIONS_PER_HOST", "4")),
+            idle_timeout=float(env("HTTP_IDLE_TIMEOUT_SECONDS", "30")),
+            on_request=lambda method, host, seconds: self.metrics.observe(
+                "dvpn_http_request_seconds", seconds, {"host": host}
+            ),
+        )
         self.pool = PoolClient(
             env("POOL_URL"),
             timeout=int(env("CONNECT_TIMEOUT_SECONDS", "5")),
             pool_token=loaded,
+            session=self.http,
+        )
+        self.pay = PaymentVerifier(
+            env("PAYMENT_API_URL"),
+            loaded,
+            timeout=int(env("CONNECT_TIMEOUT_SECONDS", "5")),
+            session=self.http,
+        )
+        self.pay_cache = CachedPaymentVerifier(
+            self.pay,
+            ttl_seconds=float(env("PAYMENT_CACHE_TTL_SECONDS", "300")),
+            grace_seconds=float(env("PAYMENT_CACHE_GRACE_SECONDS", "120")),
+            refresh_ahead_seconds=float(env("PAYMENT_CACHE_REFRESH_AHEAD_SECONDS", "60")),
+            on_event=lambda event: self.metrics.inc(f"dvpn_payment_cache_{event}_total"),
         )
-        self.pay = PaymentVerifier(env("PAYMENT_API_URL"), loaded, timeout=int(env("CONNECT_TIMEOUT_SECONDS", "5")))
 
         self.fallback = FallbackProvisioner(
             enabled=env("FALLBACK_ENABLED", "false").lower() == "true",
@@ -152,6 +204,20 @@ class DVPNService:
             timeout=int(env("FALLBACK_TIMEOUT_SECONDS", "30")),
         )
         self.mesh_sample_size = int(env("MESH_SAMPLE_SIZE", "3"))
+        self.probe_workers = int(env("PROBE_WORKERS", "16"))
+        self.probe_deadline_seconds = float(env("PROBE_DEADLINE_SECONDS", "4"))
+        good_enough = float(env("PROBE_GOOD_ENOUGH_MS", "0"))
+        self.probe_good_enough_ms = good_enough if good_enough > 0 else None
+        self.probe_samples = int(env("PROBE_SAMPLES", "3"))
+        self.probe_responder_enabled = env("PROBE_RESPONDER_ENABLED", "true").lower() == "true"
+        self.node_probe_port = int(env("NODE_PROBE_PORT", "51821"))
+        self.probe_responder: EchoResponder | None = None
+        self.scoreboard = ProviderScoreboard(
+            Path(env("SCOREBOARD_PATH", "/tmp/dvpn/scoreboard.json")),
+            max_entries=int(env("SCOREBOARD_MAX_ENTRIES", "4096")),
+            half_life_seconds=float(env("SCOREBOARD_HALF_LIFE_SECONDS", "21600")),
+        )
+        self.scoreboard.load()
         self.auto_network_enabled = env("AUTO_NETWORK_CONFIG", "true").lower() == "true"
         self.upnp_enabled = env("UPNP_ENABLED", "true").lower() == "true"
         self.node_register_enabled = env("NODE_REGISTER_ENABLED", "true").lower() == "true"
@@ -164,34 +230,120 @@ class DVPNService:
         self.bandwidth_test_url = env("BANDWIDTH_TEST_URL", "https://speed.cloudflare.com/__down?bytes=25000000")
         self.bandwidth_sample_seconds = int(env("BANDWIDTH_SAMPLE_SECONDS", "4"))
         self.bandwidth_total_mbps = float(env("BANDWIDTH_TOTAL_MBPS", "0"))
-        if self.bandwidth_total_mbps <= 0:
-            try:
-                self.bandwidth_total_mbps = measure_throughput_mbps(
-                    self.bandwidth_test_url,
-                    timeout=int(env("CONNECT_TIMEOUT_SECONDS", "5")),
-                    sample_seconds=self.bandwidth_sample_seconds,
-                )
-            except Exception:
-                self.bandwidth_total_mbps = 100.0
-        self.bandwidth = BandwidthAllocator(self.bandwidth_total_mbps, fraction_per_connection=0.5)
-        self.metrics = Metrics()
+        # Without a configured total, start from 100 Mbps and let the startup throughput test
+        # replace it in the background instead of blocking construction for the sample window.
+        self.bandwidth_measure_pending = self.bandwidth_total_mbps <= 0
+        self.bandwidth_streams = max(1, int(env("BANDWIDTH_STREAMS", "4")))
+        # Measured totals are refreshed in the background; a configured total is left alone.
+        self.bandwidth_remeasure_seconds = (
+            float(env("BANDWIDTH_REMEASURE_SECONDS", "3600")) if self.bandwidth_measure_pending else 0.0
+        )
+        if self.bandwidth_measure_pending:
+            self.bandwidth_total_mbps = 100.0
+        self.metrics = Metrics(max_series=int(env("METRICS_MAX_SERIES", "256")))
+        # Grants for provider-side peers are enforced on the WireGuard interface when a backend is set.
+        shaping_backend = env("SHAPING_BACKEND", "none").lower()
+        self.shaper: TcShaper | None = None
+        if shaping_backend == "tc":
+            self.shaper = TcShaper(self.wg.name, tc_cmd=env("TC_CMD", "tc"))
+        elif shaping_backend == "dry-run":
+            self.shaper = DryRunShaper(self.wg.name)
+        self.bandwidth = BandwidthAllocator(
+            self.bandwidth_total_mbps,
+            fraction_per_connection=0.5,
+            shaper=self.shaper,
+            on_shaping_error=self.on_shaping_error,
+        )
         self.metrics.set_gauge("dvpn_bandwidth_total_mbps", self.bandwidth_total_mbps)
         self.retry_seconds = int(env("RETRY_SECONDS", "15"))
         self.endpoint_rotate_seconds = int(env("ENDPOINT_ROTATE_SECONDS", "240"))
         self.endpoint_rotate_jitter_seconds = int(env("ENDPOINT_ROTATE_JITTER_SECONDS", "45"))
+        self.rotation_mode = env("ROTATION_MODE", "make_before_break").strip().lower()
+        self.rotation_started_at: float | None = None
+        self.current_provider: Provider | None = None
         self.rotation_rng = random.SystemRandom()
         self.log_stdout = env("LOG_STDOUT", "false").lower() == "true"
+        # In-memory only, bounded. This is used for debugging via /logs without persisting anything.
+        self.log_ring = RingSink(maxlen=200)
+        log_sinks: list = [self.log_ring]
+        if self.log_stdout:
+            log_sinks.append(StdoutSink("text"))
+        if env("AUDIT_ENABLED", "false").lower() == "true":
+            audit_path = env("AUDIT_LOG_PATH", "").strip()
+            if audit_path:
+                log_sinks.append(
+                    RotatingFileSink(
+                        Path(audit_path),
+                        max_bytes=int(env("AUDIT_LOG_MAX_BYTES", "10000000")),
+                        backups=int(env("AUDIT_LOG_BACKUPS", "3")),
+                    )
+                )
+            else:
+                log_sinks.append(StdoutSink("json"))
+        # Sinks are resolved once here; log() fills the ring and enqueues, and a writer thread formats and writes the rest in batches.
+        self.log_pipeline = LogPipeline(
+            log_sinks,
+            capacity=int(env("LOG_QUEUE_SIZE", "4096")),
+            policy=env("LOG_OVERFLOW_POLICY", "drop_oldest").strip().lower(),
+            flush_interval=float(env("LOG_FLUSH_SECONDS", "0.2")),
+            on_drop=lambda count: self.metrics.inc("dvpn_log_dropped_total", count),
+        )
         self.running = True
         self.desired_connected = True
+        self.runtime = ServiceRuntime()
         self.last_provider_id: str | None = None
         self.current_pool_event: str = "uninitialized"
         self.current_connection_event: str = "disconnected"
         self.current_phase: str = "idle"
-        # In-memory only, bounded. This is used for debugging via /logs without persisting anything.
-        self.recent_logs: deque[str] = deque(maxlen=200)
         self.socks_proc: subprocess.Popen | None = None
         self.last_detected_public_ip: str | None = None
         self.last_detected_local_ip: str | None = None
+        self.network_detected = False
+        self.public_ip_detector = PublicIPDetector(
+            timeout=int(env("CONNECT_TIMEOUT_SECONDS", "5")),
+            ttl_seconds=float(env("PUBLIC_IP_CACHE_TTL_SECONDS", "300")),
+        )
+        stun_servers = [
+            server.strip()
+            for server in env("STUN_SERVERS", "stun.l.google.com:19302,stun.cloudflare.com:3478").split(",")
+            if server.strip()
+        ]
+        self.stun: StunDetector | None = None
+        if env("STUN_ENABLED", "true").lower() == "true" and stun_servers:
+            self.stun = StunDetector(
+                stun_servers,
+                local_port=self.node_port,
+                timeout=float(env("STUN_TIMEOUT_SECONDS", "2")),
+                ttl_seconds=float(env("PUBLIC_IP_CACHE_TTL_SECONDS", "300")),
+            )
+        self.nat: NatDiscovery | None = None
+        self.cgnat_suspected = False
+        self.upnp_mapped = False
+        self.port_mapping: PortMapping | None = None
+        self.port_mapper: PortMapper | None = None
+        if self.auto_network_enabled and self.upnp_enabled:
+            self.port_mapper = PortMapper(
+                self.node_port,
+                lease_seconds=int(env("PORTMAP_LEASE_SECONDS", "3600")),
+                on_change=self.on_port_mapping,
+            )
+        # Clients probe the echo responder, not the WireGuard port, so it needs a mapping of its own.
+        self.probe_port_mapping: PortMapping | None = None
+        self.probe_port_mapper: PortMapper | None = None
+        if self.port_mapper is not None and self.probe_responder_enabled:
+            self.probe_port_mapper = PortMapper(
+                self.node_probe_port,
+                lease_seconds=int(env("PORTMAP_LEASE_SECONDS", "3600")),
+                description="DVPN probe",
+                on_change=self.on_probe_port_mapping,
+            )
+        self.registered_endpoint: str | None = None
+        self.registered_probe_port: int | None = None
+        # Registration runs from startup and from the port mapper's thread; one at a time.
+        self.register_lock = threading.RLock()
+        self.wg_public_key: str | None = None
+        self.startup_tasks: dict[str, asyncio.Future] = {}
+        self.background_tasks: list[asyncio.Future] = []
         self.provider_forward_disable_cmd = env("PROVIDER_FORWARD_DISABLE_CMD", "").strip()
         self.provider_forward_enable_cmd = env(
             "PROVIDER_FORWARD_ENABLE_CMD",
@@ -200,14 +352,19 @@ class DVPNService:
         self.pool_pruned_on_startup = False
         self.provider_server_ready = False
         self.provider_forwarding_applied = False
-        self.handled_claim_nonces: set[str] = set()
+        self.provider_peers = PeerLifecycle(
+            idle_seconds=float(env("PROVIDER_PEER_IDLE_SECONDS", "900")),
+            max_nonces=int(env("PROVIDER_NONCE_WINDOW_SIZE", "65536")),
+        )
+        self.claim_batch_size = max(1, int(env("PROVIDER_CLAIM_BATCH_SIZE", "32")))
+        self.claim_wait_seconds = max(0.0, float(env("PROVIDER_CLAIM_WAIT_SECONDS", "10")))
+        self.provider_standby_seconds = max(1.0, float(env("PROVIDER_STANDBY_SECONDS", "30")))
+        # Claims the pool already handed over; kept here so a cancelled standby applies them next time.
+        self.pending_claims: list[dict] = []
+        self.claims_lock = threading.Lock()
 
     def log(self, message: str) -> None:
-        line = f"[dvpn] {message}"
-        self.recent_logs.append(line)
-        if self.log_stdout:
-            print(line, flush=True)
-        audit_log("service_log", message=message)
+        self.log_pipeline.emit("service_log", message)
 
     def log_pool(self, message: str) -> None:
         self.current_pool_event = message
@@ -259,6 +416,31 @@ class DVPNService:
         finally:
             self.pool_pruned_on_startup = True
 
+    def record_provider_outcome(self, provider_id: str, success: bool, seconds: float | None = None) -> None:
+        self.scoreboard.record_handshake(provider_id, success, seconds)
+        try:
+            self.scoreboard.save()
+        except OSError as err:
+            self.log_pool(f"scoreboard save failed: {err}")
+
+    def ensure_probe_responder(self) -> None:
+        if not self.probe_responder_enabled:
+            return
+        if self.probe_responder is not None and self.probe_responder.running:
+            return
+        try:
+            self.probe_responder = EchoResponder("0.0.0.0", self.node_probe_port)
+            self.probe_responder.start()
+            self.log_connection(f"latency probe responder listening on udp/{self.node_probe_port}")
+        except OSError as err:
+            self.probe_responder = None
+            self.log_connection(f"latency probe responder unavailable: {err}")
+
+    def stop_probe_responder(self) -> None:
+        if self.probe_responder is not None:
+            self.probe_responder.stop()
+            self.probe_responder = None
+
     def ensure_provider_server_up(self) -> None:
         if not self.wg_enabled:
             return
@@ -270,33 +452,102 @@ class DVPNService:
         self.provider_server_ready = True
         self.log_connection("provider wireguard server ready")
 
-    def apply_provider_claim(self, claim: dict) -> None:
-        lease_nonce = str(claim.get("lease_nonce", "")).strip()
-        client_ip = str(claim.get("client_ip", "")).strip()
-        client_pub = str(claim.get("client_public_key", "")).strip()
-        if not lease_nonce or not client_ip or not client_pub:
-            return
-        if lease_nonce in self.handled_claim_nonces:
-            return
-        if shutil.which("wg") is None:
+    def apply_provider_claims(self, claims: list[dict]) -> int:
+        # Replayed nonces and expired leases are dropped here, before anything touches WireGuard.
+        leases = self.provider_peers.admissible(claims)
+        if not leases:
+            return 0
+        if shutil.which(self.wg.wg_cmd) is None:
             self.log_connection("provider claim skipped: missing wg command")
-            return
-        run(["wg", "set", "wg0", "peer", client_pub, "allowed-ips", client_ip, "persistent-keepalive", "25"])
-        self.handled_claim_nonces.add(lease_nonce)
-        self.log_connection(f"provider peer added {client_ip}")
-
-    def poll_provider_claim_once(self) -> None:
+            return 0
+        # Every admitted client goes into one `wg set`, however many claims the batch held.
+        peers = [Peer(lease.public_key, lease.client_ip, persistent_keepalive=25) for lease in leases]
+        try:
+            self.wg.set_peers(peers, remove_others=False)
+        except subprocess.CalledProcessError as err:
+            # One peer the kernel refuses fails the whole command; retry one at a time so the rest still land.
+            self.log_connection(f"provider claim batch failed, retrying per peer: {err}")
+            applied: list[PeerLease] = []
+            for lease, peer in zip(leases, peers):
+                try:
+                    self.wg.set_peers([peer], remove_others=False)
+                except subprocess.CalledProcessError as peer_err:
+                    self.metrics.inc("dvpn_provider_claims_rejected_total")
+                    self.log_connection(f"provider claim rejected for {lease.client_ip}: {peer_err}")
+                else:
+                    applied.append(lease)
+            leases = applied
+            if not leases:
+                return 0
+        self.provider_peers.track(leases)
+        self.bandwidth.open_connections([(f"peer:{lease.public_key}", lease.client_ip) for lease in leases])
+        self.metrics.set_gauge("dvpn_active_connections", self.bandwidth.active_count)
+        self.metrics.inc("dvpn_provider_claims_applied_total", len(leases))
+        self.metrics.set_gauge("dvpn_provider_peers", len(self.provider_peers))
+        self.metrics.set_gauge("dvpn_provider_claim_nonces", len(self.provider_peers.nonces))
+        self.log_connection(f"provider peers added: {', '.join(lease.client_ip for lease in leases)}")
+        return len(leases)
+
+    def on_shaping_error(self, err: Exception) -> None:
+        self.metrics.inc("dvpn_shaping_failure_total")
+        self.log_connection(f"bandwidth shaping failed: {err}")
+
+    def evict_provider_peers(self) -> int:
+        lifecycle = self.provider_peers
+        expired = lifecycle.expired()
+        idle: list[str] = []
+        if lifecycle.idle_seconds > 0 and lifecycle.leases:
+            try:
+                handshakes = self.wg.latest_handshakes()
+            except (subprocess.CalledProcessError, subprocess.TimeoutExpired, OSError) as err:
+                self.log_connection(f"provider idle check failed: {err}")
+            else:
+                idle = [public_key for public_key in lifecycle.idle(handshakes) if public_key not in expired]
+        evicted = expired + idle
+        if not evicted:
+            return 0
+        try:
+            # One `wg set` removes the whole batch; on failure the leases stay queued for the next sweep.
+            self.wg.remove_peers(evicted)
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired, OSError) as err:
+            self.log_connection(f"provider peer eviction failed: {err}")
+            return 0
+        lifecycle.forget(evicted)
+        self.bandwidth.close_connections([f"peer:{public_key}" for public_key in evicted])
+        self.metrics.set_gauge("dvpn_active_connections", self.bandwidth.active_count)
+        self.metrics.inc("dvpn_provider_peers_expired_total", len(expired))
+        self.metrics.inc("dvpn_provider_peers_idle_evicted_total", len(idle))
+        self.metrics.set_gauge("dvpn_provider_peers", len(lifecycle))
+        self.metrics.set_gauge("dvpn_provider_claim_nonces", len(lifecycle.nonces))
+        self.log_connection(f"provider peers evicted: {len(expired)} expired, {len(idle)} idle")
+        return len(evicted)
+
+    def fetch_provider_claims(self, wait_seconds: float) -> int:
         try:
-            claim = self.pool.fetch_next_claim(self.node_id)
+            claims = self.pool.fetch_claims(self.node_id, limit=self.claim_batch_size, wait_seconds=wait_seconds)
         except Exception as err:
             self.log_pool(f"provider claim fetch failed: {err}")
-            return
-        if claim:
-            self.apply_provider_claim(claim)
+            return 0
+        with self.claims_lock:
+            self.pending_claims.extend(claims)
+        return len(claims)
+
+    def apply_pending_claims(self) -> int:
+        with self.claims_lock:
+            claims, self.pending_claims = self.pending_claims, []
+        return self.apply_provider_claims(claims)
 
     def subscription_active(self) -> bool:
         self.pool.set_token(self.pay.token)
-        return self.pay.is_active("pool-access")
+        return self.payment_active("pool-access")
+
+    def payment_active(self, provider_id: str) -> bool:
+        with self.metrics.timer("dvpn_call_seconds", {"call": "is_active"}):
+            return self.pay_cache.is_active(provider_id)
+
+    def fetch_providers(self) -> list[Provider]:
+        with self.metrics.timer("dvpn_call_seconds", {"call": "fetch_providers"}):
+            return self.pool.fetch_providers()
 
     def wg_down(self) -> None:
         if not self.wg_enabled:
@@ -309,10 +560,25 @@ class DVPNService:
             self.wg_enabled = False
             return
         try:
-            run([self.wg_quick_cmd, "down", str(self.wg_config_path)])
-        except subprocess.CalledProcessError:
+            self.wg.down()
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
             pass
         self.provider_server_ready = False
+        self.wg_client_address = None
+        if self.shaper is not None:
+            self.shaper.forget()
+        self.drop_provider_peers()
+
+    def drop_provider_peers(self) -> None:
+        # The interface took every peer down with it, so their leases and bandwidth grants go too.
+        public_keys = list(self.provider_peers.leases)
+        if not public_keys:
+            return
+        self.provider_peers.forget(public_keys)
+        self.bandwidth.close_connections([f"peer:{public_key}" for public_key in public_keys])
+        self.metrics.set_gauge("dvpn_active_connections", self.bandwidth.active_count)
+        self.metrics.set_gauge("dvpn_provider_peers", len(self.provider_peers))
+        self.metrics.set_gauge("dvpn_provider_claim_nonces", len(self.provider_peers.nonces))
 
     def wg_up(self) -> None:
         if not self.wg_enabled:
@@ -321,7 +587,37 @@ class DVPNService:
             self.log(f"wireguard disabled: missing command {self.wg_quick_cmd}")
             self.wg_enabled = False
             return
-        run([self.wg_quick_cmd, "up", str(self.wg_config_path)])
+        self.wg.up()
+
+    def client_peer(self, provider: Provider, allowed_ips: str | None = None, keepalive: int | None = None) -> Peer:
+        return Peer(
+            provider.public_key,
+            provider.allowed_ips if allowed_ips is None else allowed_ips,
+            provider.endpoint,
+            keepalive if keepalive is not None else int(env("WG_PERSISTENT_KEEPALIVE", "25")),
+        )
+
+    def connect_tunnel(self, provider: Provider) -> bool:
+        # Returns whether wg0 was reconfigured; an unchanged peer keeps its session and will not re-handshake.
+        write_wg_config(provider, self.wg_config_path)
+        address = (provider.client_ip or "").strip() or env("WG_ADDRESS")
+        if self.wg_incremental and self.wg.is_up and self.wg_client_address is not None:
+            try:
+                if address != self.wg_client_address:
+                    self.wg.add_address(address)
+                changes = self.wg.set_peers([self.client_peer(provider)])
+                moved = address != self.wg_client_address
+                if moved:
+                    self.wg.remove_address(self.wg_client_address)
+                    self.wg_client_address = address
+                self.log_connection(f"wireguard peers updated in place ({len(changes)} args)")
+                return bool(changes) or moved
+            except (subprocess.CalledProcessError, subprocess.TimeoutExpired, OSError) as err:
+                self.log_connection(f"incremental wireguard update failed: {err}; restarting interface")
+        self.wg_down()
+        self.wg_up()
+        self.wg_client_address = address
+        return True
 
     def start_socks(self) -> None:
         if not self.socks_enabled:
@@ -344,21 +640,30 @@ class DVPNService:
             self.log("start blocked: killswitch enabled")
             return {"ok": False, "killswitch_enabled": True}
         self.desired_connected = True
+        self.runtime.wake()
         self.log("requested start")
         return {"ok": True}
 
     def stop(self) -> dict:
         self.desired_connected = False
+        self.runtime.wake(interrupt=True)
         if self.last_provider_id:
             self.bandwidth.close_connection(self.last_provider_id)
             self.metrics.set_gauge("dvpn_active_connections", self.bandwidth.active_count)
-        self.wg_down()
-        self.stop_socks()
-        self.restore_provider_forwarding()
+        self.current_provider = None
+        self.rotation_started_at = None
+        self.runtime.call_exclusive(self.tear_down, True)
         self.set_phase("stopped")
         self.log_connection("stopped")
         return {"ok": True}
 
+    def tear_down(self, restore_forwarding: bool = False) -> None:
+        # Control actions run this on the tunnel lane, so it lands after any wg step already in flight.
+        self.wg_down()
+        self.stop_socks()
+        if restore_forwarding:
+            self.restore_provider_forwarding()
+
     def payment_flow(self) -> dict:
         session = self.pay.begin_checkout(user_id=self.user_id)
         return {"ok": True, "checkout": session}
@@ -367,20 +672,19 @@ class DVPNService:
         if self.killswitch_enabled:
             return {"ok": False, "killswitch_enabled": True}
         self.log_connection("restarting")
-        self.wg_down()
-        self.stop_socks()
+        self.runtime.call_exclusive(self.tear_down)
         self.set_phase("restarting")
         self.last_provider_id = None
         self.desired_connected = True
+        self.runtime.wake(interrupt=True)
         return {"ok": True}
 
     def toggle_killswitch(self) -> dict:
         self.killswitch_enabled = not self.killswitch_enabled
         if self.killswitch_enabled:
             self.desired_connected = False
-            self.wg_down()
-            self.stop_socks()
-            self.restore_provider_forwarding()
+            self.runtime.wake(interrupt=True)
+            self.runtime.call_exclusive(self.tear_down, True)
         self.log_connection(f"killswitch={self.killswitch_enabled}")
         return {"ok": True, "killswitch_enabled": self.killswitch_enabled}
 
@@ -393,13 +697,18 @@ class DVPNService:
     def exit(self) -> dict:
         self.running = False
         self.stop()
+        self.stop_probe_responder()
+        for mapper in (self.port_mapper, self.probe_port_mapper):
+            if mapper is not None:
+                mapper.stop()
+        self.http.close()
         self.log_connection("exit")
         return {"ok": True}
 
     def get_logs(self) -> dict:
         return {
             "ok": True,
-            "logs": list(self.recent_logs)[-80:],
+            "logs": list(self.log_ring.lines)[-80:],
         }
 
     def metrics_text(self) -> str:
@@ -414,225 +723,584 @@ class DVPNService:
             "pool": self.current_pool_event,
             "connection": self.current_connection_event,
             "phase": self.current_phase,
+            "startup": self.startup_trace.snapshot(),
+            "peers": self.telemetry.snapshot(),
         }
 
-    def verify_handshake(self, provider: Provider, timeout_seconds: int = 20) -> bool:
-        deadline = time.time() + timeout_seconds
-        while time.time() < deadline:
+    async def rotate_make_before_break(self, current: Provider) -> Provider:
+        # Selection, payment and the handshake wait run on the I/O pool; only the wg changes hold the
+        # tunnel lane, so stop/killswitch never queue behind a 20 s handshake timeout.
+        candidate = await self.runtime.blocking(self.choose_pool_provider)
+        if candidate.id == current.id or candidate.public_key == current.public_key:
+            raise RuntimeError("no alternative provider for make-before-break rotation")
+        if not await self.runtime.blocking(self.payment_active, candidate.id):
+            self.metrics.inc("dvpn_payment_failure_total")
+            raise RuntimeError(f"Payment inactive for provider {candidate.id}")
+        await self.runtime.blocking(self.pool.mark_approved, candidate, self.pay.token)
+
+        baseline = await self.runtime.blocking(self.handshake_baseline, candidate)
+        await self.runtime.exclusive(self.stage_peer, candidate)
+        handshake_started = time.monotonic()
+        if not await self.runtime.blocking(self.verify_handshake, candidate, baseline):
+            self.record_provider_outcome(candidate.id, success=False)
+            await self.runtime.exclusive(self.unstage_peer, candidate)
+            raise RuntimeError(f"wireguard handshake not confirmed for staged provider {candidate.id}")
+        self.record_provider_outcome(candidate.id, success=True, seconds=time.monotonic() - handshake_started)
+
+        gap = await self.runtime.exclusive(self.switch_peer, current, candidate)
+        self.metrics.set_gauge("dvpn_rotation_gap_seconds", gap)
+        self.metrics.observe("dvpn_rotation_switch_seconds", gap)
+        self.metrics.inc("dvpn_rotation_total")
+        self.log_connection(f"rotated {current.id} -> {candidate.id} (make-before-break, gap={gap * 1000:.1f}ms)")
+        return candidate
+
+    def stage_peer(self, candidate: Provider) -> None:
+        # Stage the next peer without allowed-ips: it handshakes but carries no traffic yet,
+        # so the current tunnel keeps serving while we wait for confirmation.
+        self.wg.set_peers([self.client_peer(candidate, allowed_ips="", keepalive=1)], remove_others=False)
+
+    def unstage_peer(self, candidate: Provider) -> None:
+        try:
+            self.wg.remove_peers([candidate.public_key])
+        except subprocess.CalledProcessError:
+            pass
+
+    def switch_peer(self, current: Provider, candidate: Provider) -> float:
+        if not self.desired_connected:
+            # A stop landed on the lane between staging and the switch.
+            raise RuntimeError("rotation cancelled")
+        current_address = self.wg_client_address or (current.client_ip or "").strip() or env("WG_ADDRESS")
+        next_address = (candidate.client_ip or "").strip() or env("WG_ADDRESS")
+        switch_started = time.monotonic()
+        if next_address != current_address:
+            self.wg.add_address(next_address)
+        # Desired state is only the new peer, so one `wg set` moves allowed-ips to it and drops the old one together.
+        self.wg.set_peers([self.client_peer(candidate)])
+        gap = time.monotonic() - switch_started
+        if next_address != current_address:
             try:
-                proc = subprocess.run(
-                    ["wg", "show", "wg0", "latest-handshakes"],
-                    capture_output=True,
-                    text=True,
-                    check=True,
-                    timeout=3,
-                )
-                for line in proc.stdout.splitlines():
-                    parts = line.strip().split()
-                    if len(parts) != 2:
-                        continue
-                    pub, ts = parts
-                    if pub == provider.public_key and ts.isdigit() and int(ts) > 0:
-                        return True
-            except Exception:
+                self.wg.remove_address(current_address)
+            except subprocess.CalledProcessError:
                 pass
-            time.sleep(1)
-        return False
-
-    def maybe_register_node(self) -> None:
-        if self.node_registered or not self.node_register_enabled:
-            return
-        private_key = env("WG_PRIVATE_KEY", "")
-        public_key = derive_wg_public_key(private_key) if private_key else None
-        if not public_key:
-            self.log_pool("node registration skipped: unable to derive WireGuard public key")
-            return
+        self.wg_client_address = next_address
+        write_wg_config(candidate, self.wg_config_path)
+        return gap
 
-        endpoint = self.node_public_endpoint
-        local_ip = None
-        public_ip = None
-        upnp_mapped = False
-        if self.auto_network_enabled:
-            net = auto_network_config(self.upnp_enabled, self.node_port)
-            local_ip = net.local_ip
-            public_ip = net.public_ip
-            self.last_detected_local_ip = local_ip
-            self.last_detected_public_ip = public_ip
-            upnp_mapped = net.upnp_mapped
-            if net.cgnat_suspected:
-                self.log_pool("network warning: cgnat suspected; direct inbound may fail")
-            if self.upnp_enabled and not upnp_mapped:
-                self.log_pool("network warning: upnp mapping unavailable")
-            if not endpoint and public_ip:
-                # If public_ip is IPv6, wrap in brackets for host:port formatting.
-                endpoint = f"[{public_ip}]:{self.node_port}" if ":" in public_ip else f"{public_ip}:{self.node_port}"
-
-        if not endpoint:
-            self.log_pool("node registration skipped: no public endpoint detected")
+    def handshake_baseline(self, provider: Provider) -> int:
+        # Read before wg0 is touched: only a handshake newer than this proves the new configuration.
+        try:
+            return self.wg.latest_handshakes().get(provider.public_key, 0)
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired, OSError):
+            # No interface yet, so no earlier handshake either.
+            return 0
+
+    def verify_handshake(
+        self, provider: Provider, after: int, reconfigured: bool = True, timeout_seconds: int = 20
+    ) -> bool:
+        if not reconfigured and after > time.time() - SESSION_LIFETIME_SECONDS:
+            # Nothing on wg0 changed, so the live session is the proof: waiting for a newer
+            # handshake would take until the next rekey, long after the timeout.
+            return True
+        with self.metrics.timer("dvpn_call_seconds", {"call": "verify_handshake"}):
+            elapsed = self.wg.wait_for_handshake(provider.public_key, timeout=timeout_seconds, after=after)
+        if elapsed is None:
+            return False
+        self.metrics.observe("dvpn_handshake_seconds", elapsed)
+        return True
+
+    def prepare_wg_key(self) -> None:
+        self.wg_public_key = ensure_wg_private_key()
+
+    def detect_network(self) -> None:
+        # The public address is cached until the TTL lapses or the local address changes. Only called
+        # while no client tunnel is up: with full-tunnel routing every lookup would leave via the provider.
+        local_ip = detect_local_ip()
+        # STUN answers with the UDP mapping our WireGuard port gets; the HTTPS sources are only
+        # asked when no STUN server responds.
+        self.nat = self.stun.discover(local_ip) if self.stun is not None else None
+        public_ip = self.nat.mapped_ip if self.nat is not None else None
+        if not public_ip:
+            public_ip = self.public_ip_detector.detect(local_ip)
+        changed = not self.network_detected or (local_ip, public_ip) != (
+            self.last_detected_local_ip,
+            self.last_detected_public_ip,
+        )
+        self.last_detected_local_ip = local_ip
+        self.last_detected_public_ip = public_ip
+        self.cgnat_suspected = is_cgnat_suspected(public_ip)
+        self.network_detected = True
+        if changed and self.cgnat_suspected:
+            self.log_pool("network warning: cgnat suspected; direct inbound may fail")
+        if changed and self.nat is not None and self.nat.nat_type == "symmetric":
+            self.log_pool("network warning: symmetric nat; peers cannot reach the advertised port without a port mapping")
+
+    def on_port_mapping(self, mapping: PortMapping | None) -> None:
+        # Called from the port mapper's thread whenever the gateway mapping appears, changes or is lost.
+        self.port_mapping = mapping
+        self.upnp_mapped = mapping is not None
+        if mapping is None:
+            self.log_pool("network warning: port mapping unavailable")
             return
+        self.startup_trace.mark("port_mapped")
+        self.log_pool(f"port mapped via {mapping.method}: udp/{mapping.external_port} -> {self.node_port} (lease={mapping.lifetime}s)")
+        self.readvertise_if_moved()
+
+    def on_probe_port_mapping(self, mapping: PortMapping | None) -> None:
+        self.probe_port_mapping = mapping
+        if mapping is not None:
+            self.log_pool(f"probe port mapped via {mapping.method}: udp/{mapping.external_port} -> {self.node_probe_port}")
+        self.readvertise_if_moved()
+
+    def advertised_probe_port(self) -> int | None:
+        if not self.probe_responder_enabled:
+            return None
+        if self.probe_port_mapper is None:
+            # No gateway traversal configured: the port is reachable as-is or forwarded by the operator.
+            return self.node_probe_port
+        # Behind the gateway only a mapped port answers; without one clients rank us by score alone.
+        mapping = self.probe_port_mapping
+        return mapping.external_port if mapping is not None else None
+
+    def readvertise_if_moved(self) -> None:
+        # Registration does not wait for the mappings; re-advertise if they changed a port. A mapping
+        # that lands while a registration is in flight is picked up when that registration completes.
+        with self.register_lock:
+            if not (self.node_registered and self.registered_endpoint):
+                return
+            endpoint = self.registered_endpoint
+            public_ip = self.last_detected_public_ip
+            if public_ip and not self.node_public_endpoint:
+                endpoint = self.advertised_endpoint(public_ip)
+            if endpoint != self.registered_endpoint or self.advertised_probe_port() != self.registered_probe_port:
+                self.node_registered = False
+                self.maybe_register_node()
 
+    def advertised_endpoint(self, public_ip: str) -> str:
+        port = self.node_port
+        mapping = self.port_mapping
+        nat = self.nat
+        if mapping is not None:
+            # NAT-PMP gateways may grant a different external port than the one requested.
+            port = mapping.external_port
+        elif (
+            nat is not None
+            and nat.local_port == self.node_port
+            and nat.nat_type in ("open", "endpoint_independent")
+            and nat.mapped_ip == public_ip
+        ):
+            # An endpoint-independent NAT keeps the mapping STUN saw for NODE_PORT, so peers
+            # must use that (possibly rewritten) port.
+            port = nat.mapped_port or port
+        # If public_ip is IPv6, wrap in brackets for host:port formatting.
+        return f"[{public_ip}]:{port}" if ":" in public_ip else f"{public_ip}:{port}"
+
+    def measure_bandwidth(self) -> None:
         try:
-            self.pool.register_node(
-                node_id=self.node_id,
-                endpoint=endpoint,
-                public_key=public_key,
-                allowed_ips="0.0.0.0/0,::/0",
-                metadata={
-                    "user_id": self.user_id,
-                    "auto_network_config": self.auto_network_enabled,
-                    "upnp_mapped": upnp_mapped,
-                    "cgnat_suspected": getattr(net, "cgnat_suspected", False) if self.auto_network_enabled else False,
-                    "local_ip": local_ip,
-                    "public_ip": public_ip,
-                },
+            total = measure_throughput_mbps(
+                self.bandwidth_test_url,
+                timeout=int(env("CONNECT_TIMEOUT_SECONDS", "5")),
+                sample_seconds=self.bandwidth_sample_seconds,
+                streams=self.bandwidth_streams,
             )
-            self.node_registered = True
-            self.metrics.inc("dvpn_node_register_success_total")
-            self.log_pool(f"registered local node as {self.node_id} ({endpoint})")
         except Exception as err:
-            self.metrics.inc("dvpn_node_register_failure_total")
-            self.log_pool(f"node registration failed: {err}")
-
-    def choose_pool_provider(self) -> Provider:
-        providers = self.pool.fetch_providers()
-        providers = [p for p in providers if p.id != self.node_id]
-        if self.auto_network_enabled and (not self.last_detected_public_ip and not self.last_detected_local_ip):
-            net = auto_network_config(self.upnp_enabled, self.node_port)
-            self.last_detected_local_ip = net.local_ip
-            self.last_detected_public_ip = net.public_ip
-        rejected: list[str] = []
-        safe: list[Provider] = []
-        my_public_ip = self.last_detected_public_ip
-        my_local_ip = self.last_detected_local_ip
-        for provider in providers:
+            self.log(f"bandwidth test failed: {err}; keeping {self.bandwidth_total_mbps:.0f}Mbps")
+            return
+        self.bandwidth_total_mbps = total
+        self.bandwidth.set_total(total)
+        self.metrics.set_gauge("dvpn_bandwidth_total_mbps", total)
+        self.log(f"bandwidth measured: {total:.2f}Mbps")
+
+    def sample_tunnel_telemetry(self) -> None:
+        try:
+            peers, gone = self.telemetry.sample()
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired, OSError):
+            # No interface between sessions: every peer's series goes away.
+            peers, gone = {}, self.telemetry.reset()
+        for public_key in gone:
+            self.metrics.remove_series({"peer": public_key})
+        now = time.time()
+        grants = self.bandwidth.grants()
+        rx_total = tx_total = 0.0
+        for public_key, peer in peers.items():
+            labels = {"peer": public_key}
+            age = peer.handshake_age(now)
+            if age is not None:
+                self.metrics.set_gauge("dvpn_peer_handshake_age_seconds", round(age, 1), labels)
+            latest = peer.latest
+            if latest is None:
+                continue
+            rx_total += latest.rx_mbps
+            tx_total += latest.tx_mbps
+            self.metrics.inc("dvpn_peer_rx_bytes_total", latest.rx_bytes, labels)
+            self.metrics.inc("dvpn_peer_tx_bytes_total", latest.tx_bytes, labels)
+            self.metrics.set_gauge("dvpn_peer_rx_mbps", round(latest.rx_mbps, 3), labels)
+            self.metrics.set_gauge("dvpn_peer_tx_mbps", round(latest.tx_mbps, 3), labels)
+            grant = grants.get(f"peer:{public_key}")
+            if grant:
+                # What a provider sends a client (tx) is what its grant caps.
+                self.metrics.set_gauge("dvpn_peer_grant_mbps", round(grant, 3), labels)
+                self.metrics.set_gauge("dvpn_peer_grant_utilisation", round(latest.tx_mbps / grant, 3), labels)
+        self.metrics.set_gauge("dvpn_tunnel_rx_mbps", round(rx_total, 3))
+        self.metrics.set_gauge("dvpn_tunnel_tx_mbps", round(tx_total, 3))
+
+    async def run_telemetry(self) -> None:
+        while self.running:
+            await self.runtime.blocking(self.sample_tunnel_telemetry)
+            await asyncio.sleep(self.telemetry_interval_seconds)
+
+    async def remeasure_bandwidth(self) -> None:
+        # Grants follow the link as it changes; set_total rebalances them live.
+        while self.running:
+            await asyncio.sleep(self.bandwidth_remeasure_seconds)
+            if self.link_busy():
+                continue
+            await self.runtime.blocking(self.measure_bandwidth)
+
+    def link_busy(self) -> bool:
+        # Through a client tunnel the test measures the provider's exit, and peers being served
+        # compete with it, so either would drag the total (and every grant) down.
+        return self.current_provider is not None or self.wg_client_address is not None or len(self.provider_peers) > 0
+
+    def maybe_register_node(self) -> None:
+        with self.register_lock:
+            if self.node_registered or not self.node_register_enabled:
+                return
+            public_key = self.wg_public_key
+            if not public_key:
+                private_key = env("WG_PRIVATE_KEY", "")
+                public_key = derive_wg_public_key(private_key) if private_key else None
+            if not public_key:
+                self.log_pool("node registration skipped: unable to derive WireGuard public key")
+                return
+
+            endpoint = self.node_public_endpoint
+            local_ip = None
+            public_ip = None
+            if self.auto_network_enabled:
+                if not self.network_detected:
+                    self.detect_network()
+                local_ip = self.last_detected_local_ip
+                public_ip = self.last_detected_public_ip
+                if not endpoint and public_ip:
+                    endpoint = self.advertised_endpoint(public_ip)
+
+            if not endpoint:
+                self.log_pool("node registration skipped: no public endpoint detected")
+                return
+
+            probe_port = self.advertised_probe_port()
             try:
-                host = endpoint_host(provider.endpoint)
-                if my_public_ip and host == my_public_ip:
-                    rejected.append(f"{provider.id}:same_public_ip")
-                    continue
-                if my_local_ip and host == my_local_ip:
-                    rejected.append(f"{provider.id}:same_local_ip")
-                    continue
-                parsed = ip_address(host)
-                if parsed.is_private or parsed.is_loopback or parsed.is_link_local or parsed.is_unspecified:
-                    rejected.append(f"{provider.id}:non_public_ip")
-                    continue
-            except ValueError:
-                # Hostname or public IP: allow unless explicitly same as local/public.
-                pass
-            safe.append(provider)
-        providers = safe
+                self.pool.register_node(
+                    node_id=self.node_id,
+                    endpoint=endpoint,
+                    public_key=public_key,
+                    allowed_ips="0.0.0.0/0,::/0",
+                    metadata={
+                        "user_id": self.user_id,
+                        "auto_network_config": self.auto_network_enabled,
+                        "upnp_mapped": self.upnp_mapped,
+                        "cgnat_suspected": self.cgnat_suspected if self.auto_network_enabled else False,
+                        "local_ip": local_ip,
+                        "public_ip": public_ip,
+                        "nat_type": self.nat.nat_type if self.nat is not None else None,
+                        "probe_port": probe_port,
+                    },
+                )
+                self.node_registered = True
+                self.registered_endpoint = endpoint
+                self.registered_probe_port = probe_port
+                self.metrics.inc("dvpn_node_register_success_total")
+                self.log_pool(f"registered local node as {self.node_id} ({endpoint})")
+            except Exception as err:
+                self.metrics.inc("dvpn_node_register_failure_total")
+                self.log_pool(f"node registration failed: {err}")
+                return
+            self.readvertise_if_moved()
+
+    def choose_pool_provider(self, providers: list[Provider] | None = None) -> Provider:
+        if providers is None:
+            providers = self.fetch_providers()
+        if self.auto_network_enabled and self.wg_client_address is None:
+            # With a client tunnel up, detection would see the tunnel address and the provider's exit
+            # IP, so selection keeps the pre-tunnel result instead.
+            self.detect_network()
+        eligible, rejected = eligible_providers(
+            providers, self.node_id, self.last_detected_public_ip, self.last_detected_local_ip
+        )
         if rejected:
-            self.log_pool(f"rejected unsafe providers: {','.join(rejected)}")
-        if not providers:
+            shown = ",".join(rejected[:20])
+            more = f" (+{len(rejected) - 20} more)" if len(rejected) > 20 else ""
+            self.log_pool(f"rejected unsafe providers: {shown}{more}")
+        if not eligible:
             raise RuntimeError("No non-self providers available in pool")
-        ordered = mesh_cycle(providers, previous_provider_id=self.last_provider_id)
-        sample_size = min(max(self.mesh_sample_size, 1), len(ordered))
-        sampled = ordered[:sample_size]
-        return fastest_provider(sampled)
+        sample_size = min(max(self.mesh_sample_size, 1), len(eligible))
+        picked = self.scoreboard.weighted_sample(
+            providers,
+            sample_size,
+            previous_provider_id=self.last_provider_id,
+            indices=eligible,
+        )
+        return fastest_provider(
+            [providers[index] for index in picked],
+            max_workers=self.probe_workers,
+            deadline_seconds=self.probe_deadline_seconds,
+            good_enough_ms=self.probe_good_enough_ms,
+            samples=self.probe_samples,
+            on_result=self.record_probe,
+        )
+
+    def record_probe(self, provider: Provider, latency_ms: float) -> None:
+        self.scoreboard.record_rtt(provider.id, latency_ms)
+        if math.isfinite(latency_ms):
+            # Per-provider quantiles; past METRICS_MAX_SERIES providers they share one `other` series.
+            self.metrics.summarize("dvpn_provider_rtt_seconds", latency_ms / 1000, {"provider": provider.id})
 
     def loop(self) -> None:
+        self.runtime.run(self.serve)
+
+    def spawn_startup(self, name: str, awaitable) -> None:
+        # Steps started before the first tunnel is up are part of the startup trace.
+        if "first_tunnel" not in self.startup_trace.marks:
+            awaitable = self.startup_trace.step(name, awaitable)
+
+        async def run() -> None:
+            try:
+                await awaitable
+            except Exception as err:
+                self.log(f"startup step {name} failed: {err}")
+                raise
+
+        task = asyncio.ensure_future(run())
+        # Failures are logged above and re-raised only to callers that require the step.
+        task.add_done_callback(lambda done: done.cancelled() or done.exception())
+        self.startup_tasks[name] = task
+
+    async def await_startup(self, *names: str, required: bool = False) -> None:
+        tasks = [self.startup_tasks[name] for name in names if name in self.startup_tasks]
+        if not tasks:
+            return
+        # Shielded so a cancelled session never cancels a shared startup step.
+        results = await asyncio.shield(asyncio.gather(*tasks, return_exceptions=True))
+        for result in results:
+            if required and isinstance(result, BaseException):
+                raise result
+
+    def start_local_startup(self) -> None:
+        # Nothing here talks to the pool, so it all starts before the payment gate.
+        if self.startup_tasks:
+            return
+        self.spawn_startup("wg_key", self.runtime.blocking(self.prepare_wg_key))
+        if self.wg_enabled and self.telemetry_interval_seconds > 0:
+            self.background_tasks.append(asyncio.ensure_future(self.run_telemetry()))
+        if self.auto_network_enabled:
+            self.spawn_startup("network", self.runtime.blocking(self.detect_network))
+            # The mappers keep their leases renewed on their own threads; nothing waits for them.
+            for mapper in (self.port_mapper, self.probe_port_mapper):
+                if mapper is not None:
+                    mapper.start()
+        if self.bandwidth_measure_pending:
+            self.bandwidth_measure_pending = False
+            self.spawn_startup("bandwidth", self.runtime.blocking(self.measure_bandwidth))
+            if self.bandwidth_remeasure_seconds > 0:
+                self.background_tasks.append(asyncio.ensure_future(self.remeasure_bandwidth()))
+
+    def start_pool_startup(self) -> None:
+        # Pool-side startup work is off the tunnel's critical path; it runs once payment is confirmed.
+        if "prune" not in self.startup_tasks:
+            self.spawn_startup("prune", self.runtime.blocking(self.maybe_prune_pool_on_startup))
+        register = self.startup_tasks.get("register")
+        if self.node_register_enabled and not self.node_registered and (register is None or register.done()):
+            self.spawn_startup("register", self.register_after_detection())
+
+    async def register_after_detection(self) -> None:
+        await self.await_startup("wg_key", "network")
+        await self.runtime.blocking(self.maybe_register_node)
+
+    def record_first_tunnel(self) -> None:
+        if "first_tunnel" in self.startup_trace.marks:
+            return
+        elapsed = self.startup_trace.mark("first_tunnel")
+        self.metrics.set_gauge("dvpn_time_to_first_tunnel_seconds", elapsed)
+        self.log_connection(f"first tunnel after {elapsed:.2f}s; startup trace: {self.startup_trace.render()}")
+
+    async def serve(self) -> None:
+        self.start_local_startup()
         while self.running:
-            if not self.desired_connected:
-                time.sleep(1)
+            self.runtime.clear()
+            if not self.desired_connected or self.killswitch_enabled:
+                # Idle until a control action changes intent; nothing polls while stopped.
+                await self.runtime.wait()
                 continue
-            if self.killswitch_enabled:
-                time.sleep(1)
-                continue
-            try:
-                if not self.subscription_active():
-                    self.metrics.inc("dvpn_payment_failure_total")
-                    self.log_pool("payment inactive: pool access blocked")
-                    if self.last_provider_id:
-                        self.bandwidth.close_connection(self.last_provider_id)
-                        self.metrics.set_gauge("dvpn_active_connections", self.bandwidth.active_count)
-                        self.last_provider_id = None
-                    self.wg_down()
-                    self.stop_socks()
-                    self.restore_provider_forwarding()
-                    self.set_phase("payment_blocked")
-                    time.sleep(self.retry_seconds)
-                    continue
+            if not await self.runtime.run_interruptible(self.run_session()):
+                await self.runtime.exclusive(self.settle_after_interrupt)
 
-                self.maybe_register_node()
-                self.maybe_prune_pool_on_startup()
-                self.start_socks()
-                self.set_phase("control_plane")
-                source = "pool"
+    def settle_after_interrupt(self) -> None:
+        # Runs on the tunnel lane after any step the cancelled session left in flight, so a
+        # late `wg-quick up` cannot resurrect a tunnel that stop/killswitch already tore down.
+        if self.running and self.desired_connected and not self.killswitch_enabled:
+            return
+        self.current_provider = None
+        self.wg_down()
+        self.stop_socks()
+
+    async def provider_standby(self) -> None:
+        await self.runtime.exclusive(self.ensure_provider_forwarding)
+        # The server config embeds the node's private key, which is generated by the wg_key step.
+        await self.await_startup("wg_key", required=True)
+        await self.runtime.exclusive(self.ensure_provider_server_up)
+        await self.runtime.blocking(self.ensure_probe_responder)
+        self.log_pool("no non-self providers available; provider standby")
+        self.set_phase("provider_standby")
+        # Admit claims as they arrive until it is time to look for providers again. The long-poll
+        # runs on the I/O pool so it never holds the tunnel lane that stop/killswitch need.
+        deadline = time.monotonic() + self.provider_standby_seconds
+        while (remaining := deadline - time.monotonic()) > 0:
+            wait_seconds = min(self.claim_wait_seconds, remaining)
+            next_expiry = self.provider_peers.next_expiry()
+            if next_expiry is not None:
+                # Wake up in time to evict the next lease as it lapses (at most once a second, so
+                # a removal that keeps failing cannot spin this loop).
+                wait_seconds = min(wait_seconds, max(next_expiry - time.time(), 1.0))
+            started = time.monotonic()
+            fetched = await self.runtime.blocking(self.fetch_provider_claims, wait_seconds)
+            await self.runtime.exclusive(self.apply_pending_claims)
+            await self.runtime.exclusive(self.evict_provider_peers)
+            if not fetched:
+                # The pool may not support long-polling (or failed); do not spin on it.
+                await asyncio.sleep(max(wait_seconds - (time.monotonic() - started), 0))
+
+    async def supervise_tunnel(self, chosen: Provider) -> None:
+        rotate_at = self.next_rotation_deadline()
+        while self.running and self.desired_connected:
+            if self.socks_proc and self.socks_proc.poll() is not None:
+                raise RuntimeError("SOCKS server stopped unexpectedly")
+            if time.time() >= rotate_at:
+                if not (self.wg_enabled and self.rotation_mode == "make_before_break"):
+                    raise RotationRequested("endpoint rotation interval reached")
+                self.set_phase("rotating")
                 try:
-                    chosen = self.choose_pool_provider()
-                except Exception as pool_err:
-                    if "No non-self providers available in pool" in str(pool_err):
-                        self.ensure_provider_forwarding()
-                        self.ensure_provider_server_up()
-                        self.poll_provider_claim_once()
-                        self.log_pool("no non-self providers available; provider standby")
-                        self.set_phase("provider_standby")
-                        time.sleep(3)
-                        continue
-                    self.metrics.inc("dvpn_fallback_attempt_total")
-                    self.log_pool(f"pool connect failed: {pool_err}; trying fallback")
-                    chosen = self.fallback.provision(self.pay.token, self.user_id)
-                    source = "fallback"
-
-                if not self.pay.is_active(chosen.id):
-                    self.metrics.inc("dvpn_payment_failure_total")
-                    raise RuntimeError(f"Payment inactive for provider {chosen.id}")
-
-                if source == "pool":
-                    self.pool.mark_approved(chosen, self.pay.token)
-                self.token_store.save_token(self.pay.token)
-
-                self.last_provider_id = chosen.id
-                granted_mbps = self.bandwidth.open_connection(chosen.id)
+                    rotated = await self.rotate_make_before_break(chosen)
+                except Exception as err:
+                    self.metrics.inc("dvpn_rotation_fallback_total")
+                    raise RotationRequested(f"make-before-break rotation failed: {err}") from err
+                self.bandwidth.close_connection(chosen.id)
+                granted_mbps = self.bandwidth.open_connection(rotated.id)
                 self.metrics.set_gauge("dvpn_last_granted_mbps", granted_mbps)
                 self.metrics.set_gauge("dvpn_active_connections", self.bandwidth.active_count)
-                self.log_pool(f"using provider {chosen.id} ({source})")
-                self.log_connection(f"provider selected {chosen.id}; grant={granted_mbps:.2f}Mbps")
-                if self.wg_enabled:
-                    write_wg_config(chosen, self.wg_config_path)
-                    self.wg_down()
-                    self.wg_up()
-                    self.set_phase("tunnel_up")
-                    if not self.verify_handshake(chosen):
-                        raise RuntimeError(f"wireguard handshake not confirmed for {chosen.id}")
-                    self.set_phase("handshake_confirmed")
-                    self.set_phase("traffic_verified")
-                else:
-                    self.log_connection("wireguard skipped (ENABLE_WIREGUARD=false)")
-                    self.set_phase("control_plane_only")
-                self.metrics.inc("dvpn_connect_success_total")
+                chosen = rotated
+                self.current_provider = rotated
+                self.last_provider_id = rotated.id
+                self.set_phase("traffic_verified")
                 rotate_at = self.next_rotation_deadline()
-
-                while self.running and self.desired_connected:
-                    if self.socks_proc and self.socks_proc.poll() is not None:
-                        raise RuntimeError("SOCKS server stopped unexpectedly")
-                    if time.time() >= rotate_at:
-                        raise RotationRequested("endpoint rotation interval reached")
-                    time.sleep(10)
-            except RotationRequested as rotation:
-                self.log_connection(str(rotation))
-                self.set_phase("rotating")
-                if self.last_provider_id:
-                    self.bandwidth.close_connection(self.last_provider_id)
-                    self.metrics.set_gauge("dvpn_active_connections", self.bandwidth.active_count)
-                    self.last_provider_id = None
-                self.wg_down()
                 continue
-            except Exception as err:
-                self.metrics.inc("dvpn_connect_failure_total")
-                self.log_connection(f"reconnect loop: {err}")
-                self.set_phase("error")
-                if self.last_provider_id:
-                    self.bandwidth.close_connection(self.last_provider_id)
-                    self.metrics.set_gauge("dvpn_active_connections", self.bandwidth.active_count)
-                    self.last_provider_id = None
-                self.wg_down()
-                time.sleep(self.retry_seconds)
+            await asyncio.sleep(min(10, max(rotate_at - time.time(), 0)))
+
+    async def connect_provider(self) -> None:
+        if not await self.runtime.blocking(self.subscription_active):
+            self.metrics.inc("dvpn_payment_failure_total")
+            self.log_pool("payment inactive: pool access blocked")
+            if self.last_provider_id:
+                self.bandwidth.close_connection(self.last_provider_id)
+                self.metrics.set_gauge("dvpn_active_connections", self.bandwidth.active_count)
+                self.last_provider_id = None
+            await self.runtime.exclusive(self.wg_down)
+            await self.runtime.exclusive(self.stop_socks)
+            await self.runtime.exclusive(self.restore_provider_forwarding)
+            self.set_phase("payment_blocked")
+            await asyncio.sleep(self.retry_seconds)
+            return
+
+        self.start_pool_startup()
+        self.set_phase("control_plane")
+        source = "pool"
+        try:
+            # The provider fetch overlaps address detection (needed to reject our own endpoints)
+            # and the socks proxy start; registration, UPnP and the bandwidth test stay off this path.
+            providers, _, _ = await asyncio.gather(
+                self.runtime.blocking(self.fetch_providers),
+                self.await_startup("network"),
+                self.runtime.exclusive(self.start_socks),
+            )
+            chosen = await self.runtime.blocking(self.choose_pool_provider, providers)
+        except Exception as pool_err:
+            if "No non-self providers available in pool" in str(pool_err):
+                await self.provider_standby()
+                return
+            self.metrics.inc("dvpn_fallback_attempt_total")
+            self.log_pool(f"pool connect failed: {pool_err}; trying fallback")
+            await self.await_startup("wg_key")
+            chosen = await self.runtime.blocking(self.fallback.provision, self.pay.token, self.user_id)
+            source = "fallback"
+
+        if not await self.runtime.blocking(self.payment_active, chosen.id):
+            self.metrics.inc("dvpn_payment_failure_total")
+            raise RuntimeError(f"Payment inactive for provider {chosen.id}")
+
+        if source == "pool":
+            await self.runtime.blocking(self.pool.mark_approved, chosen, self.pay.token)
+        self.token_store.save_token(self.pay.token)
+
+        self.last_provider_id = chosen.id
+        granted_mbps = self.bandwidth.open_connection(chosen.id)
+        self.metrics.set_gauge("dvpn_last_granted_mbps", granted_mbps)
+        self.metrics.set_gauge("dvpn_active_connections", self.bandwidth.active_count)
+        self.log_pool(f"using provider {chosen.id} ({source})")
+        self.log_connection(f"provider selected {chosen.id}; grant={granted_mbps:.2f}Mbps")
+        if self.wg_enabled:
+            await self.await_startup("wg_key", required=True)
+            baseline = await self.runtime.blocking(self.handshake_baseline, chosen)
+            reconfigured = await self.runtime.exclusive(self.connect_tunnel, chosen)
+            self.set_phase("tunnel_up")
+            handshake_started = time.monotonic()
+            if not await self.runtime.blocking(self.verify_handshake, chosen, baseline, reconfigured):
+                self.record_provider_outcome(chosen.id, success=False)
+                raise RuntimeError(f"wireguard handshake not confirmed for {chosen.id}")
+            self.record_provider_outcome(chosen.id, success=True, seconds=time.monotonic() - handshake_started)
+            self.set_phase("handshake_confirmed")
+            self.set_phase("traffic_verified")
+        else:
+            self.log_connection("wireguard skipped (ENABLE_WIREGUARD=false)")
+            self.set_phase("control_plane_only")
+        self.current_provider = chosen
+        if self.rotation_started_at is not None:
+            gap = time.monotonic() - self.rotation_started_at
+            self.metrics.set_gauge("dvpn_rotation_gap_seconds", gap)
+            self.metrics.observe("dvpn_rotation_switch_seconds", gap)
+            self.metrics.inc("dvpn_rotation_total")
+            self.rotation_started_at = None
+        self.metrics.inc("dvpn_connect_success_total")
+        self.record_first_tunnel()
+        await self.supervise_tunnel(chosen)
+
+    async def run_session(self) -> None:
+        try:
+            await self.connect_provider()
+        except RotationRequested as rotation:
+            self.log_connection(str(rotation))
+            self.set_phase("rotating")
+            self.rotation_started_at = time.monotonic()
+            self.current_provider = None
+            if self.last_provider_id:
+                self.bandwidth.close_connection(self.last_provider_id)
+                self.metrics.set_gauge("dvpn_active_connections", self.bandwidth.active_count)
+                self.last_provider_id = None
+            if not self.wg_incremental:
+                # Incremental mode keeps wg0 (and the outgoing peer) up until the next peer replaces it.
+                await self.runtime.exclusive(self.wg_down)
+        except Exception as err:
+            self.metrics.inc("dvpn_connect_failure_total")
+            self.log_connection(f"reconnect loop: {err}")
+            self.set_phase("error")
+            self.current_provider = None
+            if self.last_provider_id:
+                self.bandwidth.close_connection(self.last_provider_id)
+                self.metrics.set_gauge("dvpn_active_connections", self.bandwidth.active_count)
+                self.last_provider_id = None
+            await self.runtime.exclusive(self.wg_down)
+            await asyncio.sleep(self.retry_seconds)
 
 
 def main() -> None:
-    ensure_wg_private_key()
     service = DVPNService()
     control_host = env("CONTROL_HOST", "127.0.0.1")
     control_port = int(env("CONTROL_PORT", "8765"))
@@ -669,6 +1337,7 @@ def main() -> None:
     finally:
         control.stop()
         service.stop()
+        service.log_pipeline.close()
 
 
 if __name__ == "__main__":
@@ -1,38 +1,352 @@
+import functools
+import itertools
 import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from dataclasses import dataclass, field
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0)
+# Make-before-break gaps are milliseconds; break-before-make gaps reach a handshake timeout.
+GAP_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 20.0)
+SUMMARY_QUANTILES = (0.5, 0.9, 0.99)
+OVERFLOW_LABEL = "other"
+
+LabelSet = tuple[tuple[str, str], ...]
+
+
+def _label_set(labels: dict[str, str] | None) -> LabelSet:
+    if not labels:
+        return ()
+    if len(labels) == 1:
+        # The common per-peer / per-host case skips the generator and sort.
+        ((key, value),) = labels.items()
+        return ((key, value if type(value) is str else str(value)),)
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _render_labels(labels: LabelSet) -> str:
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+
+def _quantile(ordered: list[float], q: float) -> float:
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+@dataclass(slots=True)
+class Histogram:
+    bounds: tuple[float, ...]
+    # Per-bucket (not cumulative) counts; the last slot is the +Inf overflow.
+    counts: list[int]
+    total: float = 0.0
+    count: int = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+@dataclass(slots=True)
+class Summary:
+    # Quantiles over each writer's most recent observations; sum and count cover every observation.
+    window: deque
+    total: float = 0.0
+    count: int = 0
+
+    def observe(self, value: float) -> None:
+        self.window.append(value)
+        self.total += value
+        self.count += 1
+
+
+@dataclass(slots=True)
+class Shard:
+    # One writer thread's values. Only the owning thread writes them, so recording takes no lock;
+    # scrapes read them through C-level copies, which the GIL makes atomic.
+    owner: threading.Thread | None = None
+    version: int = 0
+    counters: dict[str, dict[LabelSet, float]] = field(default_factory=dict)
+    # Gauges carry a global sequence number so the latest write wins across shards.
+    gauges: dict[str, dict[LabelSet, tuple[int, float]]] = field(default_factory=dict)
+    histograms: dict[str, dict[LabelSet, Histogram]] = field(default_factory=dict)
+    summaries: dict[str, dict[LabelSet, Summary]] = field(default_factory=dict)
+
+
+def _merge(target: Shard, source: Shard, window: int | None) -> None:
+    # Adds source's values into target; source may still be written by its owner, so it is only read
+    # through C-level copies.
+    for name, series in source.counters.copy().items():
+        merged = target.counters.setdefault(name, {})
+        for key, value in series.copy().items():
+            merged[key] = merged.get(key, 0) + value
+    for name, series in source.gauges.copy().items():
+        merged = target.gauges.setdefault(name, {})
+        for key, stamped in series.copy().items():
+            if key not in merged or stamped[0] > merged[key][0]:
+                merged[key] = stamped
+    for name, series in source.histograms.copy().items():
+        merged = target.histograms.setdefault(name, {})
+        for key, histogram in series.copy().items():
+            counts = list(histogram.counts)
+            total = merged.get(key)
+            if total is None:
+                total = merged[key] = Histogram(histogram.bounds, [0] * len(counts))
+            total.counts = [a + b for a, b in zip(total.counts, counts)]
+            total.total += histogram.total
+            # Counted from the buckets so +Inf always equals the last cumulative bucket.
+            total.count += sum(counts)
+    for name, series in source.summaries.copy().items():
+        merged = target.summaries.setdefault(name, {})
+        for key, summary in series.copy().items():
+            total = merged.get(key)
+            if total is None:
+                total = merged[key] = Summary(deque(maxlen=window))
+            total.window.extend(list(summary.window))
+            total.total += summary.total
+            total.count += summary.count
+
+
+class Timer:
+    # Context manager and decorator observing elapsed seconds into a histogram (or summary).
+    def __init__(self, metrics: "Metrics", name: str, labels: dict[str, str] | None = None, summary: bool = False) -> None:
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.summary = summary
+        self.started = 0.0
+        self.elapsed = 0.0
+
+    def __enter__(self) -> "Timer":
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.elapsed = time.perf_counter() - self.started
+        if self.summary:
+            self.metrics.summarize(self.name, self.elapsed, self.labels)
+        else:
+            self.metrics.observe(self.name, self.elapsed, self.labels)
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            # A fresh timer per call keeps concurrent calls from sharing a start time.
+            with Timer(self.metrics, self.name, self.labels, self.summary):
+                return func(*args, **kwargs)
+
+        return timed
 
 
 class Metrics:
-    def __init__(self) -> None:
-        self._lock = threading.Lock()
-        self._counters: dict[str, int] = {
-            "dvpn_connect_success_total": 0,
-            "dvpn_connect_failure_total": 0,
-            "dvpn_fallback_attempt_total": 0,
-            "dvpn_payment_failure_total": 0,
-            "dvpn_node_register_success_total": 0,
-            "dvpn_node_register_failure_total": 0,
-        }
-        self._gauges: dict[str, float] = {
-            "dvpn_active_connections": 0,
-            "dvpn_bandwidth_total_mbps": 0,
-            "dvpn_last_granted_mbps": 0,
+    def __init__(self, max_series: int = 256, summary_window: int = 256) -> None:
+        # Label values beyond this many series per family fold into one `other` series.
+        self.max_series = max(max_series, 1)
+        self.summary_window = max(summary_window, 1)
+        self._buckets: dict[str, tuple[float, ...]] = {
+            "dvpn_handshake_seconds": DEFAULT_BUCKETS,
+            "dvpn_http_request_seconds": DEFAULT_BUCKETS,
+            "dvpn_call_seconds": DEFAULT_BUCKETS,
+            "dvpn_rotation_switch_seconds": GAP_BUCKETS,
         }
+        # Recording goes to a per-thread shard and is only aggregated when /metrics is scraped.
+        self._local = threading.local()
+        self._registry_lock = threading.Lock()
+        self._shards: list[Shard] = []
+        self._series_keys: dict[str, set[LabelSet]] = {}
+        self._gauge_seq = itertools.count(1)
+        self._removals = 0
+        self._render_lock = threading.Lock()
+        self._rendered: tuple[tuple[int, ...], str] | None = None
+        # Defaults, plus everything recorded by threads that have since exited (folded in at scrape time).
+        base = self._retired = Shard()
+        self._shards.append(base)
+        for name in (
+            "dvpn_connect_success_total",
+            "dvpn_connect_failure_total",
+            "dvpn_fallback_attempt_total",
+            "dvpn_payment_failure_total",
+            "dvpn_payment_cache_hit_total",
+            "dvpn_payment_cache_miss_total",
+            "dvpn_payment_cache_stale_total",
+            "dvpn_node_register_success_total",
+            "dvpn_node_register_failure_total",
+            "dvpn_rotation_total",
+            "dvpn_rotation_fallback_total",
+            "dvpn_provider_claims_applied_total",
+            "dvpn_provider_claims_rejected_total",
+            "dvpn_provider_peers_expired_total",
+            "dvpn_provider_peers_idle_evicted_total",
+            "dvpn_shaping_failure_total",
+            "dvpn_metric_series_overflow_total",
+            "dvpn_log_dropped_total",
+        ):
+            base.counters[name] = {(): 0}
+        for name in (
+            "dvpn_active_connections",
+            "dvpn_bandwidth_total_mbps",
+            "dvpn_last_granted_mbps",
+            "dvpn_rotation_gap_seconds",
+            "dvpn_time_to_first_tunnel_seconds",
+            "dvpn_provider_peers",
+            "dvpn_provider_claim_nonces",
+            "dvpn_tunnel_rx_mbps",
+            "dvpn_tunnel_tx_mbps",
+        ):
+            base.gauges[name] = {(): (0, 0)}
+        base.histograms["dvpn_handshake_seconds"] = {(): self._new_histogram("dvpn_handshake_seconds")}
+
+    def _shard(self) -> Shard:
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = Shard(owner=threading.current_thread())
+            with self._registry_lock:
+                self._shards.append(shard)
+            return shard
+
+    def _new_histogram(self, name: str) -> Histogram:
+        bounds = self._buckets.setdefault(name, DEFAULT_BUCKETS)
+        return Histogram(bounds, [0] * (len(bounds) + 1))
+
+    def _series(self, shard: Shard, name: str, labels: dict[str, str] | None) -> LabelSet:
+        key = _label_set(labels)
+        if not key:
+            return key
+        known = self._series_keys.get(name)
+        if known is not None and key in known:
+            return key
+        with self._registry_lock:
+            known = self._series_keys.setdefault(name, set())
+            if key in known or len(known) < self.max_series:
+                known.add(key)
+                return key
+        overflow = shard.counters.setdefault("dvpn_metric_series_overflow_total", {})
+        overflow[()] = overflow.get((), 0) + 1
+        return tuple((label, OVERFLOW_LABEL) for label, _ in key)
+
+    def register_histogram(self, name: str, buckets: tuple[float, ...]) -> None:
+        self._buckets[name] = tuple(sorted(buckets))
+
+    def timer(self, name: str, labels: dict[str, str] | None = None, summary: bool = False) -> Timer:
+        return Timer(self, name, labels, summary)
+
+    def inc(self, name: str, value: int = 1, labels: dict[str, str] | None = None) -> None:
+        shard = self._shard()
+        series = shard.counters.get(name)
+        if series is None:
+            series = shard.counters[name] = {}
+        key = self._series(shard, name, labels)
+        series[key] = series.get(key, 0) + value
+        shard.version += 1
+
+    def set_gauge(self, name: str, value: float, labels: dict[str, str] | None = None) -> None:
+        shard = self._shard()
+        key = self._series(shard, name, labels)
+        shard.gauges.setdefault(name, {})[key] = (next(self._gauge_seq), value)
+        shard.version += 1
+
+    def observe(self, name: str, value: float, labels: dict[str, str] | None = None) -> None:
+        shard = self._shard()
+        series = shard.histograms.setdefault(name, {})
+        key = self._series(shard, name, labels)
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = self._new_histogram(name)
+        histogram.observe(value)
+        shard.version += 1
+
+    def summarize(self, name: str, value: float, labels: dict[str, str] | None = None) -> None:
+        shard = self._shard()
+        series = shard.summaries.setdefault(name, {})
+        key = self._series(shard, name, labels)
+        summary = series.get(key)
+        if summary is None:
+            summary = series[key] = Summary(deque(maxlen=self.summary_window))
+        summary.observe(value)
+        shard.version += 1
 
-    def inc(self, name: str, value: int = 1) -> None:
-        with self._lock:
-            self._counters[name] = self._counters.get(name, 0) + value
+    def remove_series(self, labels: dict[str, str]) -> None:
+        # Drops every labeled series carrying exactly these labels.
+        key = _label_set(labels)
+        with self._registry_lock:
+            for known in self._series_keys.values():
+                known.discard(key)
+            shards = list(self._shards)
+            # Bumped here rather than in the shards: only their owners may write shard versions.
+            self._removals += 1
+        # The render lock keeps this from racing a scrape folding dead shards into the retired one.
+        with self._render_lock:
+            for shard in shards:
+                for families in (shard.counters, shard.gauges, shard.histograms, shard.summaries):
+                    for series in families.copy().values():
+                        series.pop(key, None)
 
-    def set_gauge(self, name: str, value: float) -> None:
-        with self._lock:
-            self._gauges[name] = value
+    def _reclaim(self) -> None:
+        # Short-lived threads (e.g. one per payment refresh) would otherwise leave a shard behind each.
+        # Their writers are gone, so folding them into the retired shard cannot race a write.
+        with self._registry_lock:
+            dead = [shard for shard in self._shards if shard.owner is not None and not shard.owner.is_alive()]
+            if not dead:
+                return
+            self._shards = [shard for shard in self._shards if shard not in dead]
+        for shard in dead:
+            _merge(self._retired, shard, self.summary_window)
+        self._retired.version += 1
 
     def render_prometheus(self) -> str:
-        with self._lock:
+        with self._render_lock:
+            self._reclaim()
+            with self._registry_lock:
+                shards = list(self._shards)
+            # Nothing recorded since the last scrape: serve the cached text.
+            cached = self._rendered
+            if cached is not None and cached[0] == tuple(shard.version for shard in shards) + (self._removals,):
+                return cached[1]
+            # Versions are read before the values, so a write racing the copy shows up as a change next scrape.
+            versions = tuple(shard.version for shard in shards) + (self._removals,)
+            merged = Shard()
+            for shard in shards:
+                _merge(merged, shard, None)
             lines: list[str] = []
-            for name, value in sorted(self._counters.items()):
-                lines.append(f"# TYPE {name} counter")
-                lines.append(f"{name} {value}")
-            for name, value in sorted(self._gauges.items()):
-                lines.append(f"# TYPE {name} gauge")
-                lines.append(f"{name} {value}")
-            return "\n".join(lines) + "\n"
+            for kind, families in (
+                ("counter", merged.counters),
+                ("gauge", {name: {key: value for key, (_, value) in series.items()} for name, series in merged.gauges.items()}),
+            ):
+                for name, series in sorted(families.items()):
+                    if not series:
+                        continue
+                    lines.append(f"# TYPE {name} {kind}")
+                    for labels, value in sorted(series.items()):
+                        lines.append(f"{name}{_render_labels(labels) if labels else ''} {value}")
+            for name, series in sorted(merged.histograms.items()):
+                if not series:
+                    continue
+                lines.append(f"# TYPE {name} histogram")
+                for labels, histogram in sorted(series.items()):
+                    cumulative = 0
+                    for bound, count in zip(histogram.bounds, histogram.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{_render_labels(labels + (('le', str(bound)),))} {cumulative}")
+                    lines.append(f"{name}_bucket{_render_labels(labels + (('le', '+Inf'),))} {histogram.count}")
+                    suffix = _render_labels(labels) if labels else ""
+                    lines.append(f"{name}_sum{suffix} {histogram.total}")
+                    lines.append(f"{name}_count{suffix} {histogram.count}")
+            for name, series in sorted(merged.summaries.items()):
+                if not series:
+                    continue
+                lines.append(f"# TYPE {name} summary")
+                for labels, summary in sorted(series.items()):
+                    ordered = sorted(summary.window)
+                    for q in SUMMARY_QUANTILES:
+                        lines.append(f"{name}{_render_labels(labels + (('quantile', str(q)),))} {_quantile(ordered, q)}")
+                    suffix = _render_labels(labels) if labels else ""
+                    lines.append(f"{name}_sum{suffix} {summary.total}")
+                    lines.append(f"{name}_count{suffix} {summary.count}")
+            text = "\n".join(lines) + "\n"
+            self._rendered = (versions, text)
+            return text
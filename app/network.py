@@ -1,19 +1,13 @@
 import json
-import shutil
 import socket
 import ssl
 import subprocess
+import threading
+import time
 import urllib.request
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from ipaddress import ip_address, ip_network
-
-
-@dataclass
-class NetworkInfo:
-    local_ip: str | None
-    public_ip: str | None
-    upnp_mapped: bool
-    cgnat_suspected: bool
+from typing import Callable
 
 
 def detect_local_ip() -> str | None:
@@ -25,65 +19,100 @@ def detect_local_ip() -> str | None:
         return None
 
 
-def detect_public_ip(timeout: int = 5) -> str | None:
-    context = ssl.create_default_context()
-    context.minimum_version = ssl.TLSVersion.TLSv1_2
-    # Prefer Cloudflare trace on our control-plane domain so strict firewall allowlists
-    # still permit public IP detection during startup.
-    urls = [
-        "https://api.dvpn.lol/cdn-cgi/trace",
-        "https://api.ipify.org?format=json",
-        "https://ifconfig.co/json",
-    ]
-    for url in urls:
-        try:
-            with urllib.request.urlopen(url, timeout=timeout, context=context) as response:
-                body = response.read().decode("utf-8", errors="replace")
-            if "cdn-cgi/trace" in url:
-                for line in body.splitlines():
-                    if line.startswith("ip="):
-                        ip = line.split("=", 1)[1].strip()
-                        if ip:
-                            return ip
-                continue
-            payload = json.loads(body)
-            ip = payload.get("ip")
-            if isinstance(ip, str) and ip:
-                return ip
-        except Exception:
-            continue
-    return None
+# Prefer Cloudflare trace on our control-plane domain so strict firewall allowlists
+# still permit public IP detection during startup.
+PUBLIC_IP_SOURCES = (
+    "https://api.dvpn.lol/cdn-cgi/trace",
+    "https://api.ipify.org?format=json",
+    "https://ifconfig.co/json",
+)
 
 
-def map_upnp(port: int, protocol: str = "UDP", local_ip: str | None = None) -> bool:
-    if port < 1 or port > 65535:
-        return False
-    upnpc = shutil.which("upnpc")
-    if not upnpc:
-        return False
-    if not local_ip:
-        local_ip = detect_local_ip()
-    if not local_ip:
-        return False
+def parse_public_ip(body: str) -> str | None:
+    # Sources answer either as JSON ({"ip": ...}) or as Cloudflare trace lines (ip=...).
+    candidate = None
     try:
-        subprocess.run(
-            [upnpc, "-e", "DVPN", "-a", local_ip, str(port), str(port), protocol.upper()],
-            check=True,
-            capture_output=True,
-            text=True,
-            timeout=8,
-        )
-        return True
+        payload = json.loads(body)
+        if isinstance(payload, dict):
+            candidate = payload.get("ip")
+    except ValueError:
+        for line in body.splitlines():
+            if line.startswith("ip="):
+                candidate = line.split("=", 1)[1].strip()
+                break
+    if not isinstance(candidate, str) or not candidate:
+        return None
+    try:
+        return str(ip_address(candidate))
+    except ValueError:
+        return None
+
+
+def _fetch_public_ip(url: str, timeout: float, context: ssl.SSLContext) -> str | None:
+    try:
+        with urllib.request.urlopen(url, timeout=timeout, context=context) as response:
+            return parse_public_ip(response.read(4096).decode("utf-8", errors="replace"))
     except Exception:
-        return False
+        return None
 
 
-def map_upnp_retry(port: int, protocol: str = "UDP", attempts: int = 3, local_ip: str | None = None) -> bool:
-    attempts = max(1, attempts)
-    for _ in range(attempts):
-        if map_upnp(port, protocol, local_ip=local_ip):
-            return True
-    return False
+def race_public_ip(urls: tuple[str, ...] | list[str] = PUBLIC_IP_SOURCES, timeout: float = 5) -> str | None:
+    if not urls:
+        return None
+    context = ssl.create_default_context()
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    # All sources are asked at once and the first valid answer wins, so one blackholed
+    # source costs nothing as long as another answers.
+    executor = ThreadPoolExecutor(max_workers=len(urls), thread_name_prefix="public-ip")
+    futures = [executor.submit(_fetch_public_ip, url, timeout, context) for url in urls]
+    try:
+        for future in as_completed(futures, timeout=timeout):
+            ip = future.result()
+            if ip:
+                return ip
+    except TimeoutError:
+        pass
+    finally:
+        # Slower lookups are abandoned; their sockets close on their own timeout.
+        executor.shutdown(wait=False, cancel_futures=True)
+    return None
+
+
+class PublicIPDetector:
+    def __init__(
+        self,
+        urls: tuple[str, ...] | list[str] = PUBLIC_IP_SOURCES,
+        timeout: float = 5,
+        ttl_seconds: float = 300,
+        local_ip_fn: Callable[[], str | None] = detect_local_ip,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.urls = tuple(urls)
+        self.timeout = timeout
+        self.ttl_seconds = ttl_seconds
+        self.local_ip_fn = local_ip_fn
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._cached: tuple[str, str | None, float] | None = None
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._cached = None
+
+    def detect(self, local_ip: str | None = None) -> str | None:
+        if local_ip is None:
+            local_ip = self.local_ip_fn()
+        # The lock makes concurrent callers share one race instead of starting their own.
+        with self._lock:
+            if self._cached is not None:
+                public_ip, cached_local_ip, expires_at = self._cached
+                # A new local address usually means a new network, so the old answer is not trusted.
+                if cached_local_ip == local_ip and self.clock() < expires_at:
+                    return public_ip
+            public_ip = race_public_ip(self.urls, timeout=self.timeout)
+            # Failures are not cached so the next caller retries straight away.
+            self._cached = (public_ip, local_ip, self.clock() + self.ttl_seconds) if public_ip else None
+            return public_ip
 
 
 def is_cgnat_suspected(public_ip: str | None) -> bool:
@@ -111,15 +140,3 @@ def derive_wg_public_key(private_key: str) -> str | None:
         return key if key else None
     except Exception:
         return None
-
-
-def auto_network_config(enable_upnp: bool, upnp_port: int) -> NetworkInfo:
-    local_ip = detect_local_ip()
-    public_ip = detect_public_ip()
-    upnp_mapped = map_upnp_retry(upnp_port, local_ip=local_ip) if enable_upnp else False
-    return NetworkInfo(
-        local_ip=local_ip,
-        public_ip=public_ip,
-        upnp_mapped=upnp_mapped,
-        cgnat_suspected=is_cgnat_suspected(public_ip),
-    )
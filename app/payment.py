@@ -1,6 +1,9 @@
 import json
-import ssl
-import urllib.request
+import threading
+import time
+from typing import Callable
+
+from app.http_session import HTTPSession
 
 REQUIRED_BTC_WALLET = "1MUss4jmaRJ2sMtS9gyZqeRw8WrhWTsrxn"
 REQUIRED_MONTHLY_PRICE_USD = 9.99
@@ -8,22 +11,21 @@ REQUIRED_PLAN_INTERVAL = "monthly"
 
 
 class PaymentVerifier:
-    def __init__(self, verify_url: str, token: str, timeout: int = 5) -> None:
+    def __init__(self, verify_url: str, token: str, timeout: int = 5, session: HTTPSession | None = None) -> None:
         self.verify_url = verify_url
         self.token = token
         self.timeout = timeout
-        self.ssl_context = ssl.create_default_context()
-        self.ssl_context.minimum_version = ssl.TLSVersion.TLSv1_2
+        self.session = session or HTTPSession(timeout=timeout)
 
     def _request(self, url: str, payload: dict) -> dict:
-        req = urllib.request.Request(
+        response = self.session.request(
+            "POST",
             url,
-            data=json.dumps(payload).encode("utf-8"),
-            headers={"Content-Type": "application/json", "User-Agent": "DVPN/1.0"},
-            method="POST",
+            body=json.dumps(payload).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+            timeout=self.timeout,
         )
-        with urllib.request.urlopen(req, timeout=self.timeout, context=self.ssl_context) as response:
-            return json.loads(response.read().decode("utf-8"))
+        return response.json()
 
     def _checkout_url(self, suffix: str) -> str:
         base = self.verify_url.rstrip("/")
@@ -51,11 +53,11 @@ class PaymentVerifier:
             },
         )
 
-    def _fetch_payment_status(self, provider_id: str) -> dict:
+    def _fetch_payment_status(self, provider_id: str, token: str) -> dict:
         return self._request(
             self.verify_url,
             {
-                "token": self.token,
+                "token": token,
                 "provider_id": provider_id,
                 "required_wallet": REQUIRED_BTC_WALLET,
                 "required_price_usd": REQUIRED_MONTHLY_PRICE_USD,
@@ -63,8 +65,8 @@ class PaymentVerifier:
             },
         )
 
-    def is_active(self, provider_id: str) -> bool:
-        body = self._fetch_payment_status(provider_id)
+    def is_active(self, provider_id: str, token: str | None = None) -> bool:
+        body = self._fetch_payment_status(provider_id, self.token if token is None else token)
 
         active = bool(body.get("active", False))
         wallet = body.get("wallet")
@@ -81,3 +83,91 @@ class PaymentVerifier:
             and interval == REQUIRED_PLAN_INTERVAL
             and amount_usd >= REQUIRED_MONTHLY_PRICE_USD
         )
+
+
+class CachedPaymentVerifier:
+    def __init__(
+        self,
+        verifier: PaymentVerifier,
+        ttl_seconds: float = 300,
+        grace_seconds: float = 120,
+        refresh_ahead_seconds: float = 60,
+        on_event: Callable[[str], None] | None = None,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.verifier = verifier
+        self.ttl_seconds = max(ttl_seconds, 0.0)
+        self.grace_seconds = max(grace_seconds, 0.0)
+        self.refresh_ahead_seconds = min(max(refresh_ahead_seconds, 0.0), self.ttl_seconds)
+        self.on_event = on_event
+        self.clock = clock
+        self._lock = threading.Lock()
+        # Only positive verifications are cached: a lapsed subscription must never be served
+        # from cache, and a freshly paid one should not wait out a negative TTL.
+        self._verified_at: dict[tuple[str, str], float] = {}
+        self._refreshing: set[tuple[str, str]] = set()
+        self._token = verifier.token
+
+    def _emit(self, event: str) -> None:
+        if self.on_event is not None:
+            self.on_event(event)
+
+    def _fetch(self, key: tuple[str, str]) -> bool:
+        # Verify the token the entry is keyed by; a background refresh may outlive a token change.
+        active = self.verifier.is_active(key[1], key[0])
+        with self._lock:
+            now = self.clock()
+            self._prune(now)
+            if active and key[0] == self._token:
+                self._verified_at[key] = now
+            else:
+                self._verified_at.pop(key, None)
+        return active
+
+    def _prune(self, now: float) -> None:
+        horizon = self.ttl_seconds + self.grace_seconds
+        for key in [key for key, verified_at in self._verified_at.items() if now - verified_at >= horizon]:
+            del self._verified_at[key]
+
+    def _refresh(self, key: tuple[str, str]) -> None:
+        try:
+            self._fetch(key)
+        except Exception:
+            # Keep serving the cached result until it falls out of the grace window.
+            pass
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def _schedule_refresh(self, key: tuple[str, str]) -> None:
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+        threading.Thread(target=self._refresh, args=(key,), daemon=True).start()
+
+    def is_active(self, provider_id: str) -> bool:
+        token = self.verifier.token
+        if token != self._token:
+            self._token = token
+            self.invalidate()
+        key = (token, provider_id)
+        with self._lock:
+            verified_at = self._verified_at.get(key)
+        if verified_at is not None:
+            age = self.clock() - verified_at
+            if age < self.ttl_seconds:
+                self._emit("hit")
+                if age >= self.ttl_seconds - self.refresh_ahead_seconds:
+                    self._schedule_refresh(key)
+                return True
+            if age < self.ttl_seconds + self.grace_seconds:
+                self._emit("stale")
+                self._schedule_refresh(key)
+                return True
+        self._emit("miss")
+        return self._fetch(key)
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._verified_at.clear()
@@ -0,0 +1,146 @@
+import heapq
+import time
+from dataclasses import dataclass
+from ipaddress import ip_interface
+from typing import Callable
+
+from app.pool import validate_public_key
+
+
+@dataclass(slots=True)
+class PeerLease:
+    public_key: str
+    client_ip: str
+    nonce: str
+    expires_at: float
+    admitted_at: float
+
+
+class NonceWindow:
+    def __init__(self, max_size: int = 65536, clock: Callable[[], float] = time.time) -> None:
+        self.max_size = max(1, max_size)
+        self.clock = clock
+        self._expiry: dict[str, float] = {}
+        self._heap: list[tuple[float, str]] = []
+
+    def __len__(self) -> int:
+        return len(self._expiry)
+
+    def __contains__(self, nonce: str) -> bool:
+        expires_at = self._expiry.get(nonce)
+        return expires_at is not None and expires_at > self.clock()
+
+    def add(self, nonce: str, expires_at: float) -> None:
+        # A nonce only needs remembering until its lease expires: after that the claim is
+        # rejected as expired anyway, so the window never has to grow past the live leases.
+        self._expiry[nonce] = expires_at
+        heapq.heappush(self._heap, (expires_at, nonce))
+        self.purge()
+        while len(self._expiry) > self.max_size:
+            # Over capacity: drop the nonces closest to expiry first.
+            self._pop()
+
+    def purge(self) -> int:
+        now = self.clock()
+        removed = 0
+        while self._heap and self._heap[0][0] <= now:
+            removed += self._pop()
+        return removed
+
+    def _pop(self) -> int:
+        expires_at, nonce = heapq.heappop(self._heap)
+        # Heap entries for re-added nonces are stale; only the current expiry counts.
+        if self._expiry.get(nonce) == expires_at:
+            del self._expiry[nonce]
+            return 1
+        return 0
+
+
+class PeerLifecycle:
+    def __init__(
+        self,
+        idle_seconds: float = 900,
+        max_nonces: int = 65536,
+        clock: Callable[[], float] = time.time,
+    ) -> None:
+        self.idle_seconds = idle_seconds
+        self.clock = clock
+        self.leases: dict[str, PeerLease] = {}
+        self.nonces = NonceWindow(max_nonces, clock=clock)
+        self._heap: list[tuple[float, str]] = []
+
+    def __len__(self) -> int:
+        return len(self.leases)
+
+    def admissible(self, claims: list[dict]) -> list[PeerLease]:
+        now = self.clock()
+        leases: dict[str, PeerLease] = {}
+        nonces: set[str] = set()
+        for claim in claims:
+            nonce = str(claim.get("lease_nonce", "")).strip()
+            client_ip = str(claim.get("client_ip", "")).strip()
+            public_key = str(claim.get("client_public_key", "")).strip()
+            if not nonce or not client_ip or not public_key or nonce in nonces or nonce in self.nonces:
+                continue
+            # A malformed key or address would make `wg set` reject the whole batch.
+            if not validate_public_key(public_key):
+                continue
+            try:
+                ip_interface(client_ip)
+            except ValueError:
+                continue
+            try:
+                # Leases carry their expiry in milliseconds since the epoch.
+                expires_at = float(claim.get("lease_exp") or 0) / 1000
+            except (TypeError, ValueError):
+                continue
+            if expires_at <= now:
+                continue
+            nonces.add(nonce)
+            leases[public_key] = PeerLease(public_key, client_ip, nonce, expires_at, now)
+        return list(leases.values())
+
+    def track(self, leases: list[PeerLease]) -> None:
+        for lease in leases:
+            previous = self.leases.get(lease.public_key)
+            if previous is not None and previous.client_ip == lease.client_ip:
+                # A renewed lease keeps the peer's idle clock running from its first admission.
+                lease.admitted_at = previous.admitted_at
+            self.leases[lease.public_key] = lease
+            self.nonces.add(lease.nonce, lease.expires_at)
+            heapq.heappush(self._heap, (lease.expires_at, lease.public_key))
+
+    def next_expiry(self) -> float | None:
+        while self._heap:
+            expires_at, public_key = self._heap[0]
+            lease = self.leases.get(public_key)
+            if lease is not None and lease.expires_at == expires_at:
+                return expires_at
+            heapq.heappop(self._heap)
+        return None
+
+    def expired(self) -> list[str]:
+        now = self.clock()
+        due: list[tuple[float, str]] = []
+        while (expires_at := self.next_expiry()) is not None and expires_at <= now:
+            due.append(heapq.heappop(self._heap))
+        # Entries stay queued until forget(), so a failed removal is retried on the next sweep.
+        for entry in due:
+            heapq.heappush(self._heap, entry)
+        return list(dict.fromkeys(public_key for _, public_key in due))
+
+    def idle(self, handshakes: dict[str, int]) -> list[str]:
+        if self.idle_seconds <= 0:
+            return []
+        cutoff = self.clock() - self.idle_seconds
+        # A peer gets idle_seconds after admission to complete its first handshake.
+        return [
+            public_key
+            for public_key, lease in self.leases.items()
+            if lease.admitted_at <= cutoff and handshakes.get(public_key, 0) <= cutoff
+        ]
+
+    def forget(self, public_keys: list[str]) -> None:
+        for public_key in public_keys:
+            self.leases.pop(public_key, None)
+        self.nonces.purge()
@@ -1,17 +1,23 @@
 import base64
 import binascii
+import functools
 import json
 import os
-import random
-import socket
-import ssl
+import sys
 import time
-import urllib.request
+import urllib.error
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from dataclasses import dataclass
-from ipaddress import ip_address, ip_network
+from ipaddress import IPv4Address, IPv6Address, ip_address, ip_network
+from typing import Callable
+from urllib.parse import urlencode
 
+from app.http_session import HTTPResponse, HTTPSession
+from app.jsonstream import decode_stream
+from app.probe import probe_connect_rtt, probe_rtt
 
-@dataclass
+
+@dataclass(slots=True)
 class Provider:
     id: str
     endpoint: str
@@ -21,19 +27,53 @@ class Provider:
     lease_nonce: str | None = None
     lease_exp: int | None = None
     lease_sig: str | None = None
+    probe_port: int | None = None
+
+
+LEASE_REFRESH_MARGIN_SECONDS = 30
+
+
+def _provider_from_item(item: dict) -> Provider:
+    # Keys and allowed-ips repeat across refetches (and allowed-ips across most providers);
+    # interning lets every copy share one string.
+    return Provider(
+        id=item["id"],
+        endpoint=item["endpoint"],
+        public_key=sys.intern(item["public_key"]),
+        allowed_ips=sys.intern(item.get("allowed_ips", "0.0.0.0/0,::/0")),
+        client_ip=item.get("client_ip"),
+        lease_nonce=item.get("lease_nonce"),
+        lease_exp=item.get("lease_exp"),
+        lease_sig=item.get("lease_sig"),
+        probe_port=_probe_port(item),
+    )
 
 
 class PoolClient:
-    def __init__(self, pool_url: str, timeout: int = 5, pool_token: str = "") -> None:
+    def __init__(self, pool_url: str, timeout: int = 5, pool_token: str = "", session: HTTPSession | None = None) -> None:
         self.pool_url = pool_url
         self.timeout = timeout
         self.pool_token = pool_token
-        self.ssl_context = ssl.create_default_context()
-        self.ssl_context.minimum_version = ssl.TLSVersion.TLSv1_2
+        self.session = session or HTTPSession(timeout=timeout)
+        # Last known provider list, revalidated with ETag/If-None-Match and `since=` deltas.
+        self._providers: dict[str, Provider] = {}
+        self._etag: str | None = None
+        self._cursor: str | None = None
+        self.last_fetch = "none"
+        # Cleared when the pool answers /claim/batch with 404, i.e. it only serves /claim/next.
+        self.claim_batch_supported = True
 
     def set_token(self, token: str) -> None:
+        if token != self.pool_token:
+            # Leases in the cached list are bound to the old token.
+            self.invalidate_providers()
         self.pool_token = token
 
+    def invalidate_providers(self) -> None:
+        self._providers.clear()
+        self._etag = None
+        self._cursor = None
+
     def _headers(self, extra: dict[str, str] | None = None) -> dict[str, str]:
         headers = {"User-Agent": "DVPN/1.0"}
         if self.pool_token:
@@ -42,28 +82,75 @@ class PoolClient:
             headers.update(extra)
         return headers
 
-    def fetch_providers(self) -> list[Provider]:
-        req = urllib.request.Request(self.pool_url, headers=self._headers())
-        with urllib.request.urlopen(req, timeout=self.timeout, context=self.ssl_context) as response:
-            raw = json.loads(response.read().decode("utf-8"))
+    def _post(self, suffix: str, payload: bytes, timeout: float | None = None) -> HTTPResponse:
+        return self.session.request(
+            "POST",
+            self.pool_url.rstrip("/") + suffix,
+            body=payload,
+            headers=self._headers({"Content-Type": "application/json"}),
+            timeout=timeout or self.timeout,
+        )
+
+    def _leases_fresh(self) -> bool:
+        # Leases are signed with an expiry (ms since epoch); revalidating a list whose leases are
+        # about to lapse would just hand mark_approved an expired signature.
+        horizon_ms = (time.time() + LEASE_REFRESH_MARGIN_SECONDS) * 1000
+        return all(p.lease_exp is None or p.lease_exp > horizon_ms for p in self._providers.values())
 
-        providers = []
-        for item in raw:
+    def fetch_providers(self) -> list[Provider]:
+        headers = self._headers()
+        url = self.pool_url
+        if self._providers and self._leases_fresh():
+            if self._etag:
+                headers["If-None-Match"] = self._etag
+            if self._cursor:
+                url += ("&" if "?" in url else "?") + urlencode({"since": self._cursor})
+        else:
+            self.invalidate_providers()
+
+        headers["Accept"] = "application/x-ndjson, application/json"
+        with self.session.stream("GET", url, headers=headers, timeout=self.timeout) as response:
+            if response.status == 304:
+                self.last_fetch = "not_modified"
+                return list(self._providers.values())
+            etag = response.getheader("ETag")
+            cursor = response.getheader("X-DVPN-Cursor")
+            ndjson = "ndjson" in (response.getheader("Content-Type") or "")
+            # Providers are validated and built as bytes arrive instead of after decoding the whole body.
+            items, document = decode_stream(response.read, ndjson=ndjson)
+            if items is None and isinstance(document, dict) and document.get("delta"):
+                for provider_id in document.get("removed", []):
+                    self._providers.pop(str(provider_id), None)
+                self._apply_provider_items(self._providers, document.get("providers", []))
+                self.last_fetch = "delta"
+            else:
+                if items is None:
+                    items = iter(document.get("providers", []) if isinstance(document, dict) else document)
+                fresh: dict[str, Provider] = {}
+                try:
+                    self._apply_provider_items(fresh, items)
+                except Exception:
+                    self.invalidate_providers()
+                    raise
+                self._providers = fresh
+                self.last_fetch = "full"
+            if isinstance(document, dict) and document.get("cursor") is not None:
+                cursor = str(document["cursor"])
+
+        self._etag = etag
+        self._cursor = cursor
+        return list(self._providers.values())
+
+    @staticmethod
+    def _apply_provider_items(target: dict[str, Provider], items) -> None:
+        for item in items:
+            if not isinstance(item, dict):
+                continue
             if item.get("health") not in (None, "ok"):
+                target.pop(str(item.get("id")), None)
                 continue
-            providers.append(
-                Provider(
-                    id=item["id"],
-                    endpoint=item["endpoint"],
-                    public_key=item["public_key"],
-                    allowed_ips=item.get("allowed_ips", "0.0.0.0/0,::/0"),
-                    client_ip=item.get("client_ip"),
-                    lease_nonce=item.get("lease_nonce"),
-                    lease_exp=item.get("lease_exp"),
-                    lease_sig=item.get("lease_sig"),
-                )
-            )
-        return providers
+            provider = _provider_from_item(item)
+            target[provider.id] = provider
 
     def mark_approved(self, provider: Provider, token: str) -> None:
         payload = json.dumps(
@@ -77,14 +164,7 @@ class PoolClient:
                 "lease_sig": provider.lease_sig,
             }
         ).encode("utf-8")
-        req = urllib.request.Request(
-            self.pool_url.rstrip("/") + "/approve",
-            data=payload,
-            headers=self._headers({"Content-Type": "application/json"}),
-            method="POST",
-        )
-        with urllib.request.urlopen(req, timeout=self.timeout, context=self.ssl_context):
-            return
+        self._post("/approve", payload)
 
     def register_node(
         self,
@@ -101,40 +181,48 @@ class PoolClient:
             "allowed_ips": allowed_ips,
             "metadata": metadata or {},
         }
-        req = urllib.request.Request(
-            self.pool_url.rstrip("/") + "/register",
-            data=json.dumps(payload).encode("utf-8"),
-            headers=self._headers({"Content-Type": "application/json"}),
-            method="POST",
-        )
-        with urllib.request.urlopen(req, timeout=self.timeout, context=self.ssl_context):
-            return
+        self._post("/register", json.dumps(payload).encode("utf-8"))
 
     def prune_dead_endpoints(self) -> dict:
-        req = urllib.request.Request(
-            self.pool_url.rstrip("/") + "/prune",
-            data=b"{}",
-            headers=self._headers({"Content-Type": "application/json"}),
-            method="POST",
-        )
-        with urllib.request.urlopen(req, timeout=self.timeout, context=self.ssl_context) as response:
-            return json.loads(response.read().decode("utf-8"))
+        return self._post("/prune", b"{}").json()
 
     def fetch_next_claim(self, provider_id: str) -> dict | None:
         payload = json.dumps({"provider_id": provider_id}).encode("utf-8")
-        req = urllib.request.Request(
-            self.pool_url.rstrip("/") + "/claim/next",
-            data=payload,
-            headers=self._headers({"Content-Type": "application/json"}),
-            method="POST",
-        )
-        with urllib.request.urlopen(req, timeout=self.timeout, context=self.ssl_context) as response:
-            body = json.loads(response.read().decode("utf-8"))
+        body = self._post("/claim/next", payload).json()
         if not body.get("ok"):
             return None
         claim = body.get("claim")
         return claim if isinstance(claim, dict) else None
 
+    def fetch_claims(self, provider_id: str, limit: int = 32, wait_seconds: float = 0.0) -> list[dict]:
+        if not self.claim_batch_supported:
+            claim = self.fetch_next_claim(provider_id)
+            return [claim] if claim else []
+        # With wait_ms the pool holds the request open until a claim arrives or the wait ends.
+        payload = json.dumps(
+            {"provider_id": provider_id, "max": limit, "wait_ms": int(wait_seconds * 1000)}
+        ).encode("utf-8")
+        try:
+            body = self._post("/claim/batch", payload, timeout=self.timeout + wait_seconds).json()
+        except urllib.error.HTTPError as err:
+            if err.code != 404:
+                raise
+            self.claim_batch_supported = False
+            claim = self.fetch_next_claim(provider_id)
+            return [claim] if claim else []
+        if not body.get("ok"):
+            return []
+        return [claim for claim in body.get("claims") or [] if isinstance(claim, dict)]
+
+
+def _probe_port(item: dict) -> int | None:
+    value = item.get("probe_port") or (item.get("meta") or {}).get("probe_port")
+    try:
+        port = int(value)
+    except (TypeError, ValueError):
+        return None
+    return port if 1 <= port <= 65535 else None
+
 
 def _allow_private_endpoints() -> bool:
     return os.getenv("ALLOW_PRIVATE_ENDPOINTS", "false").lower() == "true"
@@ -185,64 +273,135 @@ def validate_public_key(public_key: str) -> bool:
     return len(decoded) == 32
 
 
-def validate_provider(provider: Provider) -> None:
+@dataclass(frozen=True, slots=True)
+class ProviderCheck:
+    host: str | None
+    port: int | None
+    ip: IPv4Address | IPv6Address | None
+    endpoint_error: str | None
+    disallowed_host: bool
+    non_public_ip: bool
+    key_valid: bool
+    allowed_ips_error: str | None
+
+
+PROVIDER_CHECK_CACHE_SIZE = int(os.getenv("PROVIDER_CHECK_CACHE_SIZE", "131072"))
+
+
+@functools.lru_cache(maxsize=PROVIDER_CHECK_CACHE_SIZE)
+def check_provider(endpoint: str, public_key: str, allowed_ips: str) -> ProviderCheck:
+    # Everything here depends only on the three strings, so an unchanged provider is parsed
+    # once and later selection/probe cycles reuse the same record.
+    host: str | None = None
+    port: int | None = None
+    ip = None
+    endpoint_error = None
+    try:
+        host, port = _split_endpoint(endpoint)
+        ip = ip_address(host)
+    except ValueError as err:
+        if host is None:
+            endpoint_error = str(err)
+
+    allowed_ips_error = None
     try:
-        host, _ = _split_endpoint(provider.endpoint)
+        for cidr in allowed_ips.split(","):
+            ip_network(cidr.strip(), strict=False)
     except ValueError as err:
-        raise ValueError(f"Invalid provider endpoint for {provider.id}: {err}") from err
+        allowed_ips_error = str(err)
+
+    return ProviderCheck(
+        host=host,
+        port=port,
+        ip=ip,
+        endpoint_error=endpoint_error,
+        disallowed_host=host is not None and _is_disallowed_host(host),
+        non_public_ip=ip is not None and (ip.is_private or ip.is_loopback or ip.is_link_local or ip.is_unspecified),
+        key_valid=validate_public_key(public_key),
+        allowed_ips_error=allowed_ips_error,
+    )
+
+
+def provider_check(provider: Provider) -> ProviderCheck:
+    return check_provider(provider.endpoint, provider.public_key, provider.allowed_ips)
+
 
-    if not _allow_private_endpoints() and _is_disallowed_host(host):
+def validate_provider(provider: Provider) -> None:
+    check = provider_check(provider)
+    if check.endpoint_error is not None:
+        raise ValueError(f"Invalid provider endpoint for {provider.id}: {check.endpoint_error}")
+
+    if not _allow_private_endpoints() and check.disallowed_host:
         raise ValueError(f"Provider endpoint must be public-routable for {provider.id}")
 
-    if not validate_public_key(provider.public_key):
+    if not check.key_valid:
         raise ValueError(f"Invalid WireGuard public key for provider {provider.id}")
 
-    for cidr in provider.allowed_ips.split(","):
-        ip_network(cidr.strip(), strict=False)
+    if check.allowed_ips_error is not None:
+        raise ValueError(check.allowed_ips_error)
 
 
-def mesh_cycle(
-    providers: list[Provider],
-    previous_provider_id: str | None = None,
-    rng: random.Random | None = None,
-) -> list[Provider]:
-    if not providers:
-        return []
-    source = rng if rng is not None else random.SystemRandom()
-    shuffled = providers[:]
-    source.shuffle(shuffled)
-    if previous_provider_id:
-        preferred = [p for p in shuffled if p.id != previous_provider_id]
-        if preferred:
-            tail = [p for p in shuffled if p.id == previous_provider_id]
-            shuffled = preferred + tail
-    return shuffled
-
-
-def measure_latency(endpoint: str, timeout: int = 2) -> float:
+def measure_latency(endpoint: str, timeout: int = 2, samples: int = 3, probe_port: int | None = None) -> float:
     host, port = _split_endpoint(endpoint)
-    start = time.perf_counter()
-    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
-        sock.settimeout(timeout)
-        sock.sendto(b"\x00", (host, port))
-    return (time.perf_counter() - start) * 1000
+    if probe_port is None:
+        # No echo responder advertised; the WireGuard port itself never answers a probe.
+        stats = probe_connect_rtt(host, port, samples=samples, timeout=timeout)
+    else:
+        stats = probe_rtt(host, probe_port, samples=samples, timeout=timeout)
+    return stats.median_ms
+
 
+def _probe_provider(provider: Provider, timeout: int, samples: int) -> float:
+    validate_provider(provider)
+    try:
+        return measure_latency(provider.endpoint, timeout=timeout, samples=samples, probe_port=provider.probe_port)
+    except TimeoutError:
+        # Nothing answered: keep the provider, but rank it behind every measured one.
+        return float("inf")
 
-def fastest_provider(providers: list[Provider], timeout: int = 2) -> Provider:
+
+def fastest_provider(
+    providers: list[Provider],
+    timeout: int = 2,
+    max_workers: int = 16,
+    deadline_seconds: float | None = None,
+    good_enough_ms: float | None = None,
+    samples: int = 3,
+    on_result: Callable[[Provider, float], None] | None = None,
+) -> Provider:
     if not providers:
         raise ValueError("No providers available in pool")
 
-    scored = []
-    for provider in providers:
-        try:
-            validate_provider(provider)
-            latency = measure_latency(provider.endpoint, timeout=timeout)
-            scored.append((latency, provider))
-        except (OSError, ValueError):
-            continue
-
-    if not scored:
+    # Probes fan out across a bounded pool; the whole selection is capped by one global
+    # deadline instead of costing len(providers) * timeout when endpoints are blackholed.
+    deadline = time.monotonic() + (deadline_seconds if deadline_seconds is not None else timeout * 2)
+    executor = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(providers))), thread_name_prefix="dvpn-probe")
+    futures = {executor.submit(_probe_provider, provider, timeout, samples): index for index, provider in enumerate(providers)}
+    best: tuple[float, int] | None = None
+    try:
+        pending = set(futures)
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    latency = future.result()
+                except (OSError, ValueError):
+                    continue
+                if on_result is not None and latency != float("inf"):
+                    on_result(providers[futures[future]], latency)
+                # Unmeasured providers tie at inf and keep the caller's (scoreboard) order.
+                candidate = (latency, futures[future])
+                if best is None or candidate < best:
+                    best = candidate
+            if best is not None and good_enough_ms is not None and best[0] <= good_enough_ms:
+                break
+    finally:
+        # Stragglers are abandoned: queued probes are cancelled and in-flight ones are bounded by `timeout`.
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    if best is None:
         raise RuntimeError("No reachable providers")
-
-    scored.sort(key=lambda item: item[0])
-    return scored[0][1]
+    return providers[best[1]]
@@ -0,0 +1,422 @@
+import socket
+import struct
+import threading
+import time
+import urllib.error
+import urllib.request
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass
+from typing import Callable
+from urllib.parse import urljoin
+from xml.sax.saxutils import escape
+
+SSDP_ADDRESS = ("239.255.255.250", 1900)
+NATPMP_PORT = 5351
+WAN_SERVICE_TYPES = (
+    "urn:schemas-upnp-org:service:WANIPConnection:2",
+    "urn:schemas-upnp-org:service:WANIPConnection:1",
+    "urn:schemas-upnp-org:service:WANPPPConnection:1",
+)
+# UPnP error 725: the gateway only accepts permanent (lease 0) mappings.
+UPNP_ONLY_PERMANENT_LEASES = 725
+
+# NAT-PMP (RFC 6886) mapping request/response: version, opcode, ..., lifetime.
+NATPMP_REQUEST = struct.Struct("!BBHHHI")
+NATPMP_RESPONSE = struct.Struct("!BBHIHHI")
+
+
+class UPnPError(Exception):
+    def __init__(self, code: int | None, message: str) -> None:
+        super().__init__(message)
+        self.code = code
+
+
+@dataclass
+class IGDService:
+    control_url: str
+    service_type: str
+
+
+@dataclass
+class PortMapping:
+    method: str
+    protocol: str
+    internal_port: int
+    external_port: int
+    lifetime: int
+    external_ip: str | None = None
+
+
+def _local_name(tag: str) -> str:
+    return tag.rsplit("}", 1)[-1]
+
+
+def ssdp_search(timeout: float = 2.0, address: tuple[str, int] = SSDP_ADDRESS) -> list[str]:
+    request = (
+        "M-SEARCH * HTTP/1.1\r\n"
+        f"HOST: {SSDP_ADDRESS[0]}:{SSDP_ADDRESS[1]}\r\n"
+        'MAN: "ssdp:discover"\r\n'
+        "MX: 1\r\n"
+        "ST: urn:schemas-upnp-org:device:InternetGatewayDevice:1\r\n\r\n"
+    ).encode("ascii")
+    locations: list[str] = []
+    deadline = time.monotonic() + timeout
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+        sock.sendto(request, address)
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            sock.settimeout(remaining)
+            try:
+                data, _ = sock.recvfrom(2048)
+            except (socket.timeout, ConnectionRefusedError):
+                break
+            for line in data.decode("utf-8", errors="replace").split("\r\n"):
+                name, _, value = line.partition(":")
+                if name.strip().lower() == "location" and value.strip() and value.strip() not in locations:
+                    locations.append(value.strip())
+            if locations:
+                # The first gateway to answer is the one on our default route in practice.
+                break
+    return locations
+
+
+def fetch_igd_service(location: str, timeout: float = 2.0) -> IGDService | None:
+    with urllib.request.urlopen(location, timeout=timeout) as response:
+        root = ET.fromstring(response.read())
+    base = location
+    found: dict[str, str] = {}
+    for element in root.iter():
+        name = _local_name(element.tag)
+        if name == "URLBase" and element.text:
+            base = element.text.strip()
+        elif name == "service":
+            fields = {_local_name(child.tag): (child.text or "").strip() for child in element}
+            if fields.get("serviceType") in WAN_SERVICE_TYPES and fields.get("controlURL"):
+                found.setdefault(fields["serviceType"], fields["controlURL"])
+    for service_type in WAN_SERVICE_TYPES:
+        if service_type in found:
+            return IGDService(urljoin(base, found[service_type]), service_type)
+    return None
+
+
+def _soap(service: IGDService, action: str, args: list[tuple[str, str]], timeout: float) -> dict[str, str]:
+    arguments = "".join(f"<{name}>{escape(value)}</{name}>" for name, value in args)
+    body = (
+        '<?xml version="1.0"?>'
+        '<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" '
+        's:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">'
+        f'<s:Body><u:{action} xmlns:u="{service.service_type}">{arguments}</u:{action}></s:Body>'
+        "</s:Envelope>"
+    ).encode("utf-8")
+    request = urllib.request.Request(
+        service.control_url,
+        data=body,
+        method="POST",
+        headers={
+            "Content-Type": 'text/xml; charset="utf-8"',
+            "SOAPAction": f'"{service.service_type}#{action}"',
+        },
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            payload = response.read()
+    except urllib.error.HTTPError as err:
+        detail = err.read()
+        code = None
+        try:
+            for element in ET.fromstring(detail).iter():
+                if _local_name(element.tag) == "errorCode" and element.text:
+                    code = int(element.text.strip())
+        except (ET.ParseError, ValueError):
+            pass
+        raise UPnPError(code, f"{action} failed with HTTP {err.code} (UPnP error {code})") from err
+    values: dict[str, str] = {}
+    for element in ET.fromstring(payload).iter():
+        if len(element) == 0 and element.text is not None:
+            values[_local_name(element.tag)] = element.text.strip()
+    return values
+
+
+def upnp_add_mapping(
+    service: IGDService,
+    internal_client: str,
+    internal_port: int,
+    external_port: int,
+    protocol: str = "UDP",
+    lease_seconds: int = 3600,
+    description: str = "DVPN",
+    timeout: float = 2.0,
+) -> None:
+    _soap(
+        service,
+        "AddPortMapping",
+        [
+            ("NewRemoteHost", ""),
+            ("NewExternalPort", str(external_port)),
+            ("NewProtocol", protocol.upper()),
+            ("NewInternalPort", str(internal_port)),
+            ("NewInternalClient", internal_client),
+            ("NewEnabled", "1"),
+            ("NewPortMappingDescription", description),
+            ("NewLeaseDuration", str(lease_seconds)),
+        ],
+        timeout,
+    )
+
+
+def upnp_delete_mapping(service: IGDService, external_port: int, protocol: str = "UDP", timeout: float = 2.0) -> None:
+    _soap(
+        service,
+        "DeletePortMapping",
+        [("NewRemoteHost", ""), ("NewExternalPort", str(external_port)), ("NewProtocol", protocol.upper())],
+        timeout,
+    )
+
+
+def upnp_external_ip(service: IGDService, timeout: float = 2.0) -> str | None:
+    return _soap(service, "GetExternalIPAddress", [], timeout).get("NewExternalIPAddress") or None
+
+
+def natpmp_map(
+    gateway: str,
+    internal_port: int,
+    external_port: int,
+    protocol: str = "UDP",
+    lifetime: int = 3600,
+    timeout: float = 2.0,
+    port: int = NATPMP_PORT,
+) -> PortMapping | None:
+    opcode = 1 if protocol.upper() == "UDP" else 2
+    request = NATPMP_REQUEST.pack(0, opcode, 0, internal_port, external_port, lifetime)
+    deadline = time.monotonic() + timeout
+    retransmit = 0.25
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.connect((gateway, port))
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            sock.send(request)
+            # RFC 6886 retransmits at 250 ms, doubling each time.
+            sock.settimeout(min(retransmit, remaining))
+            retransmit *= 2
+            try:
+                data = sock.recv(64)
+            except socket.timeout:
+                continue
+            except ConnectionRefusedError:
+                return None
+            if len(data) < NATPMP_RESPONSE.size:
+                continue
+            version, reply_opcode, result, _, reply_internal, mapped_port, granted = NATPMP_RESPONSE.unpack_from(data)
+            if version != 0 or reply_opcode != 128 + opcode or reply_internal != internal_port:
+                continue
+            if result != 0:
+                return None
+            return PortMapping("natpmp", protocol.upper(), internal_port, mapped_port, granted)
+
+
+def default_gateway(route_path: str = "/proc/net/route") -> str | None:
+    try:
+        with open(route_path) as handle:
+            next(handle, None)
+            for line in handle:
+                fields = line.split()
+                if len(fields) > 2 and fields[1] == "00000000":
+                    return socket.inet_ntoa(struct.pack("<I", int(fields[2], 16)))
+    except (OSError, ValueError):
+        return None
+    return None
+
+
+def lan_address(gateway: str | None) -> str | None:
+    # The source address the kernel picks to reach the gateway is on the LAN even while a full
+    # tunnel is up; routing toward a public host would pick the tunnel address instead.
+    if not gateway:
+        return None
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.connect((gateway, 9))
+            return sock.getsockname()[0]
+    except OSError:
+        return None
+
+
+class PortMapper:
+    def __init__(
+        self,
+        internal_port: int,
+        protocol: str = "UDP",
+        lease_seconds: int = 3600,
+        timeout: float = 2.0,
+        retry_seconds: float = 60.0,
+        description: str = "DVPN",
+        local_ip_fn: Callable[[], str | None] | None = None,
+        gateway_fn: Callable[[], str | None] = default_gateway,
+        ssdp_address: tuple[str, int] = SSDP_ADDRESS,
+        natpmp_port: int = NATPMP_PORT,
+        on_change: Callable[[PortMapping | None], None] | None = None,
+    ) -> None:
+        self.internal_port = internal_port
+        self.protocol = protocol.upper()
+        self.lease_seconds = max(0, lease_seconds)
+        self.timeout = timeout
+        self.retry_seconds = retry_seconds
+        self.description = description
+        self.gateway_fn = gateway_fn
+        self.local_ip_fn = local_ip_fn or (lambda: lan_address(self.gateway_fn()))
+        self.ssdp_address = ssdp_address
+        self.natpmp_port = natpmp_port
+        self.on_change = on_change
+        self.mapping: PortMapping | None = None
+        # Discovered once and reused for renewals; dropped when the gateway stops answering.
+        self.igd: IGDService | None = None
+        self._permanent_only = False
+        self._lock = threading.Lock()
+        self._mapped = threading.Event()
+        self._stop = threading.Event()
+        self.thread: threading.Thread | None = None
+
+    @property
+    def running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self) -> None:
+        if self.running:
+            return
+        self._stop.clear()
+        self.thread = threading.Thread(target=self._run, name="dvpn-portmap", daemon=True)
+        self.thread.start()
+
+    def stop(self, remove: bool = True) -> None:
+        self._stop.set()
+        if self.thread is not None:
+            self.thread.join(timeout=self.timeout + 1)
+            self.thread = None
+        if remove:
+            self.remove()
+
+    def wait(self, timeout: float | None = None) -> PortMapping | None:
+        self._mapped.wait(timeout)
+        return self.mapping
+
+    def _add_upnp_mapping(self, local_ip: str, lease: int) -> None:
+        assert self.igd is not None
+        upnp_add_mapping(
+            self.igd,
+            local_ip,
+            self.internal_port,
+            self.internal_port,
+            protocol=self.protocol,
+            lease_seconds=lease,
+            description=self.description,
+            timeout=self.timeout,
+        )
+
+    def _map_upnp(self) -> PortMapping | None:
+        local_ip = self.local_ip_fn()
+        if not local_ip:
+            return None
+        if self.igd is None:
+            for location in ssdp_search(self.timeout, self.ssdp_address):
+                try:
+                    self.igd = fetch_igd_service(location, self.timeout)
+                except (OSError, ET.ParseError):
+                    continue
+                if self.igd is not None:
+                    break
+        if self.igd is None:
+            return None
+        lease = 0 if self._permanent_only else self.lease_seconds
+        try:
+            self._add_upnp_mapping(local_ip, lease)
+        except UPnPError as err:
+            if err.code != UPNP_ONLY_PERMANENT_LEASES or lease == 0:
+                raise
+            self._permanent_only = True
+            lease = 0
+            self._add_upnp_mapping(local_ip, lease)
+        try:
+            external_ip = upnp_external_ip(self.igd, self.timeout)
+        except (UPnPError, OSError, ET.ParseError):
+            external_ip = None
+        return PortMapping("upnp", self.protocol, self.internal_port, self.internal_port, lease, external_ip)
+
+    def _map_natpmp(self) -> PortMapping | None:
+        gateway = self.gateway_fn()
+        if not gateway:
+            return None
+        # Ask for the same external port as before so renewals keep the advertised endpoint.
+        suggested = self.internal_port
+        if self.mapping is not None and self.mapping.method == "natpmp":
+            suggested = self.mapping.external_port
+        return natpmp_map(
+            gateway,
+            self.internal_port,
+            suggested,
+            protocol=self.protocol,
+            lifetime=self.lease_seconds or 7200,
+            timeout=self.timeout,
+            port=self.natpmp_port,
+        )
+
+    def map_once(self) -> PortMapping | None:
+        with self._lock:
+            previous = self.mapping
+            # Renew with whichever method worked last; NAT-PMP is a single round trip, so it is
+            # tried before SSDP discovery when nothing is known yet.
+            if previous is not None and previous.method == "upnp":
+                methods = [self._map_upnp, self._map_natpmp]
+            else:
+                methods = [self._map_natpmp, self._map_upnp]
+            mapping = None
+            for method in methods:
+                try:
+                    mapping = method()
+                except (UPnPError, OSError, ET.ParseError):
+                    if method == self._map_upnp:
+                        self.igd = None
+                    mapping = None
+                if mapping is not None:
+                    break
+            self.mapping = mapping
+            if mapping is not None:
+                self._mapped.set()
+        if mapping != previous and self.on_change is not None:
+            self.on_change(mapping)
+        return mapping
+
+    def remove(self) -> None:
+        with self._lock:
+            mapping = self.mapping
+            self.mapping = None
+            self._mapped.clear()
+            if mapping is None:
+                return
+            try:
+                if mapping.method == "upnp" and self.igd is not None:
+                    upnp_delete_mapping(self.igd, mapping.external_port, mapping.protocol, self.timeout)
+                elif mapping.method == "natpmp":
+                    gateway = self.gateway_fn()
+                    if gateway:
+                        # A zero lifetime deletes the mapping (RFC 6886 section 3.4).
+                        natpmp_map(gateway, self.internal_port, 0, mapping.protocol, 0, self.timeout, self.natpmp_port)
+            except (UPnPError, OSError, ET.ParseError):
+                pass
+
+    def next_refresh_delay(self) -> float:
+        mapping = self.mapping
+        if mapping is None:
+            return self.retry_seconds
+        # Renew at half the granted lifetime; permanent leases are re-asserted on the same
+        # schedule so a rebooted gateway gets its mapping back.
+        lifetime = mapping.lifetime or self.lease_seconds or 3600
+        return max(lifetime / 2, 1.0)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self.map_once()
+            self._stop.wait(self.next_refresh_delay())
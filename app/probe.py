@@ -0,0 +1,161 @@
+import os
+import socket
+import statistics
+import struct
+import threading
+import time
+from dataclasses import dataclass
+
+# Echo protocol: an 8-byte magic, an 8-byte per-probe token and a 2-byte sequence number.
+# Responders send the packet back unchanged; anything else is ignored so the responder
+# cannot be used to reflect arbitrary traffic.
+PROBE_MAGIC = b"DVPNPING"
+PROBE_PACKET = struct.Struct("!8s8sH")
+
+
+@dataclass
+class RTTStats:
+    sent: int
+    samples_ms: list[float]
+
+    @property
+    def received(self) -> int:
+        return len(self.samples_ms)
+
+    @property
+    def loss(self) -> float:
+        if self.sent <= 0:
+            return 1.0
+        return 1.0 - (self.received / self.sent)
+
+    @property
+    def min_ms(self) -> float:
+        return min(self.samples_ms) if self.samples_ms else float("inf")
+
+    @property
+    def median_ms(self) -> float:
+        return statistics.median(self.samples_ms) if self.samples_ms else float("inf")
+
+    @property
+    def jitter_ms(self) -> float:
+        # Mean absolute difference between consecutive samples (RFC 3550 style, unsmoothed).
+        if len(self.samples_ms) < 2:
+            return 0.0
+        diffs = [abs(b - a) for a, b in zip(self.samples_ms, self.samples_ms[1:])]
+        return sum(diffs) / len(diffs)
+
+
+def _family_for(host: str) -> int:
+    return socket.AF_INET6 if ":" in host else socket.AF_INET
+
+
+def probe_rtt(host: str, port: int, samples: int = 3, timeout: float = 2.0, interval: float = 0.02) -> RTTStats:
+    samples = max(1, samples)
+    token = os.urandom(8)
+    sent_at: dict[int, float] = {}
+    rtts: dict[int, float] = {}
+    deadline = time.perf_counter() + timeout
+    with socket.socket(_family_for(host), socket.SOCK_DGRAM) as sock:
+        sock.connect((host, port))
+        for seq in range(samples):
+            sent_at[seq] = time.perf_counter()
+            sock.send(PROBE_PACKET.pack(PROBE_MAGIC, token, seq))
+            if seq + 1 < samples and interval > 0:
+                time.sleep(interval)
+        while len(rtts) < samples:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            sock.settimeout(remaining)
+            try:
+                data = sock.recv(64)
+            except socket.timeout:
+                break
+            except ConnectionRefusedError:
+                # ICMP port unreachable: nothing is listening, no point waiting for the rest.
+                break
+            received_at = time.perf_counter()
+            if len(data) != PROBE_PACKET.size:
+                continue
+            magic, reply_token, seq = PROBE_PACKET.unpack(data)
+            if magic != PROBE_MAGIC or reply_token != token or seq not in sent_at or seq in rtts:
+                continue
+            rtts[seq] = (received_at - sent_at[seq]) * 1000
+    if not rtts:
+        raise TimeoutError(f"no echo reply from {host}:{port}")
+    return RTTStats(sent=samples, samples_ms=[rtts[seq] for seq in sorted(rtts)])
+
+
+def probe_connect_rtt(host: str, port: int, samples: int = 3, timeout: float = 2.0) -> RTTStats:
+    # Fallback for providers that advertise no echo port. A TCP connect costs one round trip whether
+    # the far side accepts or refuses it, so nothing has to listen on the provider.
+    samples = max(1, samples)
+    rtts: list[float] = []
+    deadline = time.perf_counter() + timeout
+    for _ in range(samples):
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0:
+            break
+        with socket.socket(_family_for(host), socket.SOCK_STREAM) as sock:
+            sock.settimeout(remaining)
+            started = time.perf_counter()
+            try:
+                sock.connect((host, port))
+            except ConnectionRefusedError:
+                pass
+            except OSError:
+                # Timed out or filtered: later attempts would only wait out the same deadline.
+                break
+            rtts.append((time.perf_counter() - started) * 1000)
+    if not rtts:
+        raise TimeoutError(f"no TCP answer from {host}:{port}")
+    return RTTStats(sent=samples, samples_ms=rtts)
+
+
+class EchoResponder:
+    def __init__(self, host: str = "0.0.0.0", port: int = 51821) -> None:
+        self.host = host
+        self.port = port
+        self.sock: socket.socket | None = None
+        self.thread: threading.Thread | None = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self) -> None:
+        if self.running:
+            return
+        sock = socket.socket(_family_for(self.host), socket.SOCK_DGRAM)
+        sock.bind((self.host, self.port))
+        sock.settimeout(0.5)
+        self.port = sock.getsockname()[1]
+        self.sock = sock
+        self._stop.clear()
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    def _serve(self) -> None:
+        assert self.sock is not None
+        while not self._stop.is_set():
+            try:
+                data, addr = self.sock.recvfrom(64)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            if len(data) == PROBE_PACKET.size and data.startswith(PROBE_MAGIC):
+                try:
+                    self.sock.sendto(data, addr)
+                except OSError:
+                    continue
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self.thread is not None:
+            self.thread.join(timeout=2)
+            self.thread = None
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
@@ -0,0 +1,188 @@
+import asyncio
+import functools
+import threading
+import time
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, TypeVar
+
+T = TypeVar("T")
+
+LANE_THREAD_PREFIX = "dvpn-tunnel"
+
+
+@dataclass
+class TraceSpan:
+    name: str
+    start: float
+    end: float | None = None
+    error: str | None = None
+
+
+class StartupTrace:
+    def __init__(self, clock: Callable[[], float] = time.monotonic) -> None:
+        self.clock = clock
+        self.origin = clock()
+        self._lock = threading.Lock()
+        self.spans: list[TraceSpan] = []
+        self.marks: dict[str, float] = {}
+
+    def elapsed(self) -> float:
+        return self.clock() - self.origin
+
+    def mark(self, name: str) -> float:
+        # Marks are milestones (e.g. first tunnel), so only the first occurrence counts.
+        with self._lock:
+            return self.marks.setdefault(name, self.elapsed())
+
+    async def step(self, name: str, awaitable: Awaitable[T]) -> T:
+        span = TraceSpan(name, self.elapsed())
+        with self._lock:
+            self.spans.append(span)
+        try:
+            result = await awaitable
+        except asyncio.CancelledError:
+            span.error = "cancelled"
+            raise
+        except Exception as err:
+            span.error = str(err) or type(err).__name__
+            raise
+        finally:
+            span.end = self.elapsed()
+        return result
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "marks": {name: round(at, 3) for name, at in self.marks.items()},
+                "steps": [
+                    {
+                        "name": span.name,
+                        "start": round(span.start, 3),
+                        "end": None if span.end is None else round(span.end, 3),
+                        "error": span.error,
+                    }
+                    for span in self.spans
+                ],
+            }
+
+    def render(self) -> str:
+        snapshot = self.snapshot()
+        parts = []
+        for step in snapshot["steps"]:
+            end = "running" if step["end"] is None else f"{step['end']:.2f}s"
+            failed = " failed" if step["error"] else ""
+            parts.append(f"{step['name']} {step['start']:.2f}s-{end}{failed}")
+        parts += [f"{name}@{at:.2f}s" for name, at in snapshot["marks"].items()]
+        return ", ".join(parts)
+
+
+class ServiceRuntime:
+    def __init__(self, max_workers: int = 8) -> None:
+        self.max_workers = max(1, max_workers)
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self._wakeup: asyncio.Event | None = None
+        self._lane: ThreadPoolExecutor | None = None
+        self._workers: ThreadPoolExecutor | None = None
+        self._lock = threading.Lock()
+        self._generation = 0
+
+    @property
+    def generation(self) -> int:
+        with self._lock:
+            return self._generation
+
+    def wake(self, interrupt: bool = False) -> None:
+        # Called from control-server and tray threads. `interrupt` cancels whatever session is
+        # running so stop/restart/killswitch take effect now rather than at the next poll.
+        if interrupt:
+            with self._lock:
+                self._generation += 1
+        loop = self.loop
+        wakeup = self._wakeup
+        if loop is None or wakeup is None:
+            return
+        try:
+            loop.call_soon_threadsafe(wakeup.set)
+        except RuntimeError:
+            # Loop already closed; there is nothing left to wake.
+            pass
+
+    def clear(self) -> None:
+        if self._wakeup is not None:
+            self._wakeup.clear()
+
+    async def wait(self, timeout: float | None = None) -> bool:
+        assert self._wakeup is not None
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def blocking(self, fn: Callable[..., T], *args: Any) -> T:
+        assert self.loop is not None and self._workers is not None
+        return await self.loop.run_in_executor(self._workers, functools.partial(fn, *args))
+
+    async def exclusive(self, fn: Callable[..., T], *args: Any) -> T:
+        # Tunnel, firewall and socks changes share one worker thread, so a step that is still
+        # running after its task was cancelled always finishes before the cleanup queued after it.
+        assert self.loop is not None and self._lane is not None
+        return await self.loop.run_in_executor(self._lane, functools.partial(fn, *args))
+
+    def call_exclusive(self, fn: Callable[..., T], *args: Any) -> T:
+        # For control threads: queue behind whatever tunnel step is in flight and wait for the result.
+        # Without a running lane (or when already on it) there is nothing to order against.
+        lane = self._lane
+        if lane is None or threading.current_thread().name.startswith(LANE_THREAD_PREFIX):
+            return fn(*args)
+        try:
+            future = lane.submit(fn, *args)
+        except RuntimeError:
+            # The lane was shut down with the loop.
+            return fn(*args)
+        try:
+            return future.result()
+        except CancelledError:
+            # Shutdown dropped it before it got to run.
+            return fn(*args)
+
+    async def run_interruptible(self, coro: Awaitable[None]) -> bool:
+        generation = self.generation
+        task = asyncio.ensure_future(coro)
+        try:
+            while not task.done():
+                self.clear()
+                if self.generation != generation:
+                    task.cancel()
+                    try:
+                        await task
+                    except asyncio.CancelledError:
+                        pass
+                    return False
+                waiter = asyncio.ensure_future(self._wakeup.wait())
+                try:
+                    await asyncio.wait({task, waiter}, return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    waiter.cancel()
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        task.result()
+        return True
+
+    def run(self, main: Callable[[], Awaitable[None]]) -> None:
+        async def runner() -> None:
+            self.loop = asyncio.get_running_loop()
+            self._wakeup = asyncio.Event()
+            self._lane = ThreadPoolExecutor(max_workers=1, thread_name_prefix=LANE_THREAD_PREFIX)
+            self._workers = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="dvpn-io")
+            try:
+                await main()
+            finally:
+                self.loop = None
+                # Do not wait for in-flight HTTP/subprocess calls; exit should not block on their timeouts.
+                self._lane.shutdown(wait=False, cancel_futures=True)
+                self._workers.shutdown(wait=False, cancel_futures=True)
+
+        asyncio.run(runner())
@@ -0,0 +1,195 @@
+import heapq
+import json
+import math
+import os
+import random
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Iterable
+
+from app.pool import Provider
+
+
+@dataclass
+class ProviderScore:
+    rtt_ms: float | None = None
+    handshake_s: float | None = None
+    successes: float = 0.0
+    failures: float = 0.0
+    last_seen: float = 0.0
+
+    def success_rate(self) -> float:
+        # Laplace-smoothed so a provider with no history starts at 0.5 instead of 0 or 1.
+        return (self.successes + 1.0) / (self.successes + self.failures + 2.0)
+
+
+class ProviderScoreboard:
+    def __init__(
+        self,
+        path: Path | None = None,
+        max_entries: int = 4096,
+        alpha: float = 0.3,
+        half_life_seconds: float = 6 * 3600,
+        max_age_seconds: float = 7 * 24 * 3600,
+        clock: Callable[[], float] = time.time,
+    ) -> None:
+        self.path = path
+        self.max_entries = max(1, max_entries)
+        self.alpha = min(max(alpha, 0.01), 1.0)
+        self.half_life_seconds = max(half_life_seconds, 1.0)
+        self.max_age_seconds = max_age_seconds
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._scores: dict[str, ProviderScore] = {}
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._scores)
+
+    def get(self, provider_id: str) -> ProviderScore | None:
+        with self._lock:
+            score = self._scores.get(provider_id)
+            return self._decayed(score, self.clock()) if score is not None else None
+
+    def _decayed(self, score: ProviderScore, now: float) -> ProviderScore:
+        age = max(now - score.last_seen, 0.0)
+        factor = 0.5 ** (age / self.half_life_seconds)
+        return ProviderScore(score.rtt_ms, score.handshake_s, score.successes * factor, score.failures * factor, score.last_seen)
+
+    def _touch(self, score: ProviderScore, now: float) -> None:
+        decayed = self._decayed(score, now)
+        score.successes = decayed.successes
+        score.failures = decayed.failures
+        score.last_seen = now
+
+    def _ewma(self, current: float | None, sample: float) -> float:
+        if current is None:
+            return sample
+        return (1.0 - self.alpha) * current + self.alpha * sample
+
+    def _entry(self, provider_id: str, now: float) -> ProviderScore:
+        score = self._scores.get(provider_id)
+        if score is None:
+            if len(self._scores) >= self.max_entries:
+                stalest = min(self._scores, key=lambda key: self._scores[key].last_seen)
+                del self._scores[stalest]
+            score = ProviderScore(last_seen=now)
+            self._scores[provider_id] = score
+        else:
+            self._touch(score, now)
+        return score
+
+    def record_rtt(self, provider_id: str, rtt_ms: float) -> None:
+        if not math.isfinite(rtt_ms) or rtt_ms < 0:
+            return
+        with self._lock:
+            score = self._entry(provider_id, self.clock())
+            score.rtt_ms = self._ewma(score.rtt_ms, rtt_ms)
+
+    def record_handshake(self, provider_id: str, success: bool, seconds: float | None = None) -> None:
+        with self._lock:
+            score = self._entry(provider_id, self.clock())
+            if success:
+                score.successes += 1.0
+                if seconds is not None and seconds >= 0:
+                    score.handshake_s = self._ewma(score.handshake_s, seconds)
+            else:
+                score.failures += 1.0
+
+    def weight(self, provider_id: str) -> float:
+        with self._lock:
+            score = self._scores.get(provider_id)
+            if score is None:
+                return self._weight(ProviderScore())
+            return self._weight(self._decayed(score, self.clock()))
+
+    @staticmethod
+    def _weight(score: ProviderScore) -> float:
+        # Unknown latency/handshake cost is treated as average (100 ms / 2 s) rather than best-case.
+        rtt = score.rtt_ms if score.rtt_ms is not None else 100.0
+        handshake = score.handshake_s if score.handshake_s is not None else 2.0
+        return score.success_rate() * (100.0 / (100.0 + rtt)) * (2.0 / (2.0 + handshake))
+
+    def weighted_sample(
+        self,
+        providers: list[Provider],
+        k: int,
+        previous_provider_id: str | None = None,
+        rng: random.Random | None = None,
+        indices: Iterable[int] | None = None,
+    ) -> list[int]:
+        source = rng if rng is not None else random.SystemRandom()
+        candidates = range(len(providers)) if indices is None else indices
+        now = self.clock()
+        unknown = self._weight(ProviderScore())
+        with self._lock:
+            keyed = []
+            for index in candidates:
+                provider = providers[index]
+                score = self._scores.get(provider.id)
+                weight = self._weight(self._decayed(score, now)) if score is not None else unknown
+                # Efraimidis-Spirakis: the k largest u ** (1 / w) are a weighted sample without
+                # replacement, so good providers come first while every provider keeps a chance.
+                key = source.random() ** (1.0 / max(weight, 1e-9))
+                if provider.id == previous_provider_id:
+                    key -= 1.0
+                keyed.append((key, index))
+        return [index for _, index in heapq.nlargest(k, keyed)]
+
+    def prune(self) -> int:
+        now = self.clock()
+        with self._lock:
+            stale = [key for key, score in self._scores.items() if now - score.last_seen > self.max_age_seconds]
+            for key in stale:
+                del self._scores[key]
+            return len(stale)
+
+    def save(self) -> None:
+        if self.path is None:
+            return
+        self.prune()
+        with self._lock:
+            rows = {
+                key: [
+                    None if score.rtt_ms is None else round(score.rtt_ms, 2),
+                    None if score.handshake_s is None else round(score.handshake_s, 3),
+                    round(score.successes, 3),
+                    round(score.failures, 3),
+                    int(score.last_seen),
+                ]
+                for key, score in self._scores.items()
+            }
+        payload = json.dumps({"v": 1, "scores": rows}, separators=(",", ":"))
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(self.path.suffix + ".tmp")
+        tmp_path.write_text(payload)
+        os.chmod(tmp_path, 0o600)
+        os.replace(tmp_path, self.path)
+
+    def load(self) -> None:
+        if self.path is None or not self.path.exists():
+            return
+        try:
+            payload = json.loads(self.path.read_text())
+            rows = payload.get("scores", {}) if payload.get("v") == 1 else {}
+        except (OSError, ValueError, AttributeError):
+            return
+        with self._lock:
+            for key, row in rows.items():
+                try:
+                    rtt, handshake, successes, failures, last_seen = row
+                    self._scores[str(key)] = ProviderScore(
+                        rtt_ms=None if rtt is None else float(rtt),
+                        handshake_s=None if handshake is None else float(handshake),
+                        successes=float(successes),
+                        failures=float(failures),
+                        last_seen=float(last_seen),
+                    )
+                except (TypeError, ValueError):
+                    continue
+            while len(self._scores) > self.max_entries:
+                stalest = min(self._scores, key=lambda key: self._scores[key].last_seen)
+                del self._scores[stalest]
+        self.prune()
@@ -0,0 +1,137 @@
+import subprocess
+from ipaddress import ip_interface
+
+# HTB layout on the shaped interface: root qdisc 1:, parent class 1:1 at the node's total rate,
+# one leaf class 1:<minor> per peer plus a u32 filter matching the peer's tunnel address.
+ROOT_HANDLE = "1:"
+PARENT_CLASS = "1:1"
+DEFAULT_MINOR = 0xFFFF
+FIRST_MINOR = 0x10
+# Each address family gets its own u32 instance: the kernel refuses a second protocol at a prio
+# that already holds one. Root hash tables are numbered from 800 in creation order, so setup
+# creates the IPv4 instance first.
+FILTERS = {4: ("ip", 1, "800"), 6: ("ipv6", 2, "801")}
+
+
+def _rate(mbps: float) -> str:
+    # tc takes integer rates; kbit keeps sub-megabit grants from rounding to zero.
+    return f"{max(int(mbps * 1000), 8)}kbit"
+
+
+class TcShaper:
+    def __init__(self, interface: str, tc_cmd: str = "tc", timeout: float = 10) -> None:
+        self.interface = interface
+        self.tc_cmd = tc_cmd
+        self.timeout = timeout
+        self.classes: dict[str, tuple[int, str]] = {}
+        self._free_minors: list[int] = []
+        self._next_minor = FIRST_MINOR
+        self._ready = False
+
+    def run_batch(self, lines: list[str]) -> None:
+        # One `tc -batch` per update instead of a fork per class and filter.
+        subprocess.run(
+            [self.tc_cmd, "-batch", "-"],
+            input="\n".join(lines) + "\n",
+            capture_output=True,
+            text=True,
+            check=True,
+            timeout=self.timeout,
+        )
+
+    def _allocate_minor(self) -> int:
+        if self._free_minors:
+            return self._free_minors.pop()
+        minor = self._next_minor
+        if minor >= DEFAULT_MINOR:
+            raise RuntimeError("no free HTB class ids")
+        self._next_minor += 1
+        return minor
+
+    def _filter(self, verb: str, minor: int, address: str) -> str:
+        network = ip_interface(address).network
+        protocol, prio, table = FILTERS[network.version]
+        prefix = (
+            f"filter {verb} dev {self.interface} parent {ROOT_HANDLE} protocol {protocol} prio {prio} "
+            f"handle {table}::{minor:x} u32"
+        )
+        if verb == "del":
+            return prefix
+        match = "ip6" if network.version == 6 else "ip"
+        return f"{prefix} match {match} dst {network} flowid 1:{minor:x}"
+
+    def update(self, total_mbps: float, grants: dict[str, tuple[str, float]], removed: list[str]) -> None:
+        lines: list[str] = []
+        if not self._ready:
+            # Start from an empty qdisc so the filter tables get known ids; there may be nothing to delete.
+            try:
+                self.run_batch([f"qdisc del dev {self.interface} root"])
+            except subprocess.CalledProcessError:
+                pass
+            # Unmatched traffic (handshakes, the node's own flows) falls into the default class.
+            lines += [
+                f"qdisc add dev {self.interface} root handle {ROOT_HANDLE} htb default {DEFAULT_MINOR:x}",
+                f"class replace dev {self.interface} parent {ROOT_HANDLE} classid 1:{DEFAULT_MINOR:x} htb rate {_rate(total_mbps)}",
+                *(
+                    f"filter add dev {self.interface} parent {ROOT_HANDLE} protocol {protocol} prio {prio} u32"
+                    for protocol, prio, _ in FILTERS.values()
+                ),
+            ]
+        lines.append(
+            f"class replace dev {self.interface} parent {ROOT_HANDLE} classid {PARENT_CLASS} htb rate {_rate(total_mbps)}"
+        )
+        classes = dict(self.classes)
+        released: list[int] = []
+        for connection_id in removed:
+            entry = classes.pop(connection_id, None)
+            if entry is None:
+                continue
+            minor, address = entry
+            lines.append(self._filter("del", minor, address))
+            lines.append(f"class del dev {self.interface} classid 1:{minor:x}")
+            released.append(minor)
+        for connection_id, (address, mbps) in grants.items():
+            entry = classes.get(connection_id)
+            if entry is None:
+                minor = self._allocate_minor()
+            else:
+                minor = entry[0]
+            # ceil == rate: a grant is a cap, not a floor that may borrow idle bandwidth.
+            lines.append(
+                f"class replace dev {self.interface} parent {PARENT_CLASS} classid 1:{minor:x} "
+                f"htb rate {_rate(mbps)} ceil {_rate(mbps)}"
+            )
+            if entry is None or entry[1] != address:
+                if entry is not None:
+                    lines.append(self._filter("del", minor, entry[1]))
+                lines.append(self._filter("replace", minor, address))
+            classes[connection_id] = (minor, address)
+        try:
+            self.run_batch(lines)
+        except Exception:
+            # tc stops at the first failing line, so the kernel state is unknown: rebuild on the next update.
+            self.forget()
+            raise
+        self.classes = classes
+        self._ready = True
+        self._free_minors += released
+
+    def forget(self) -> None:
+        # The interface was torn down, taking its qdisc with it.
+        self.classes.clear()
+        self._free_minors.clear()
+        self._next_minor = FIRST_MINOR
+        self._ready = False
+
+
+class DryRunShaper(TcShaper):
+    def __init__(self, interface: str = "wg0") -> None:
+        super().__init__(interface)
+        self.batches: list[list[str]] = []
+
+    @property
+    def commands(self) -> list[str]:
+        return [line for batch in self.batches for line in batch]
+
+    def run_batch(self, lines: list[str]) -> None:
+        self.batches.append(list(lines))
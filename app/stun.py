@@ -0,0 +1,242 @@
+import os
+import socket
+import struct
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable
+
+# RFC 5389 message header: type, length, magic cookie, 96-bit transaction id.
+MAGIC_COOKIE = 0x2112A442
+BINDING_REQUEST = 0x0001
+BINDING_SUCCESS = 0x0101
+ATTR_MAPPED_ADDRESS = 0x0001
+ATTR_XOR_MAPPED_ADDRESS = 0x0020
+STUN_HEADER = struct.Struct("!HHI12s")
+DEFAULT_STUN_PORT = 3478
+
+_COOKIE_BYTES = MAGIC_COOKIE.to_bytes(4, "big")
+
+
+def binding_request(transaction_id: bytes) -> bytes:
+    return STUN_HEADER.pack(BINDING_REQUEST, 0, MAGIC_COOKIE, transaction_id)
+
+
+def binding_response(transaction_id: bytes, mapped: tuple[str, int]) -> bytes:
+    host, port = mapped
+    if ":" in host:
+        family, raw, mask = 0x02, socket.inet_pton(socket.AF_INET6, host), _COOKIE_BYTES + transaction_id
+    else:
+        family, raw, mask = 0x01, socket.inet_pton(socket.AF_INET, host), _COOKIE_BYTES
+    value = struct.pack("!BBH", 0, family, port ^ (MAGIC_COOKIE >> 16)) + bytes(a ^ b for a, b in zip(raw, mask))
+    attribute = struct.pack("!HH", ATTR_XOR_MAPPED_ADDRESS, len(value)) + value
+    return STUN_HEADER.pack(BINDING_SUCCESS, len(attribute), MAGIC_COOKIE, transaction_id) + attribute
+
+
+def _decode_address(value: bytes, transaction_id: bytes, xor: bool) -> tuple[str, int] | None:
+    if len(value) < 4:
+        return None
+    family = value[1]
+    port = struct.unpack("!H", value[2:4])[0]
+    if xor:
+        port ^= MAGIC_COOKIE >> 16
+    if family == 0x01 and len(value) >= 8:
+        raw = value[4:8]
+        if xor:
+            raw = bytes(a ^ b for a, b in zip(raw, _COOKIE_BYTES))
+        return socket.inet_ntop(socket.AF_INET, raw), port
+    if family == 0x02 and len(value) >= 20:
+        raw = value[4:20]
+        if xor:
+            raw = bytes(a ^ b for a, b in zip(raw, _COOKIE_BYTES + transaction_id))
+        return socket.inet_ntop(socket.AF_INET6, raw), port
+    return None
+
+
+def parse_binding_response(data: bytes, transaction_id: bytes) -> tuple[str, int] | None:
+    if len(data) < STUN_HEADER.size:
+        return None
+    msg_type, length, cookie, reply_id = STUN_HEADER.unpack_from(data)
+    if msg_type != BINDING_SUCCESS or cookie != MAGIC_COOKIE or reply_id != transaction_id:
+        return None
+    end = min(len(data), STUN_HEADER.size + length)
+    offset = STUN_HEADER.size
+    mapped = None
+    while offset + 4 <= end:
+        attr_type, attr_len = struct.unpack_from("!HH", data, offset)
+        value = data[offset + 4 : offset + 4 + attr_len]
+        if attr_type == ATTR_XOR_MAPPED_ADDRESS:
+            return _decode_address(value, reply_id, xor=True)
+        if attr_type == ATTR_MAPPED_ADDRESS and mapped is None:
+            # Pre-RFC 5389 servers only send the plain attribute.
+            mapped = _decode_address(value, reply_id, xor=False)
+        # Attributes are padded to a 4-byte boundary.
+        offset += 4 + attr_len + (-attr_len % 4)
+    return mapped
+
+
+def _resolve(server: str) -> tuple[str, int] | None:
+    host, _, port_text = server.rpartition(":")
+    if not host:
+        host, port_text = server, str(DEFAULT_STUN_PORT)
+    try:
+        infos = socket.getaddrinfo(host, int(port_text), socket.AF_INET, socket.SOCK_DGRAM)
+    except (OSError, ValueError):
+        return None
+    return infos[0][4][:2] if infos else None
+
+
+def query_mappings(
+    servers: list[str],
+    local_port: int = 0,
+    timeout: float = 2.0,
+    bind_host: str = "0.0.0.0",
+) -> tuple[int, dict[str, tuple[str, int]]]:
+    targets: dict[bytes, tuple[str, tuple[str, int]]] = {}
+    for server in servers:
+        address = _resolve(server)
+        if address is not None:
+            targets[os.urandom(12)] = (server, address)
+    results: dict[str, tuple[str, int]] = {}
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        try:
+            sock.bind((bind_host, local_port))
+        except OSError:
+            if not local_port:
+                raise
+            # The port is taken (e.g. by our own WireGuard listener): fall back to an ephemeral
+            # port, which still classifies the NAT but does not describe that port's mapping.
+            sock.bind((bind_host, 0))
+        bound_port = sock.getsockname()[1]
+        if not targets:
+            return bound_port, results
+
+        # One socket asks every server at once, so all mappings describe the same local port.
+        deadline = time.monotonic() + timeout
+        retransmit = 0.25
+        next_send = time.monotonic()
+        while len(results) < len(targets):
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            if now >= next_send:
+                for transaction_id, (server, address) in targets.items():
+                    if server not in results:
+                        try:
+                            sock.sendto(binding_request(transaction_id), address)
+                        except OSError:
+                            continue
+                next_send = now + retransmit
+                retransmit *= 2
+            sock.settimeout(max(min(next_send, deadline) - time.monotonic(), 0.001))
+            try:
+                data, _ = sock.recvfrom(2048)
+            except socket.timeout:
+                continue
+            except ConnectionRefusedError:
+                continue
+            if len(data) < STUN_HEADER.size:
+                continue
+            transaction_id = data[8:20]
+            target = targets.get(transaction_id)
+            if target is None or target[0] in results:
+                continue
+            mapped = parse_binding_response(data, transaction_id)
+            if mapped is not None:
+                results[target[0]] = mapped
+    return bound_port, results
+
+
+def classify_nat(mappings: list[tuple[str, int]], local_ip: str | None, local_port: int) -> str:
+    if not mappings:
+        return "blocked"
+    if local_ip and all(mapped == (local_ip, local_port) for mapped in mappings):
+        return "open"
+    if len(mappings) < 2:
+        return "unknown"
+    # Endpoint-independent mapping reuses one public ip:port for every destination; symmetric
+    # NAT allocates a new one per destination, so peers cannot reach the advertised port.
+    return "endpoint_independent" if len(set(mappings)) == 1 else "symmetric"
+
+
+@dataclass
+class NatDiscovery:
+    local_port: int
+    nat_type: str
+    mappings: dict[str, tuple[str, int]] = field(default_factory=dict)
+
+    @property
+    def mapped(self) -> tuple[str, int] | None:
+        return next(iter(self.mappings.values()), None)
+
+    @property
+    def mapped_ip(self) -> str | None:
+        return self.mapped[0] if self.mapped else None
+
+    @property
+    def mapped_port(self) -> int | None:
+        return self.mapped[1] if self.mapped else None
+
+
+def discover_nat(
+    servers: list[str],
+    local_port: int = 0,
+    local_ip: str | None = None,
+    timeout: float = 2.0,
+    bind_host: str = "0.0.0.0",
+) -> NatDiscovery:
+    bound_port, results = query_mappings(servers, local_port=local_port, timeout=timeout, bind_host=bind_host)
+    ordered = {server: results[server] for server in servers if server in results}
+    return NatDiscovery(
+        local_port=bound_port,
+        nat_type=classify_nat(list(ordered.values()), local_ip, bound_port),
+        mappings=ordered,
+    )
+
+
+class StunDetector:
+    def __init__(
+        self,
+        servers: list[str],
+        local_port: int = 0,
+        timeout: float = 2.0,
+        ttl_seconds: float = 300,
+        bind_host: str = "0.0.0.0",
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.servers = list(servers)
+        self.local_port = local_port
+        self.timeout = timeout
+        self.ttl_seconds = ttl_seconds
+        self.bind_host = bind_host
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._cached: tuple[NatDiscovery, str | None, float] | None = None
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._cached = None
+
+    def discover(self, local_ip: str | None) -> NatDiscovery | None:
+        with self._lock:
+            if self._cached is not None:
+                discovery, cached_local_ip, expires_at = self._cached
+                if cached_local_ip == local_ip and self.clock() < expires_at:
+                    return discovery
+            try:
+                discovery = discover_nat(
+                    self.servers,
+                    local_port=self.local_port,
+                    local_ip=local_ip,
+                    timeout=self.timeout,
+                    bind_host=self.bind_host,
+                )
+            except OSError:
+                self._cached = None
+                return None
+            if not discovery.mappings:
+                self._cached = None
+                return None
+            self._cached = (discovery, local_ip, self.clock() + self.ttl_seconds)
+            return discovery
+
@@ -0,0 +1,104 @@
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Callable
+
+from app.wireguard import Peer
+
+
+@dataclass(slots=True)
+class TransferRate:
+    at: float
+    rx_bytes: int
+    tx_bytes: int
+    rx_mbps: float
+    tx_mbps: float
+
+
+@dataclass(slots=True)
+class PeerTelemetry:
+    public_key: str
+    rx_bytes: int
+    tx_bytes: int
+    latest_handshake: int
+    sampled_at: float
+    history: deque
+
+    @property
+    def latest(self) -> TransferRate | None:
+        return self.history[-1] if self.history else None
+
+    def handshake_age(self, now: float) -> float | None:
+        return now - self.latest_handshake if self.latest_handshake else None
+
+
+class TunnelTelemetry:
+    def __init__(
+        self,
+        read_peers: Callable[[], dict[str, Peer]],
+        history: int = 60,
+        clock: Callable[[], float] = time.monotonic,
+        wall: Callable[[], float] = time.time,
+    ) -> None:
+        self.read_peers = read_peers
+        self.history = max(history, 1)
+        self.clock = clock
+        self.wall = wall
+        self._lock = threading.Lock()
+        self.peers: dict[str, PeerTelemetry] = {}
+
+    def sample(self) -> tuple[dict[str, PeerTelemetry], list[str]]:
+        transfers = self.read_peers()
+        now = self.clock()
+        with self._lock:
+            gone = [public_key for public_key in self.peers if public_key not in transfers]
+            for public_key in gone:
+                del self.peers[public_key]
+            for public_key, transfer in transfers.items():
+                peer = self.peers.get(public_key)
+                if peer is None:
+                    # The first sample is only a baseline; rates need two readings.
+                    self.peers[public_key] = PeerTelemetry(
+                        public_key,
+                        transfer.rx_bytes,
+                        transfer.tx_bytes,
+                        transfer.latest_handshake,
+                        now,
+                        deque(maxlen=self.history),
+                    )
+                    continue
+                elapsed = max(now - peer.sampled_at, 0.001)
+                # Counters restart from zero when the peer or interface is re-created.
+                rx = transfer.rx_bytes - peer.rx_bytes if transfer.rx_bytes >= peer.rx_bytes else transfer.rx_bytes
+                tx = transfer.tx_bytes - peer.tx_bytes if transfer.tx_bytes >= peer.tx_bytes else transfer.tx_bytes
+                peer.history.append(TransferRate(now, rx, tx, rx * 8 / elapsed / 1_000_000, tx * 8 / elapsed / 1_000_000))
+                peer.rx_bytes = transfer.rx_bytes
+                peer.tx_bytes = transfer.tx_bytes
+                peer.latest_handshake = transfer.latest_handshake
+                peer.sampled_at = now
+            return dict(self.peers), gone
+
+    def reset(self) -> list[str]:
+        with self._lock:
+            gone = list(self.peers)
+            self.peers.clear()
+            return gone
+
+    def snapshot(self) -> dict:
+        now = self.wall()
+        with self._lock:
+            peers = {}
+            for public_key, peer in self.peers.items():
+                latest = peer.latest
+                window = list(peer.history)
+                peers[public_key] = {
+                    "rx_bytes": peer.rx_bytes,
+                    "tx_bytes": peer.tx_bytes,
+                    "rx_mbps": round(latest.rx_mbps, 3) if latest else None,
+                    "tx_mbps": round(latest.tx_mbps, 3) if latest else None,
+                    "rx_mbps_avg": round(sum(r.rx_mbps for r in window) / len(window), 3) if window else None,
+                    "tx_mbps_avg": round(sum(r.tx_mbps for r in window) / len(window), 3) if window else None,
+                    "handshake_age_seconds": peer.handshake_age(now),
+                }
+            return peers
@@ -0,0 +1,172 @@
+import shutil
+import subprocess
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+# WireGuard drops session keys this long after their handshake (REJECT_AFTER_TIME); a live session
+# re-handshakes on its own only every two minutes or so.
+SESSION_LIFETIME_SECONDS = 180
+
+
+@dataclass
+class Peer:
+    public_key: str
+    allowed_ips: str = ""
+    endpoint: str | None = None
+    persistent_keepalive: int | None = None
+    latest_handshake: int = 0
+    rx_bytes: int = 0
+    tx_bytes: int = 0
+
+
+def _normalize_allowed_ips(value: str) -> frozenset[str]:
+    if value in ("", "(none)"):
+        return frozenset()
+    return frozenset(part.strip() for part in value.split(",") if part.strip())
+
+
+def parse_dump(output: str) -> dict[str, Peer]:
+    peers: dict[str, Peer] = {}
+    # First line describes the interface itself; every following line is one peer:
+    # public-key preshared-key endpoint allowed-ips latest-handshake rx tx keepalive
+    for line in output.splitlines()[1:]:
+        parts = line.split("\t")
+        if len(parts) < 8:
+            continue
+        public_key, _, endpoint, allowed_ips, handshake, rx, tx, keepalive = parts[:8]
+        peers[public_key] = Peer(
+            public_key=public_key,
+            allowed_ips=",".join(sorted(_normalize_allowed_ips(allowed_ips))),
+            endpoint=None if endpoint == "(none)" else endpoint,
+            persistent_keepalive=int(keepalive) if keepalive.isdigit() else None,
+            latest_handshake=int(handshake) if handshake.isdigit() else 0,
+            rx_bytes=int(rx) if rx.isdigit() else 0,
+            tx_bytes=int(tx) if tx.isdigit() else 0,
+        )
+    return peers
+
+
+def diff_peers(current: dict[str, Peer], desired: list[Peer], remove_others: bool = True) -> list[str]:
+    args: list[str] = []
+    wanted = {peer.public_key for peer in desired}
+    for peer in desired:
+        existing = current.get(peer.public_key)
+        changes: list[str] = []
+        if existing is None:
+            if peer.endpoint:
+                changes += ["endpoint", peer.endpoint]
+            if peer.allowed_ips:
+                changes += ["allowed-ips", peer.allowed_ips]
+            if peer.persistent_keepalive:
+                changes += ["persistent-keepalive", str(peer.persistent_keepalive)]
+            args += ["peer", peer.public_key, *changes]
+            continue
+        if peer.endpoint and existing.endpoint != peer.endpoint:
+            changes += ["endpoint", peer.endpoint]
+        if _normalize_allowed_ips(existing.allowed_ips) != _normalize_allowed_ips(peer.allowed_ips):
+            changes += ["allowed-ips", peer.allowed_ips]
+        if (peer.persistent_keepalive or None) != existing.persistent_keepalive:
+            changes += ["persistent-keepalive", str(peer.persistent_keepalive or 0)]
+        if changes:
+            args += ["peer", peer.public_key, *changes]
+    if remove_others:
+        for public_key in current:
+            if public_key not in wanted:
+                args += ["peer", public_key, "remove"]
+    return args
+
+
+class WireGuardInterface:
+    def __init__(
+        self,
+        name: str,
+        config_path: Path,
+        wg_cmd: str = "wg",
+        wg_quick_cmd: str = "wg-quick",
+        ip_cmd: str = "ip",
+        timeout: int = 5,
+    ) -> None:
+        self.name = name
+        self.config_path = config_path
+        self.wg_cmd = wg_cmd
+        self.wg_quick_cmd = wg_quick_cmd
+        self.ip_cmd = ip_cmd
+        self.timeout = timeout
+        self.is_up = False
+
+    def available(self) -> bool:
+        return shutil.which(self.wg_quick_cmd) is not None and shutil.which(self.wg_cmd) is not None
+
+    def _run(self, cmd: list[str], timeout: float | None = None) -> str:
+        proc = subprocess.run(cmd, capture_output=True, text=True, check=True, timeout=timeout or self.timeout)
+        return proc.stdout
+
+    def up(self) -> None:
+        # wg-quick also configures routes, DNS and firewall rules, so allow it more time than `wg`.
+        self._run([self.wg_quick_cmd, "up", str(self.config_path)], timeout=30)
+        self.is_up = True
+
+    def down(self) -> None:
+        try:
+            self._run([self.wg_quick_cmd, "down", str(self.config_path)], timeout=30)
+        finally:
+            self.is_up = False
+
+    def peers(self) -> dict[str, Peer]:
+        return parse_dump(self._run([self.wg_cmd, "show", self.name, "dump"]))
+
+    def latest_handshakes(self) -> dict[str, int]:
+        handshakes: dict[str, int] = {}
+        for line in self._run([self.wg_cmd, "show", self.name, "latest-handshakes"]).splitlines():
+            parts = line.strip().split()
+            if len(parts) == 2 and parts[1].isdigit():
+                handshakes[parts[0]] = int(parts[1])
+        return handshakes
+
+    def wait_for_handshake(
+        self,
+        public_key: str,
+        timeout: float,
+        after: int = 0,
+        min_interval: float = 0.05,
+        max_interval: float = 0.5,
+    ) -> float | None:
+        # Poll fast right after the peer is configured (handshakes usually land within one RTT),
+        # then back off so a slow or dead peer does not fork `wg` dozens of times per second.
+        started = time.monotonic()
+        deadline = started + timeout
+        interval = min_interval
+        while True:
+            try:
+                latest = self.latest_handshakes().get(public_key, 0)
+            except (subprocess.CalledProcessError, subprocess.TimeoutExpired, OSError):
+                latest = 0
+            now = time.monotonic()
+            if latest > after:
+                return now - started
+            remaining = deadline - now
+            if remaining <= 0:
+                return None
+            time.sleep(min(interval, remaining))
+            interval = min(interval * 1.5, max_interval)
+
+    def set_peers(self, desired: list[Peer], remove_others: bool = True) -> list[str]:
+        args = diff_peers(self.peers(), desired, remove_others=remove_others)
+        if args:
+            # All peer changes go out in one `wg set`, which the kernel applies as a single update.
+            self._run([self.wg_cmd, "set", self.name, *args])
+        return args
+
+    def remove_peers(self, public_keys: list[str]) -> None:
+        args: list[str] = []
+        for public_key in public_keys:
+            args += ["peer", public_key, "remove"]
+        if args:
+            self._run([self.wg_cmd, "set", self.name, *args])
+
+    def add_address(self, address: str) -> None:
+        self._run([self.ip_cmd, "address", "add", address, "dev", self.name])
+
+    def remove_address(self, address: str) -> None:
+        self._run([self.ip_cmd, "address", "del", address, "dev", self.name])
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# Record and scrape cost of app.metrics.Metrics with concurrent writers.
+# Usage: python scripts/bench_metrics.py [writers ...]   (default: 1 4 8)
+import sys
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from app.metrics import Metrics  # noqa: E402
+
+RECORDS_PER_WRITER = 100_000
+PEERS = 64
+SCRAPE_INTERVAL = 0.005
+
+
+class GlobalLockMetrics:
+    # The previous layout (one lock for every write, a full re-render per scrape), kept here only as a baseline.
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._counters: dict[tuple, float] = {}
+
+    def inc(self, name: str, value: int = 1, labels: dict[str, str] | None = None) -> None:
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def render_prometheus(self) -> str:
+        with self._lock:
+            lines = []
+            for (name, labels), value in sorted(self._counters.items()):
+                rendered = ",".join(f'{k}="{v}"' for k, v in labels)
+                lines.append(f"{name}{{{rendered}}} {value}" if labels else f"{name} {value}")
+            return "\n".join(lines) + "\n"
+
+
+def run(metrics, writers: int) -> tuple[float, float, int]:
+    # Writers record labeled counters while a scraper polls every few milliseconds.
+    done = threading.Event()
+    scrapes: list[float] = []
+    labels = [{"peer": f"peer-{index}"} for index in range(PEERS)]
+
+    def writer() -> None:
+        for index in range(RECORDS_PER_WRITER):
+            metrics.inc("dvpn_peer_rx_bytes_total", 1500, labels[index % PEERS])
+
+    def scraper() -> None:
+        while not done.is_set():
+            started = time.perf_counter()
+            metrics.render_prometheus()
+            scrapes.append(time.perf_counter() - started)
+            time.sleep(SCRAPE_INTERVAL)
+
+    threads = [threading.Thread(target=writer) for _ in range(writers)]
+    scrape_thread = threading.Thread(target=scraper)
+    scrape_thread.start()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    done.set()
+    scrape_thread.join()
+    record_ns = elapsed / (writers * RECORDS_PER_WRITER) * 1e9
+    scrapes.sort()
+    return record_ns, scrapes[len(scrapes) // 2] * 1000 if scrapes else 0.0, len(scrapes)
+
+
+def idle_scrape_ms(metrics, scrapes: int = 200) -> float:
+    metrics.render_prometheus()
+    started = time.perf_counter()
+    for _ in range(scrapes):
+        metrics.render_prometheus()
+    return (time.perf_counter() - started) / scrapes * 1000
+
+
+def main() -> None:
+    counts = [int(arg) for arg in sys.argv[1:]] or [1, 4, 8]
+    print(f"{'writers':>7} {'layout':>12} {'record ns':>10} {'scrape p50 ms':>14} {'scrapes':>8} {'idle scrape ms':>15}")
+    for writers in counts:
+        for label, factory in (("global-lock", GlobalLockMetrics), ("sharded", Metrics)):
+            metrics = factory()
+            record_ns, scrape_ms, scrapes = run(metrics, writers)
+            print(
+                f"{writers:>7} {label:>12} {record_ns:>10.0f} {scrape_ms:>14.3f} {scrapes:>8} "
+                f"{idle_scrape_ms(metrics):>15.4f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
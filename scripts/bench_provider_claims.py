@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# Compare provider claim admission: one claim per request vs batched claims applied with one
+# `wg set`, and fixed-interval polling vs long-poll latency. Runs against the in-process mock
+# orchestrator and the fake `wg` from tests/fixtures (one fork per call, like the real tool).
+# Usage: python scripts/bench_provider_claims.py [claim_count] [poll_interval_seconds]
+import importlib.util
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from app.pool import PoolClient  # noqa: E402
+from app.wireguard import Peer, WireGuardInterface  # noqa: E402
+
+FAKE_WG = str(ROOT / "tests" / "fixtures" / "fake_wg.py")
+PROVIDER_ID = "bench-node"
+
+
+def load_mock():
+    spec = importlib.util.spec_from_file_location("mock_orchestrator", ROOT / "scripts" / "mock_orchestrator.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.Handler.log_message = lambda *args: None
+    return module
+
+
+def make_claim(index: int) -> dict:
+    return {
+        "lease_nonce": f"{index:032x}",
+        "lease_exp": (time.time() + 600) * 1000,
+        "client_ip": f"10.{66 + (index >> 16)}.{(index >> 8) & 255}.{index & 255}/32",
+        "client_public_key": f"{index:043d}=",
+        "queued_at": time.monotonic(),
+    }
+
+
+def apply(wg: WireGuardInterface, claims: list[dict], admitted: list[float]) -> None:
+    if not claims:
+        return
+    wg.set_peers([Peer(c["client_public_key"], c["client_ip"], persistent_keepalive=25) for c in claims], remove_others=False)
+    now = time.monotonic()
+    admitted.extend(now - c["queued_at"] for c in claims)
+
+
+def drain_one_per_request(client: PoolClient, wg: WireGuardInterface, count: int, admitted: list[float]) -> None:
+    while len(admitted) < count:
+        claim = client.fetch_next_claim(PROVIDER_ID)
+        apply(wg, [claim] if claim else [], admitted)
+
+
+def drain_batched(client: PoolClient, wg: WireGuardInterface, count: int, admitted: list[float]) -> None:
+    while len(admitted) < count:
+        apply(wg, client.fetch_claims(PROVIDER_ID, limit=32), admitted)
+
+
+def throughput(mock, client: PoolClient, wg: WireGuardInterface, name: str, drain, count: int) -> None:
+    for index in range(count):
+        mock.CLAIMS.push(PROVIDER_ID, make_claim(index))
+    admitted: list[float] = []
+    started = time.perf_counter()
+    drain(client, wg, count, admitted)
+    elapsed = time.perf_counter() - started
+    print(f"{name:<22} claims={count} time={elapsed:.2f}s rate={count / elapsed:.1f} claims/s")
+
+
+def latency(mock, client: PoolClient, wg: WireGuardInterface, name: str, poll_interval: float | None, count: int) -> None:
+    # Claims trickle in at random; measure how long each waits before its peer is configured.
+    def produce() -> None:
+        for index in range(count):
+            time.sleep(random.uniform(0, 0.2))
+            mock.CLAIMS.push(PROVIDER_ID, make_claim(index))
+
+    admitted: list[float] = []
+    producer = threading.Thread(target=produce)
+    producer.start()
+    while len(admitted) < count:
+        if poll_interval is None:
+            apply(wg, client.fetch_claims(PROVIDER_ID, limit=32, wait_seconds=5), admitted)
+        else:
+            claim = client.fetch_next_claim(PROVIDER_ID)
+            apply(wg, [claim] if claim else [], admitted)
+            time.sleep(poll_interval)
+    producer.join()
+    admitted.sort()
+    p50 = admitted[len(admitted) // 2]
+    p95 = admitted[min(len(admitted) - 1, int(len(admitted) * 0.95))]
+    print(f"{name:<22} claims={count} p50={p50 * 1000:.0f}ms p95={p95 * 1000:.0f}ms")
+
+
+def main() -> None:
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    poll_interval = float(sys.argv[2]) if len(sys.argv) > 2 else 3.0
+    mock = load_mock()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), mock.Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = PoolClient(f"http://127.0.0.1:{server.server_address[1]}/providers", timeout=10, pool_token="bench")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["FAKE_WG_STATE"] = str(Path(tmp) / "state.json")
+        wg = WireGuardInterface("wg0", Path(tmp) / "wg0.conf", wg_cmd=FAKE_WG, wg_quick_cmd=FAKE_WG, ip_cmd=FAKE_WG)
+        wg.up()
+        throughput(mock, client, wg, "one claim per request", drain_one_per_request, count)
+        throughput(mock, client, wg, "batched (32)", drain_batched, count)
+        print(f"{'':<22} (the old standby loop also slept 3s per claim: at most {1 / 3:.2f} claims/s)")
+        samples = min(count, 20)
+        latency(mock, client, wg, f"poll every {poll_interval:g}s", poll_interval, samples)
+        latency(mock, client, wg, "long-poll", None, samples)
+    client.session.close()
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
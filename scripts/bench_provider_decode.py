@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# Compare whole-body json.loads against the streaming provider decoder on a synthetic pool.
+# Usage: python scripts/bench_provider_decode.py [provider_count]
+import io
+import json
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from app.jsonstream import decode_stream  # noqa: E402
+from app.pool import PoolClient, _provider_from_item  # noqa: E402
+
+KEY = "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA="
+
+
+def synthetic_payload(count: int) -> bytes:
+    items = [
+        {
+            "id": f"node-{i}",
+            "endpoint": f"203.0.{(i >> 8) & 255}.{i & 255}:51820",
+            "public_key": KEY,
+            "allowed_ips": "0.0.0.0/0,::/0",
+            "health": "ok" if i % 50 else "down",
+            "client_ip": f"10.66.{(i >> 8) & 255}.{i & 255}/32",
+            "lease_nonce": f"{i:032x}",
+            "lease_exp": 1_900_000_000_000,
+            "lease_sig": "s" * 64,
+        }
+        for i in range(count)
+    ]
+    return json.dumps(items).encode("utf-8")
+
+
+def whole_body(payload: bytes) -> int:
+    response = io.BytesIO(payload)
+    raw = json.loads(response.read().decode("utf-8"))
+    providers = [_provider_from_item(item) for item in raw if item.get("health") in (None, "ok")]
+    return len(providers)
+
+
+def streaming(payload: bytes) -> int:
+    response = io.BytesIO(payload)
+    items, _ = decode_stream(response.read)
+    providers: dict = {}
+    PoolClient._apply_provider_items(providers, items)
+    return len(providers)
+
+
+def measure(name: str, fn, payload: bytes) -> None:
+    tracemalloc.start()
+    started = time.perf_counter()
+    count = fn(payload)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:<12} providers={count} time={elapsed:.3f}s peak_extra={peak / 1_000_000:.1f}MB")
+
+
+def main() -> None:
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    payload = synthetic_payload(count)
+    print(f"payload={len(payload) / 1_000_000:.1f}MB providers={count}")
+    measure("whole_body", whole_body, payload)
+    measure("streaming", streaming, payload)
+
+
+if __name__ == "__main__":
+    main()
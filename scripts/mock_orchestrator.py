@@ -2,7 +2,11 @@ import json
 import os
 import random
 import ssl
+import threading
+import time
+from collections import deque
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
 
 REQUIRED_WALLET = "1MUss4jmaRJ2sMtS9gyZqeRw8WrhWTsrxn"
 REQUIRED_INTERVAL = "monthly"
@@ -16,6 +20,91 @@ ENDPOINTS = [
 REGISTERED_NODES: dict[str, dict] = {}
 
 
+# Versioned provider list backing ETag revalidation and `since=` deltas for PoolClient.
+class ProviderRegistry:
+    def __init__(self, max_tombstones: int = 4096) -> None:
+        self.lock = threading.Lock()
+        self.version = 0
+        self.providers: dict[str, tuple[int, dict]] = {}
+        self.removed: dict[str, int] = {}
+        self.max_tombstones = max_tombstones
+        # Deltas older than this cursor cannot be served because their tombstones were dropped.
+        self.oldest_cursor = 0
+
+    def upsert(self, provider: dict) -> None:
+        with self.lock:
+            self.version += 1
+            self.providers[str(provider["id"])] = (self.version, provider)
+            self.removed.pop(str(provider["id"]), None)
+
+    def remove(self, provider_id: str) -> None:
+        with self.lock:
+            if self.providers.pop(provider_id, None) is None:
+                return
+            self.version += 1
+            self.removed[provider_id] = self.version
+            if len(self.removed) > self.max_tombstones:
+                oldest = min(self.removed, key=self.removed.get)
+                self.oldest_cursor = self.removed.pop(oldest)
+
+    def etag(self) -> str:
+        return f'"v{self.version}"'
+
+    def snapshot(self, since: int | None) -> tuple[int, dict | list]:
+        with self.lock:
+            if since is None or since < self.oldest_cursor or since > self.version:
+                return self.version, [provider for _, provider in self.providers.values()]
+            return self.version, {
+                "delta": True,
+                "cursor": self.version,
+                "providers": [provider for version, provider in self.providers.values() if version > since],
+                "removed": [provider_id for provider_id, version in self.removed.items() if version > since],
+            }
+
+
+# Approved client claims per provider. Long-polling takers wait on the condition, so a claim is
+# handed to a waiting provider as soon as /approve queues it.
+class ClaimQueue:
+    def __init__(self, max_per_provider: int = 1024) -> None:
+        self.cond = threading.Condition()
+        self.claims: dict[str, deque] = {}
+        self.max_per_provider = max_per_provider
+
+    def push(self, provider_id: str, claim: dict) -> None:
+        with self.cond:
+            self.claims.setdefault(provider_id, deque(maxlen=self.max_per_provider)).append(claim)
+            self.cond.notify_all()
+
+    def _pop(self, provider_id: str, limit: int) -> list[dict]:
+        queue = self.claims.get(provider_id)
+        now_ms = time.time() * 1000
+        taken: list[dict] = []
+        while queue and len(taken) < limit:
+            claim = queue.popleft()
+            if float(claim.get("lease_exp") or 0) > now_ms:
+                taken.append(claim)
+        return taken
+
+    def take(self, provider_id: str, limit: int, wait_seconds: float = 0.0) -> list[dict]:
+        deadline = time.monotonic() + wait_seconds
+        with self.cond:
+            while True:
+                taken = self._pop(provider_id, limit)
+                remaining = deadline - time.monotonic()
+                if taken or remaining <= 0:
+                    return taken
+                self.cond.wait(remaining)
+
+
+PROVIDERS = ProviderRegistry()
+for _index, _endpoint in enumerate(ENDPOINTS):
+    PROVIDERS.upsert({"id": f"mock-{_index}", "endpoint": _endpoint, "public_key": PUBLIC_KEY, "allowed_ips": "0.0.0.0/0,::/0", "health": "ok"})
+
+CLAIMS = ClaimQueue()
+MAX_CLAIM_BATCH = 256
+MAX_CLAIM_WAIT_SECONDS = 30.0
+
+
 class Handler(BaseHTTPRequestHandler):
     def _read_json(self) -> dict:
         size = int(self.headers.get("Content-Length", "0"))
@@ -30,7 +119,35 @@ class Handler(BaseHTTPRequestHandler):
         self.end_headers()
         self.wfile.write(data)
 
+    def _send_providers(self) -> None:
+        parts = urlsplit(self.path)
+        since_values = parse_qs(parts.query).get("since", [])
+        since = int(since_values[0]) if since_values and since_values[0].isdigit() else None
+        etag = PROVIDERS.etag()
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        cursor, payload = PROVIDERS.snapshot(since)
+        content_type = "application/json"
+        if isinstance(payload, list) and "application/x-ndjson" in self.headers.get("Accept", ""):
+            content_type = "application/x-ndjson"
+            data = b"".join(json.dumps(item).encode("utf-8") + b"\n" for item in payload)
+        else:
+            data = json.dumps(payload).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("ETag", etag)
+        self.send_header("X-DVPN-Cursor", str(cursor))
+        self.end_headers()
+        self.wfile.write(data)
+
     def do_GET(self) -> None:
+        if urlsplit(self.path).path == "/providers":
+            self._send_providers()
+            return
         if self.path == "/portal":
             self.send_response(200)
             self.send_header("Content-Type", "text/html; charset=utf-8")
@@ -83,7 +200,40 @@ class Handler(BaseHTTPRequestHandler):
                 },
             )
             return
-        if self.path == "/register":
+        if self.path in ("/approve", "/providers/approve"):
+            body = self._read_json()
+            if not body.get("provider_id") or not body.get("lease_nonce") or not body.get("client_ip"):
+                self._send(400, {"error": "lease_fields_required"})
+                return
+            # Leases are not signature-checked here; clients that send their key get a claim queued.
+            if body.get("client_public_key"):
+                CLAIMS.push(
+                    str(body["provider_id"]),
+                    {
+                        "lease_nonce": str(body["lease_nonce"]),
+                        "lease_exp": body.get("lease_exp") or int((time.time() + 300) * 1000),
+                        "client_ip": str(body["client_ip"]),
+                        "client_public_key": str(body["client_public_key"]).strip(),
+                        "created_at": int(time.time() * 1000),
+                    },
+                )
+            self._send(200, {"ok": True, "approved": True})
+            return
+        if self.path in ("/claim/next", "/providers/claim/next", "/claim/batch", "/providers/claim/batch"):
+            body = self._read_json()
+            provider_id = str(body.get("provider_id") or "").strip()
+            if not provider_id:
+                self._send(400, {"ok": False, "error": "provider_id_required"})
+                return
+            if self.path.endswith("/next"):
+                taken = CLAIMS.take(provider_id, 1)
+                self._send(200, {"ok": True, "claim": taken[0] if taken else None})
+                return
+            limit = min(max(int(body.get("max") or 1), 1), MAX_CLAIM_BATCH)
+            wait_seconds = min(max(float(body.get("wait_ms") or 0) / 1000, 0.0), MAX_CLAIM_WAIT_SECONDS)
+            self._send(200, {"ok": True, "claims": CLAIMS.take(provider_id, limit, wait_seconds)})
+            return
+        if self.path in ("/register", "/providers/register"):
             body = self._read_json()
             node_id = body.get("id")
             endpoint = body.get("endpoint")
@@ -92,6 +242,16 @@ class Handler(BaseHTTPRequestHandler):
                 self._send(400, {"error": "id, endpoint, public_key are required"})
                 return
             REGISTERED_NODES[str(node_id)] = body
+            PROVIDERS.upsert(
+                {
+                    "id": str(node_id),
+                    "endpoint": endpoint,
+                    "public_key": public_key,
+                    "allowed_ips": body.get("allowed_ips", "0.0.0.0/0,::/0"),
+                    "health": "ok",
+                    "meta": body.get("metadata", {}),
+                }
+            )
             self._send(200, {"ok": True, "node_id": node_id, "registered": len(REGISTERED_NODES)})
             return
         self.send_error(404)
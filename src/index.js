@@ -212,6 +212,19 @@ function pruneClaims(claims) {
   return claims.filter((c) => Number(c?.lease_exp || 0) > now);
 }
 
+const MAX_CLAIM_BATCH = 32;
+
+// KV has no change notifications, so holding the request open would mean re-reading the claim
+// list in a loop. The worker answers at once instead and ignores wait_ms; the provider waits out
+// the rest of its poll interval before asking again, which costs one KV read per interval.
+async function takeClaims(env, providerId, max) {
+  const claims = pruneClaims(await loadClaims(env, providerId));
+  if (claims.length === 0) return [];
+  const taken = claims.splice(0, max);
+  await saveClaims(env, providerId, claims);
+  return taken;
+}
+
 function parseEndpoint(endpoint) {
   try {
     const parsed = new URL(`udp://${endpoint}`);
@@ -318,6 +331,7 @@ export default {
           "POST /providers/register",
           "POST /providers/prune",
           "POST /providers/claim/next",
+          "POST /providers/claim/batch",
           "POST /verify",
           "POST /verify/checkout/start",
           "POST /verify/checkout/status",
@@ -444,6 +458,24 @@ export default {
       return json({ ok: true, claim });
     }
 
+    if (request.method === "POST" && path === "/providers/claim/batch") {
+      const gate = poolAccessAllowed(request, env);
+      if (!gate.ok) return json({ ok: false, error: gate.error }, gate.code);
+      let body = {};
+      try {
+        body = await request.json();
+      } catch {
+        return json({ ok: false, error: "invalid_json" }, 400);
+      }
+      const providerId = String(body.provider_id || "").trim();
+      if (!providerId) {
+        return json({ ok: false, error: "provider_id_required" }, 400);
+      }
+      const max = Math.min(Math.max(Math.trunc(Number(body.max) || 1), 1), MAX_CLAIM_BATCH);
+      const claims = await takeClaims(env, providerId, max);
+      return json({ ok: true, claims });
+    }
+
     if (request.method === "POST" && path === "/verify") {
       let body = {};
       try {
@@ -0,0 +1,60 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+CHUNK = b"\0" * 16384
+
+
+class ByteSource:
+    # Local HTTP server streaming zero bytes, each connection paced to `rate` bytes/second.
+    def __init__(self, rate: float, size: int = 1 << 30) -> None:
+        self.rate = rate
+        self.size = size
+        self.connections = 0
+        self.server: ThreadingHTTPServer | None = None
+
+    @property
+    def url(self) -> str:
+        assert self.server is not None
+        return f"http://127.0.0.1:{self.server.server_address[1]}/bytes"
+
+    def start(self) -> None:
+        source = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                query = parse_qs(urlsplit(self.path).query)
+                size = int(query.get("size", [source.size])[0])
+                source.connections += 1
+                self.send_response(200)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Content-Length", str(size))
+                self.end_headers()
+                # The rate is fixed per connection so changing it only affects new streams.
+                rate = source.rate
+                started = time.monotonic()
+                sent = 0
+                try:
+                    while sent < size:
+                        chunk = CHUNK[: min(len(CHUNK), size - sent)]
+                        self.wfile.write(chunk)
+                        sent += len(chunk)
+                        ahead = sent / rate - (time.monotonic() - started)
+                        if ahead > 0:
+                            time.sleep(ahead)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def log_message(self, *args) -> None:
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self) -> None:
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
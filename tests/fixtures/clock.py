@@ -0,0 +1,7 @@
+class FakeClock:
+    # Callable stand-in for time.time/time.monotonic; tests move `now` by hand.
+    def __init__(self, now: float = 1_000_000.0) -> None:
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
@@ -0,0 +1,168 @@
+import socket
+import struct
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import xml.etree.ElementTree as ET
+
+SERVICE_TYPE = "urn:schemas-upnp-org:service:WANIPConnection:1"
+
+
+class FakeIGD:
+    # SSDP responder plus device description and SOAP control endpoint of a UPnP IGD.
+    def __init__(self, external_ip: str = "203.0.113.7", permanent_only: bool = False) -> None:
+        self.external_ip = external_ip
+        self.permanent_only = permanent_only
+        self.mappings: dict[tuple[int, str], dict[str, str]] = {}
+        self.actions: list[str] = []
+        self.searches = 0
+        self.fail = False
+        igd = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/rootDesc.xml":
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = (
+                    '<?xml version="1.0"?><root xmlns="urn:schemas-upnp-org:device-1-0"><device>'
+                    "<deviceType>urn:schemas-upnp-org:device:InternetGatewayDevice:1</deviceType>"
+                    "<deviceList><device><deviceList><device><serviceList><service>"
+                    f"<serviceType>{SERVICE_TYPE}</serviceType>"
+                    "<controlURL>/ctl/IPConn</controlURL>"
+                    "</service></serviceList></device></deviceList></device></deviceList>"
+                    "</device></root>"
+                ).encode("utf-8")
+                self.reply(200, body)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", "0"))
+                envelope = ET.fromstring(self.rfile.read(length))
+                call = next(element for element in envelope.iter() if element.tag.startswith("{" + SERVICE_TYPE))
+                action = call.tag.rsplit("}", 1)[-1]
+                args = {child.tag: (child.text or "") for child in call}
+                igd.actions.append(action)
+                if igd.fail:
+                    self.fault(501)
+                    return
+                if action == "AddPortMapping":
+                    if igd.permanent_only and args["NewLeaseDuration"] != "0":
+                        self.fault(725)
+                        return
+                    igd.mappings[(int(args["NewExternalPort"]), args["NewProtocol"])] = args
+                    self.respond(action, "")
+                elif action == "DeletePortMapping":
+                    igd.mappings.pop((int(args["NewExternalPort"]), args["NewProtocol"]), None)
+                    self.respond(action, "")
+                elif action == "GetExternalIPAddress":
+                    self.respond(action, f"<NewExternalIPAddress>{igd.external_ip}</NewExternalIPAddress>")
+                else:
+                    self.fault(401)
+
+            def respond(self, action: str, inner: str) -> None:
+                body = (
+                    '<?xml version="1.0"?><s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/"><s:Body>'
+                    f'<u:{action}Response xmlns:u="{SERVICE_TYPE}">{inner}</u:{action}Response>'
+                    "</s:Body></s:Envelope>"
+                ).encode("utf-8")
+                self.reply(200, body)
+
+            def fault(self, code: int) -> None:
+                body = (
+                    '<?xml version="1.0"?><s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/"><s:Body>'
+                    "<s:Fault><detail><UPnPError xmlns=\"urn:schemas-upnp-org:control-1-0\">"
+                    f"<errorCode>{code}</errorCode><errorDescription>fake</errorDescription>"
+                    "</UPnPError></detail></s:Fault></s:Body></s:Envelope>"
+                ).encode("utf-8")
+                self.reply(500, body)
+
+            def reply(self, status: int, body: bytes) -> None:
+                self.send_response(status)
+                self.send_header("Content-Type", "text/xml")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                return
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.ssdp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.ssdp.bind(("127.0.0.1", 0))
+        self.ssdp.settimeout(0.2)
+        self._stop = threading.Event()
+        self.threads = [
+            threading.Thread(target=self.httpd.serve_forever, daemon=True),
+            threading.Thread(target=self._serve_ssdp, daemon=True),
+        ]
+
+    @property
+    def ssdp_address(self) -> tuple[str, int]:
+        return self.ssdp.getsockname()
+
+    def _serve_ssdp(self) -> None:
+        location = f"http://127.0.0.1:{self.httpd.server_address[1]}/rootDesc.xml"
+        while not self._stop.is_set():
+            try:
+                data, addr = self.ssdp.recvfrom(2048)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            if data.startswith(b"M-SEARCH"):
+                self.searches += 1
+                reply = f"HTTP/1.1 200 OK\r\nST: urn:schemas-upnp-org:device:InternetGatewayDevice:1\r\nLOCATION: {location}\r\n\r\n"
+                self.ssdp.sendto(reply.encode("ascii"), addr)
+
+    def start(self) -> "FakeIGD":
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.ssdp.close()
+
+
+class FakeNatPmp:
+    # NAT-PMP gateway that maps every request to `external_port` (or the suggested port).
+    def __init__(self, external_port: int | None = None, lifetime: int | None = None) -> None:
+        self.external_port = external_port
+        self.lifetime = lifetime
+        self.requests: list[tuple[int, int, int]] = []
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.settimeout(0.2)
+        self._stop = threading.Event()
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+
+    @property
+    def port(self) -> int:
+        return self.sock.getsockname()[1]
+
+    def _serve(self) -> None:
+        while not self._stop.is_set():
+            try:
+                data, addr = self.sock.recvfrom(64)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            if len(data) != 12:
+                continue
+            _, opcode, _, internal, suggested, lifetime = struct.unpack("!BBHHHI", data)
+            self.requests.append((internal, suggested, lifetime))
+            external = 0 if lifetime == 0 else (self.external_port or suggested)
+            granted = 0 if lifetime == 0 else (self.lifetime or lifetime)
+            self.sock.sendto(struct.pack("!BBHIHHI", 0, 128 + opcode, 0, 1, internal, external, granted), addr)
+
+    def start(self) -> "FakeNatPmp":
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        self.thread.join(timeout=1)
+        self.sock.close()
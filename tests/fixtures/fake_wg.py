@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""Stand-in for `wg` / `wg-quick` that keeps interface state in a JSON file.
+
+Every invocation is appended to FAKE_WG_LOG so tests can assert on the exact commands.
+A `set` naming any key listed in FAKE_WG_REJECT fails without changing anything.
+Handshakes are stamped when a peer is added or its endpoint changes, and then stay put the way a
+live WireGuard session does between rekeys.
+"""
+import json
+import os
+import sys
+import time
+
+STATE_PATH = os.environ["FAKE_WG_STATE"]
+LOG_PATH = os.environ.get("FAKE_WG_LOG", "")
+REJECT = set(filter(None, os.environ.get("FAKE_WG_REJECT", "").split(",")))
+
+
+def load() -> dict:
+    try:
+        with open(STATE_PATH) as handle:
+            return json.load(handle)
+    except FileNotFoundError:
+        return {"up": False, "peers": {}, "addresses": []}
+
+
+def save(state: dict) -> None:
+    with open(STATE_PATH, "w") as handle:
+        json.dump(state, handle)
+
+
+def main(argv: list[str]) -> int:
+    if LOG_PATH:
+        with open(LOG_PATH, "a") as handle:
+            handle.write(json.dumps(argv) + "\n")
+    state = load()
+    if argv[:1] in (["up"], ["down"]):
+        state["up"] = argv[0] == "up"
+        if not state["up"]:
+            state["peers"] = {}
+        save(state)
+        return 0
+    if argv[:1] == ["address"]:
+        action, address = argv[1], argv[2]
+        if action == "add":
+            state["addresses"].append(address)
+        elif address in state["addresses"]:
+            state["addresses"].remove(address)
+        save(state)
+        return 0
+    if argv[:1] == ["show"] and len(argv) == 3:
+        if not state["up"]:
+            print("Unable to access interface: No such device", file=sys.stderr)
+            return 1
+        if argv[2] == "dump":
+            print("PRIVATE\tPUBLIC\t51820\toff")
+            for key, peer in state["peers"].items():
+                handshake = peer.get("handshake", 0)
+                print(
+                    "\t".join(
+                        [
+                            key,
+                            "(none)",
+                            peer.get("endpoint") or "(none)",
+                            peer.get("allowed_ips") or "(none)",
+                            str(handshake),
+                            str(peer.get("rx", 0)),
+                            str(peer.get("tx", 0)),
+                            str(peer.get("keepalive") or "off"),
+                        ]
+                    )
+                )
+        elif argv[2] == "latest-handshakes":
+            for key, peer in state["peers"].items():
+                print(f"{key}\t{peer.get('handshake', 0)}")
+        return 0
+    if argv[:1] == ["set"]:
+        args = argv[2:]
+        if REJECT.intersection(args):
+            return 1
+        index = 0
+        while index < len(args):
+            if args[index] != "peer":
+                return 1
+            key = args[index + 1]
+            index += 2
+            peer = state["peers"].setdefault(key, {})
+            while index < len(args) and args[index] != "peer":
+                option = args[index]
+                if option == "remove":
+                    state["peers"].pop(key, None)
+                    index += 1
+                    continue
+                value = args[index + 1]
+                if option == "endpoint":
+                    if peer.get("endpoint") != value:
+                        peer["handshake"] = int(time.time())
+                    peer["endpoint"] = value
+                elif option == "allowed-ips":
+                    peer["allowed_ips"] = value
+                elif option == "persistent-keepalive":
+                    peer["keepalive"] = int(value) if value not in ("0", "off") else None
+                index += 2
+        save(state)
+        return 0
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
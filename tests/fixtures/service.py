@@ -0,0 +1,26 @@
+from pathlib import Path
+
+FAKE_WG = str(Path(__file__).resolve().parent / "fake_wg.py")
+
+
+def service_environ(tmp: str) -> dict[str, str]:
+    # Keeps DVPNService's state files under `tmp` and its pool/payment calls off the network.
+    return {
+        "POOL_URL": "https://pool.invalid/providers",
+        "PAYMENT_API_URL": "https://pay.invalid/verify",
+        "TOKEN_STORE_PATH": str(Path(tmp) / "token.store"),
+        "SCOREBOARD_PATH": str(Path(tmp) / "scores.json"),
+        "WG_CONFIG_PATH": str(Path(tmp) / "wg0.conf"),
+    }
+
+
+def fake_wg_environ(tmp: str, log: Path | None = None) -> dict[str, str]:
+    # service_environ plus fake_wg in place of wg/wg-quick, with its state in `tmp`/state.json.
+    environ = service_environ(tmp) | {
+        "FAKE_WG_STATE": str(Path(tmp) / "state.json"),
+        "WG_CMD": FAKE_WG,
+        "WG_QUICK_CMD": FAKE_WG,
+    }
+    if log is not None:
+        environ["FAKE_WG_LOG"] = str(log)
+    return environ
@@ -0,0 +1,72 @@
+import socket
+import threading
+from typing import Callable
+
+from app.stun import BINDING_REQUEST, MAGIC_COOKIE, STUN_HEADER, binding_response
+
+
+class StunResponder:
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        mapped: Callable[[tuple[str, int]], tuple[str, int]] | None = None,
+    ) -> None:
+        self.host = host
+        self.port = port
+        # Reports the sender's address by default; `mapped` simulates NAT rewriting.
+        self.mapped = mapped
+        self.requests = 0
+        self.sock: socket.socket | None = None
+        self.thread: threading.Thread | None = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    @property
+    def address(self) -> str:
+        return f"{self.host}:{self.port}"
+
+    def start(self) -> None:
+        if self.running:
+            return
+        sock = socket.socket(socket.AF_INET6 if ":" in self.host else socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((self.host, self.port))
+        sock.settimeout(0.5)
+        self.port = sock.getsockname()[1]
+        self.sock = sock
+        self._stop.clear()
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    def _serve(self) -> None:
+        assert self.sock is not None
+        while not self._stop.is_set():
+            try:
+                data, addr = self.sock.recvfrom(2048)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            if len(data) < STUN_HEADER.size:
+                continue
+            msg_type, _, cookie, transaction_id = STUN_HEADER.unpack_from(data)
+            if msg_type != BINDING_REQUEST or cookie != MAGIC_COOKIE:
+                continue
+            self.requests += 1
+            source = (addr[0], addr[1])
+            try:
+                self.sock.sendto(binding_response(transaction_id, self.mapped(source) if self.mapped else source), addr)
+            except OSError:
+                continue
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self.thread is not None:
+            self.thread.join(timeout=2)
+            self.thread = None
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
@@ -0,0 +1,172 @@
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+from app.audit import LogPipeline, RingSink, RotatingFileSink, StdoutSink
+from app.main import DVPNService
+from fixtures.service import service_environ
+
+
+class RecordingSink:
+    def __init__(self) -> None:
+        self.batches: list[list[str]] = []
+
+    def write(self, records) -> None:
+        self.batches.append([record.message for record in records])
+
+
+class GatedSink(RecordingSink):
+    # Blocks the writer thread inside its first write until released.
+    def __init__(self) -> None:
+        super().__init__()
+        self.entered = threading.Event()
+        self.release = threading.Event()
+
+    def write(self, records) -> None:
+        self.entered.set()
+        self.release.wait(5)
+        super().write(records)
+
+
+class BrokenSink:
+    def write(self, records) -> None:
+        raise OSError("disk full")
+
+
+class TestLogPipeline(unittest.TestCase):
+    def test_records_reach_every_sink_in_batches(self):
+        sink = RecordingSink()
+        stream = io.StringIO()
+        pipeline = LogPipeline([sink, StdoutSink("json", stream=stream)], flush_interval=5)
+        for index in range(10):
+            pipeline.emit("service_log", f"line {index}")
+        self.assertTrue(pipeline.flush())
+        self.assertEqual([line for batch in sink.batches for line in batch], [f"line {index}" for index in range(10)])
+        self.assertEqual(len(sink.batches), 1)
+        first = json.loads(stream.getvalue().splitlines()[0])
+        self.assertEqual((first["event"], first["message"]), ("service_log", "line 0"))
+        pipeline.close()
+
+    def test_drop_new_keeps_the_queue_bounded(self):
+        sink = GatedSink()
+        drops: list[int] = []
+        pipeline = LogPipeline([sink], capacity=3, policy="drop_new", flush_interval=0.01, on_drop=drops.append)
+        pipeline.emit("service_log", "first")
+        self.assertTrue(sink.entered.wait(5))
+        accepted = [pipeline.emit("service_log", f"line {index}") for index in range(6)]
+        self.assertEqual(accepted, [True, True, True, False, False, False])
+        sink.release.set()
+        pipeline.flush()
+        self.assertEqual([line for batch in sink.batches for line in batch], ["first", "line 0", "line 1", "line 2"])
+        self.assertEqual((pipeline.dropped, sum(drops)), (3, 3))
+        pipeline.close()
+
+    def test_drop_oldest_keeps_the_latest_records(self):
+        sink = GatedSink()
+        pipeline = LogPipeline([sink], capacity=3, policy="drop_oldest", flush_interval=0.01)
+        pipeline.emit("service_log", "first")
+        self.assertTrue(sink.entered.wait(5))
+        for index in range(6):
+            pipeline.emit("service_log", f"line {index}")
+        sink.release.set()
+        pipeline.flush()
+        self.assertEqual([line for batch in sink.batches for line in batch], ["first", "line 3", "line 4", "line 5"])
+        self.assertEqual(pipeline.dropped, 3)
+        pipeline.close()
+
+    def test_drop_oldest_never_evicts_a_flush_marker(self):
+        sink = GatedSink()
+        pipeline = LogPipeline([sink], capacity=2, policy="drop_oldest", flush_interval=0.01)
+        pipeline.emit("service_log", "first")
+        self.assertTrue(sink.entered.wait(5))
+        result = {}
+        flusher = threading.Thread(target=lambda: result.setdefault("flushed", pipeline.flush(timeout=2)))
+        flusher.start()
+        while not pipeline._queue:
+            time.sleep(0.001)
+        # The marker is the oldest entry when the queue overflows.
+        for index in range(4):
+            pipeline.emit("service_log", f"line {index}")
+        sink.release.set()
+        flusher.join()
+        self.assertTrue(result["flushed"])
+        self.assertEqual([line for batch in sink.batches for line in batch][-1], "line 3")
+        self.assertGreaterEqual(pipeline.dropped, 2)
+        pipeline.close()
+
+    def test_ring_sink_sees_records_before_the_writer_runs(self):
+        sink = GatedSink()
+        ring = RingSink()
+        pipeline = LogPipeline([sink, ring], flush_interval=5)
+        pipeline.emit("service_log", "just now")
+        self.assertEqual(list(ring.lines), ["[dvpn] just now"])
+        sink.release.set()
+        pipeline.close()
+
+    def test_block_waits_for_the_writer_before_dropping(self):
+        sink = GatedSink()
+        pipeline = LogPipeline([sink], capacity=1, policy="block", flush_interval=0.01, block_seconds=0.05)
+        pipeline.emit("service_log", "first")
+        self.assertTrue(sink.entered.wait(5))
+        self.assertTrue(pipeline.emit("service_log", "queued"))
+        # The writer is stuck, so the bounded wait gives up.
+        self.assertFalse(pipeline.emit("service_log", "dropped"))
+        threading.Timer(0.05, sink.release.set).start()
+        pipeline.block_seconds = 2
+        self.assertTrue(pipeline.emit("service_log", "after wait"))
+        pipeline.flush()
+        self.assertEqual([line for batch in sink.batches for line in batch], ["first", "queued", "after wait"])
+        pipeline.close()
+
+    def test_a_failing_sink_does_not_stop_the_others(self):
+        ring = RingSink(maxlen=2)
+        pipeline = LogPipeline([BrokenSink(), ring])
+        for index in range(3):
+            pipeline.emit("service_log", f"line {index}")
+        pipeline.flush()
+        self.assertEqual(list(ring.lines), ["[dvpn] line 1", "[dvpn] line 2"])
+        self.assertGreaterEqual(pipeline.sink_errors, 1)
+        pipeline.close()
+        self.assertFalse(pipeline.emit("service_log", "closed"))
+
+
+class TestRotatingFileSink(unittest.TestCase):
+    def test_rotates_by_size_and_keeps_backups(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "audit.log"
+            sink = RotatingFileSink(path, max_bytes=200, backups=2)
+            pipeline = LogPipeline([sink], batch_size=1)
+            for index in range(20):
+                pipeline.emit("service_log", f"line {index:02d}")
+            pipeline.close()
+            files = sorted(p.name for p in Path(tmp).iterdir())
+            self.assertEqual(files, ["audit.log", "audit.log.1", "audit.log.2"])
+            self.assertLessEqual(path.stat().st_size, 200)
+            last = json.loads(path.read_text().splitlines()[-1])
+            self.assertEqual(last["message"], "line 19")
+
+
+class TestServiceLogging(unittest.TestCase):
+    def test_audit_file_and_logs_endpoint_share_one_pipeline(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            environ = service_environ(tmp) | {
+                "AUDIT_ENABLED": "true",
+                "AUDIT_LOG_PATH": str(Path(tmp) / "audit.log"),
+            }
+            with patch.dict(os.environ, environ):
+                service = DVPNService()
+            service.log_pool("registered")
+            service.log_pipeline.close()
+            self.assertEqual(service.get_logs()["logs"][-1], "[dvpn] pool: registered")
+            audit = json.loads((Path(tmp) / "audit.log").read_text().splitlines()[-1])
+            self.assertEqual((audit["event"], audit["message"]), ("service_log", "pool: registered"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,10 @@
+import socket
+import subprocess
 import unittest
 
-from app.bandwidth import BandwidthAllocator
+from app.bandwidth import BandwidthAllocator, estimate_throughput
+from app.shaping import DryRunShaper
+from fixtures.byte_source import ByteSource
 
 
 class TestBandwidthAllocator(unittest.TestCase):
@@ -9,14 +13,35 @@ class TestBandwidthAllocator(unittest.TestCase):
         granted = allocator.open_connection("conn-1")
         self.assertAlmostEqual(granted, 100.0)
 
-    def test_each_new_connection_gets_half_total_until_remaining_exhausted(self):
+    def test_oversubscribed_connections_share_max_min_fairly(self):
         allocator = BandwidthAllocator(total_mbps=100.0, fraction_per_connection=0.5)
         grant1 = allocator.open_connection("a")
         grant2 = allocator.open_connection("b")
         grant3 = allocator.open_connection("c")
         self.assertAlmostEqual(grant1, 50.0)
         self.assertAlmostEqual(grant2, 50.0)
-        self.assertAlmostEqual(grant3, 0.0)
+        self.assertAlmostEqual(grant3, 100.0 / 3)
+        self.assertAlmostEqual(allocator.grants()["a"], 100.0 / 3)
+        self.assertAlmostEqual(allocator.granted_total_mbps, 100.0)
+
+    def test_small_demands_are_met_and_the_rest_is_split(self):
+        allocator = BandwidthAllocator(total_mbps=100.0, fraction_per_connection=0.5)
+        allocator.open_connection("small", demand_mbps=10.0)
+        allocator.open_connection("a")
+        allocator.open_connection("b")
+        grants = allocator.grants()
+        self.assertAlmostEqual(grants["small"], 10.0)
+        self.assertAlmostEqual(grants["a"], 45.0)
+        self.assertAlmostEqual(grants["b"], 45.0)
+        allocator.close_connection("small")
+        self.assertEqual(allocator.grants(), {"a": 50.0, "b": 50.0})
+        self.assertAlmostEqual(allocator.granted_total_mbps, 100.0)
+
+    def test_new_total_rebalances_existing_grants(self):
+        allocator = BandwidthAllocator(total_mbps=100.0, fraction_per_connection=0.5)
+        allocator.open_connection("a")
+        allocator.set_total(40.0)
+        self.assertAlmostEqual(allocator.grants()["a"], 20.0)
 
     def test_release_restores_capacity(self):
         allocator = BandwidthAllocator(total_mbps=100.0, fraction_per_connection=0.5)
@@ -27,5 +52,124 @@ class TestBandwidthAllocator(unittest.TestCase):
         self.assertAlmostEqual(grant, 50.0)
 
 
+class TestTcShaping(unittest.TestCase):
+    def test_grants_map_to_htb_classes_per_peer(self):
+        shaper = DryRunShaper("wg0")
+        allocator = BandwidthAllocator(total_mbps=100.0, fraction_per_connection=0.5, shaper=shaper)
+        allocator.open_connection("peer-a", address="10.66.0.2/32")
+        self.assertEqual(shaper.batches[0], ["qdisc del dev wg0 root"])
+        self.assertEqual(
+            shaper.batches[1],
+            [
+                "qdisc add dev wg0 root handle 1: htb default ffff",
+                "class replace dev wg0 parent 1: classid 1:ffff htb rate 100000kbit",
+                "filter add dev wg0 parent 1: protocol ip prio 1 u32",
+                "filter add dev wg0 parent 1: protocol ipv6 prio 2 u32",
+                "class replace dev wg0 parent 1: classid 1:1 htb rate 100000kbit",
+                "class replace dev wg0 parent 1:1 classid 1:10 htb rate 50000kbit ceil 50000kbit",
+                "filter replace dev wg0 parent 1: protocol ip prio 1 handle 800::10 u32 match ip dst 10.66.0.2/32 flowid 1:10",
+            ],
+        )
+
+    def test_redistribution_updates_every_squeezed_class_in_one_batch(self):
+        shaper = DryRunShaper("wg0")
+        allocator = BandwidthAllocator(total_mbps=90.0, fraction_per_connection=0.5, shaper=shaper)
+        allocator.open_connection("a", address="10.66.0.2/32")
+        allocator.open_connection("b", address="10.66.0.3/32")
+        allocator.open_connection("c", address="fd00::4/128")
+        last = shaper.batches[-1]
+        self.assertEqual(len(shaper.batches), 4)
+        self.assertEqual(sum("htb rate 30000kbit ceil 30000kbit" in line for line in last), 3)
+        self.assertIn("filter replace dev wg0 parent 1: protocol ipv6 prio 2 handle 801::12 u32 match ip6 dst fd00::4/128 flowid 1:12", last)
+
+        allocator.close_connection("a")
+        last = shaper.batches[-1]
+        self.assertIn("filter del dev wg0 parent 1: protocol ip prio 1 handle 800::10 u32", last)
+        self.assertIn("class del dev wg0 classid 1:10", last)
+        self.assertEqual(sum("htb rate 45000kbit ceil 45000kbit" in line for line in last), 2)
+        # The freed class id is reused by the next peer.
+        allocator.open_connection("d", address="10.66.0.5/32")
+        self.assertIn("classid 1:10 htb", "\n".join(shaper.batches[-1]))
+
+    def test_connections_without_address_are_not_shaped(self):
+        shaper = DryRunShaper("wg0")
+        allocator = BandwidthAllocator(total_mbps=100.0, shaper=shaper)
+        allocator.open_connection("provider-a")
+        allocator.close_connection("provider-a")
+        self.assertEqual(shaper.batches, [])
+
+    def test_shaping_failure_keeps_bookkeeping(self):
+        errors = []
+
+        class FailingShaper(DryRunShaper):
+            def run_batch(self, lines):
+                raise OSError("tc missing")
+
+        allocator = BandwidthAllocator(total_mbps=100.0, shaper=FailingShaper(), on_shaping_error=errors.append)
+        self.assertAlmostEqual(allocator.open_connection("a", address="10.66.0.2/32"), 50.0)
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(allocator.shaper.classes, {})
+
+    def test_failed_batch_rebuilds_and_resends_every_grant(self):
+        class FlakyShaper(DryRunShaper):
+            fail = False
+
+            def run_batch(self, lines):
+                super().run_batch(lines)
+                if self.fail and lines[0].startswith("class"):
+                    raise subprocess.CalledProcessError(1, "tc")
+
+        shaper = FlakyShaper()
+        errors = []
+        allocator = BandwidthAllocator(
+            total_mbps=100.0, fraction_per_connection=0.25, shaper=shaper, on_shaping_error=errors.append
+        )
+        allocator.open_connection("a", address="10.66.0.2/32")
+        shaper.fail = True
+        allocator.open_connection("b", address="10.66.0.3/32")
+        self.assertEqual(len(errors), 1)
+        shaper.fail = False
+        allocator.open_connection("c", address="10.66.0.4/32")
+        self.assertEqual(shaper.batches[-2], ["qdisc del dev wg0 root"])
+        rebuilt = "\n".join(shaper.batches[-1])
+        for address in ("10.66.0.2/32", "10.66.0.3/32", "10.66.0.4/32"):
+            self.assertIn(f"match ip dst {address}", rebuilt)
+        self.assertEqual(sorted(shaper.classes), ["a", "b", "c"])
+
+
+class TestThroughputEstimate(unittest.TestCase):
+    def setUp(self):
+        # 1 MB/s per connection: the estimate should scale with the number of streams.
+        self.source = ByteSource(rate=1_000_000)
+        self.source.start()
+
+    def tearDown(self):
+        self.source.stop()
+
+    def test_parallel_streams_converge_before_the_sample_window(self):
+        estimate = estimate_throughput(self.source.url, sample_seconds=5, streams=4, interval=0.2)
+        self.assertTrue(estimate.converged)
+        self.assertLess(estimate.elapsed, 4)
+        self.assertAlmostEqual(estimate.mbps, 32.0, delta=32.0 * 0.2)
+        self.assertEqual(self.source.connections, 4)
+
+    def test_single_stream_measures_one_connection(self):
+        estimate = estimate_throughput(self.source.url, sample_seconds=5, streams=1, interval=0.2)
+        self.assertAlmostEqual(estimate.mbps, 8.0, delta=8.0 * 0.2)
+
+    def test_short_body_finishes_without_waiting_for_the_window(self):
+        estimate = estimate_throughput(self.source.url + "?size=200000", sample_seconds=5, streams=2, interval=0.1)
+        self.assertFalse(estimate.converged)
+        self.assertLess(estimate.elapsed, 2)
+        self.assertGreater(estimate.mbps, 0)
+
+    def test_unreachable_source_raises(self):
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        with self.assertRaises(OSError):
+            estimate_throughput(f"http://127.0.0.1:{port}/bytes", timeout=1, sample_seconds=1, streams=2)
+
+
 if __name__ == "__main__":
     unittest.main()
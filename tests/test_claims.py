@@ -0,0 +1,196 @@
+import importlib.util
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+import urllib.error
+from http.server import ThreadingHTTPServer
+from pathlib import Path
+from unittest.mock import patch
+
+from app.main import DVPNService
+from app.peers import PeerLifecycle
+from app.pool import PoolClient
+from fixtures.clock import FakeClock
+from fixtures.service import fake_wg_environ
+
+ROOT = Path(__file__).resolve().parent.parent
+MOCK_PATH = ROOT / "scripts" / "mock_orchestrator.py"
+KEYS = [f"{chr(ord('A') + index) * 43}=" for index in range(5)]
+
+
+def load_mock():
+    spec = importlib.util.spec_from_file_location("mock_orchestrator", MOCK_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def claim(index: int, lease_exp: float | None = None) -> dict:
+    return {
+        "lease_nonce": f"nonce-{index}",
+        "lease_exp": lease_exp or (time.time() + 300) * 1000,
+        "client_ip": f"10.66.0.{index + 2}/32",
+        "client_public_key": KEYS[index],
+    }
+
+
+class MockPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.mock = load_mock()
+        self.mock.Handler.log_message = lambda *args: None
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.mock.Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.pool_url = f"http://127.0.0.1:{self.server.server_address[1]}/providers"
+        self.client = PoolClient(self.pool_url, timeout=2, pool_token="tok")
+
+    def tearDown(self):
+        self.client.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class TestClaimBatches(MockPoolTestCase):
+    def test_batch_returns_up_to_limit_and_skips_expired(self):
+        self.mock.CLAIMS.push("node", claim(0, lease_exp=1))
+        for index in range(1, 5):
+            self.mock.CLAIMS.push("node", claim(index))
+        first = self.client.fetch_claims("node", limit=3)
+        second = self.client.fetch_claims("node", limit=3)
+        self.assertEqual([c["lease_nonce"] for c in first], ["nonce-1", "nonce-2", "nonce-3"])
+        self.assertEqual([c["lease_nonce"] for c in second], ["nonce-4"])
+
+    def test_long_poll_returns_when_claim_arrives(self):
+        threading.Timer(0.2, self.mock.CLAIMS.push, ("node", claim(0))).start()
+        started = time.monotonic()
+        claims = self.client.fetch_claims("node", wait_seconds=5)
+        elapsed = time.monotonic() - started
+        self.assertEqual([c["lease_nonce"] for c in claims], ["nonce-0"])
+        self.assertLess(elapsed, 2)
+
+    def test_long_poll_times_out_empty(self):
+        started = time.monotonic()
+        self.assertEqual(self.client.fetch_claims("node", wait_seconds=0.3), [])
+        self.assertGreaterEqual(time.monotonic() - started, 0.3)
+
+    def test_pool_without_batch_endpoint_falls_back_to_next(self):
+        self.mock.CLAIMS.push("node", claim(0))
+        self.mock.CLAIMS.push("node", claim(1))
+        original = self.client._post
+
+        def post(suffix, payload, timeout=None):
+            if suffix == "/claim/batch":
+                raise urllib.error.HTTPError(self.pool_url + suffix, 404, "Not Found", None, None)
+            return original(suffix, payload, timeout)
+
+        with patch.object(self.client, "_post", post):
+            self.assertEqual([c["lease_nonce"] for c in self.client.fetch_claims("node")], ["nonce-0"])
+            self.assertFalse(self.client.claim_batch_supported)
+            self.assertEqual([c["lease_nonce"] for c in self.client.fetch_claims("node")], ["nonce-1"])
+
+
+class TestProviderAdmission(MockPoolTestCase):
+    def service_environ(self, tmp: str, log: Path) -> dict:
+        return fake_wg_environ(tmp, log) | {
+            "POOL_URL": self.pool_url,
+            "NODE_ID": "node",
+            "SHAPING_BACKEND": "dry-run",
+            "BANDWIDTH_TOTAL_MBPS": "90",
+        }
+
+    def test_batch_is_applied_with_one_wg_set(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            log = Path(tmp) / "calls.log"
+            with patch.dict(os.environ, self.service_environ(tmp, log)):
+                service = DVPNService()
+                service.wg.up()
+                for index in range(4):
+                    self.mock.CLAIMS.push("node", claim(index))
+                # A replayed nonce in the same batch is admitted once.
+                self.mock.CLAIMS.push("node", claim(0))
+                self.assertEqual(service.fetch_provider_claims(wait_seconds=0), 5)
+                self.assertEqual(service.apply_pending_claims(), 4)
+                self.mock.CLAIMS.push("node", claim(1))
+                service.fetch_provider_claims(wait_seconds=0)
+                self.assertEqual(service.apply_pending_claims(), 0)
+                peers = service.wg.peers()
+            calls = [json.loads(line) for line in log.read_text().splitlines()]
+        self.assertEqual(set(peers), set(KEYS[:4]))
+        sets = [call for call in calls if call[0] == "set"]
+        self.assertEqual(len(sets), 1)
+        self.assertEqual(sets[0].count("peer"), 4)
+        self.assertIn("dvpn_provider_claims_applied_total 4", service.metrics_text())
+
+    def test_rejected_batch_falls_back_to_one_peer_per_set(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            log = Path(tmp) / "calls.log"
+            with patch.dict(os.environ, self.service_environ(tmp, log) | {"FAKE_WG_REJECT": KEYS[1]}):
+                service = DVPNService()
+                service.wg.up()
+                self.assertEqual(service.apply_provider_claims([claim(0), claim(1), claim(2)]), 2)
+                peers = service.wg.peers()
+            calls = [json.loads(line) for line in log.read_text().splitlines()]
+        self.assertEqual(set(peers), {KEYS[0], KEYS[2]})
+        self.assertEqual(sorted(service.provider_peers.leases), [KEYS[0], KEYS[2]])
+        self.assertEqual(sorted(service.bandwidth.grants()), [f"peer:{KEYS[0]}", f"peer:{KEYS[2]}"])
+        self.assertEqual([call.count("peer") for call in calls if call[0] == "set"], [3, 1, 1, 1])
+        self.assertIn("dvpn_provider_claims_rejected_total 1", service.metrics_text())
+
+    def test_expired_and_idle_peers_are_evicted_in_one_batch(self):
+        clock = FakeClock(time.time())
+        with tempfile.TemporaryDirectory() as tmp:
+            log = Path(tmp) / "calls.log"
+            with patch.dict(os.environ, self.service_environ(tmp, log)):
+                service = DVPNService()
+                service.provider_peers = PeerLifecycle(idle_seconds=60, clock=clock)
+                service.wg.up()
+                service.apply_provider_claims(
+                    [claim(0, lease_exp=(clock.now + 30) * 1000), claim(1), claim(2, lease_exp=(clock.now + 3600) * 1000)]
+                )
+                self.assertEqual(service.evict_provider_peers(), 0)
+                self.assertEqual(sorted(service.bandwidth.grants().values()), [30.0, 30.0, 30.0])
+                self.assertEqual(len(service.shaper.classes), 3)
+                clock.now += 120
+                # claim(1) leases for 300s, so it is only idle; claim(0)'s lease has lapsed.
+                self.assertEqual(service.evict_provider_peers(), 3)
+                peers = service.wg.peers()
+            calls = [json.loads(line) for line in log.read_text().splitlines()]
+        self.assertEqual(peers, {})
+        removals = [call for call in calls if call[0] == "set" and "remove" in call]
+        self.assertEqual(len(removals), 1)
+        self.assertEqual(removals[0].count("remove"), 3)
+        metrics = service.metrics_text()
+        self.assertIn("dvpn_provider_peers_expired_total 1", metrics)
+        self.assertIn("dvpn_provider_peers_idle_evicted_total 2", metrics)
+        self.assertIn("dvpn_provider_peers 0", metrics)
+        self.assertEqual(service.shaper.classes, {})
+        self.assertEqual(sum("class del" in line for line in service.shaper.batches[-1]), 3)
+        self.assertEqual(service.bandwidth.active_count, 0)
+
+    def test_interface_teardown_drops_leases_and_grants(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            log = Path(tmp) / "calls.log"
+            with patch.dict(os.environ, self.service_environ(tmp, log)):
+                service = DVPNService()
+                service.wg.up()
+                service.wg_config_path.write_text("[Interface]\n", encoding="utf-8")
+                self.assertEqual(service.apply_provider_claims([claim(0), claim(1)]), 2)
+                self.assertIn("dvpn_provider_peers 2", service.metrics_text())
+                batches = len(service.shaper.batches)
+                service.wg_down()
+        self.assertEqual(service.provider_peers.leases, {})
+        self.assertEqual(service.bandwidth.grants(), {})
+        # The qdisc went down with the interface, so nothing is sent to tc.
+        self.assertEqual(len(service.shaper.batches), batches)
+        metrics = service.metrics_text()
+        self.assertIn("dvpn_provider_peers 0", metrics)
+        self.assertIn("dvpn_active_connections 0", metrics)
+        # Nonces outlive the teardown so the same claims cannot be replayed onto the new interface.
+        self.assertEqual(service.provider_peers.admissible([claim(0)]), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
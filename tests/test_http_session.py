@@ -0,0 +1,109 @@
+import http.client
+import json
+import threading
+import time
+import unittest
+import urllib.error
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from app.http_session import HTTPSession
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Server drops idle keep-alive connections quickly so tests can exercise reconnects.
+    timeout = 0.3
+    hits: list[str] = []
+
+    def do_GET(self):
+        self.hits.append(f"{self.command} {self.path}")
+        if self.path == "/drop":
+            # Read the request, then hang up without answering.
+            self.close_connection = True
+            return
+        if self.path == "/missing":
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        payload = json.dumps({"port": self.client_address[1], "path": self.path}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        self.do_GET()
+
+    def log_message(self, format, *args):
+        return
+
+
+class TestHTTPSession(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), KeepAliveHandler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.base = f"http://127.0.0.1:{self.server.server_address[1]}"
+        KeepAliveHandler.hits = []
+        self.timings: list[float] = []
+        self.session = HTTPSession(timeout=2, on_request=lambda method, host, seconds: self.timings.append(seconds))
+
+    def tearDown(self):
+        self.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_reuses_keep_alive_connection(self):
+        first = self.session.request("GET", self.base + "/a").json()["port"]
+        second = self.session.request("GET", self.base + "/b").json()["port"]
+        self.assertEqual(first, second)
+        self.assertEqual(len(self.timings), 2)
+
+    def test_idle_connections_are_evicted(self):
+        self.session.idle_timeout = 0
+        first = self.session.request("GET", self.base + "/a").json()["port"]
+        second = self.session.request("GET", self.base + "/a").json()["port"]
+        self.assertNotEqual(first, second)
+
+    def test_reconnects_when_pooled_socket_was_reset(self):
+        first = self.session.request("GET", self.base + "/a").json()["port"]
+        time.sleep(0.6)
+        second = self.session.request("GET", self.base + "/a").json()["port"]
+        self.assertNotEqual(first, second)
+
+    def test_only_idempotent_requests_are_replayed_after_a_reset(self):
+        self.session.request("GET", self.base + "/a")
+        with self.assertRaises(http.client.RemoteDisconnected):
+            self.session.request("POST", self.base + "/drop", body=b"{}")
+        self.assertEqual(KeepAliveHandler.hits[1:], ["POST /drop"])
+
+        self.session.request("GET", self.base + "/a")
+        with self.assertRaises(http.client.RemoteDisconnected):
+            self.session.request("GET", self.base + "/drop")
+        # The reused socket failed, so the GET was sent once more on a fresh connection.
+        self.assertEqual(KeepAliveHandler.hits[3:], ["GET /drop", "GET /drop"])
+
+    def test_post_on_a_pooled_socket_the_server_closed_opens_a_new_one(self):
+        first = self.session.request("GET", self.base + "/a").json()["port"]
+        time.sleep(0.6)
+        second = self.session.request("POST", self.base + "/a", body=b"{}").json()["port"]
+        self.assertNotEqual(first, second)
+
+    def test_plain_http_goes_through_the_configured_proxy(self):
+        session = HTTPSession(timeout=2, proxies={"http": self.base})
+        self.addCleanup(session.close)
+        response = session.request("GET", "http://dvpn.invalid:8080/a?x=1").json()
+        self.assertEqual(response["path"], "http://dvpn.invalid:8080/a?x=1")
+
+    def test_error_status_raises_http_error(self):
+        with self.assertRaises(urllib.error.HTTPError) as ctx:
+            self.session.request("GET", self.base + "/missing")
+        self.assertEqual(ctx.exception.code, 404)
+
+
+if __name__ == "__main__":
+    unittest.main()
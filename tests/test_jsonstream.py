@@ -0,0 +1,31 @@
+import io
+import json
+import unittest
+
+from app.jsonstream import decode_stream, iter_json_array, iter_ndjson
+
+
+class TestJSONStream(unittest.TestCase):
+    def test_array_items_survive_any_chunk_boundary(self):
+        items = [{"id": f"p{i}", "endpoint": "8.8.8.8:51820", "note": "é✓"} for i in range(20)] + [12345, "tail"]
+        payload = json.dumps(items, ensure_ascii=False).encode("utf-8")
+        for chunk_size in (1, 2, 3, 7, 64, 4096):
+            with self.subTest(chunk_size=chunk_size):
+                self.assertEqual(list(iter_json_array(io.BytesIO(payload).read, chunk_size)), items)
+
+    def test_ndjson_lines(self):
+        payload = b'{"id": "a"}\n\n{"id": "b"}'
+        self.assertEqual([item["id"] for item in iter_ndjson(io.BytesIO(payload).read, 4)], ["a", "b"])
+
+    def test_decode_stream_returns_documents_whole(self):
+        items, document = decode_stream(io.BytesIO(b' {"delta": true, "removed": ["x"]}').read)
+        self.assertIsNone(items)
+        self.assertEqual(document["removed"], ["x"])
+
+    def test_malformed_array_raises(self):
+        with self.assertRaises(ValueError):
+            list(iter_json_array(io.BytesIO(b'[{"id": 1} {"id": 2}]').read))
+
+
+if __name__ == "__main__":
+    unittest.main()
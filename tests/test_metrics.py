@@ -0,0 +1,149 @@
+import threading
+import unittest
+
+from app.metrics import Metrics
+
+
+class TestMetrics(unittest.TestCase):
+    def test_histogram_renders_cumulative_buckets(self):
+        metrics = Metrics()
+        metrics.observe("dvpn_handshake_seconds", 0.2)
+        metrics.observe("dvpn_handshake_seconds", 3.0)
+        text = metrics.render_prometheus()
+        self.assertIn("# TYPE dvpn_handshake_seconds histogram", text)
+        self.assertIn('dvpn_handshake_seconds_bucket{le="0.25"} 1', text)
+        self.assertIn('dvpn_handshake_seconds_bucket{le="5.0"} 2', text)
+        self.assertIn('dvpn_handshake_seconds_bucket{le="+Inf"} 2', text)
+        self.assertIn("dvpn_handshake_seconds_count 2", text)
+
+    def test_labeled_series_share_one_type_line_and_can_be_removed(self):
+        metrics = Metrics()
+        metrics.inc("dvpn_peer_rx_bytes_total", 10, {"peer": "a"})
+        metrics.inc("dvpn_peer_rx_bytes_total", 5, {"peer": 'b"\\'})
+        metrics.set_gauge("dvpn_peer_rx_mbps", 1.5, {"peer": "a"})
+        text = metrics.render_prometheus()
+        self.assertEqual(text.count("# TYPE dvpn_peer_rx_bytes_total counter"), 1)
+        self.assertIn('dvpn_peer_rx_bytes_total{peer="a"} 10', text)
+        self.assertIn('dvpn_peer_rx_bytes_total{peer="b\\"\\\\"} 5', text)
+        self.assertIn('dvpn_peer_rx_mbps{peer="a"} 1.5', text)
+        metrics.remove_series({"peer": "a"})
+        text = metrics.render_prometheus()
+        self.assertNotIn('peer="a"', text)
+        self.assertIn("dvpn_peer_rx_bytes_total{", text)
+
+    def test_labeled_histograms_keep_separate_buckets(self):
+        metrics = Metrics()
+        metrics.observe("dvpn_http_request_seconds", 0.04, {"host": "pool.example"})
+        metrics.observe("dvpn_http_request_seconds", 7.0, {"host": "pay.example"})
+        text = metrics.render_prometheus()
+        self.assertEqual(text.count("# TYPE dvpn_http_request_seconds histogram"), 1)
+        self.assertIn('dvpn_http_request_seconds_bucket{host="pool.example",le="0.05"} 1', text)
+        self.assertIn('dvpn_http_request_seconds_bucket{host="pay.example",le="5.0"} 0', text)
+        self.assertIn('dvpn_http_request_seconds_bucket{host="pay.example",le="10.0"} 1', text)
+        self.assertIn('dvpn_http_request_seconds_count{host="pay.example"} 1', text)
+
+    def test_summary_reports_quantiles_over_recent_window(self):
+        metrics = Metrics(summary_window=100)
+        for value in range(1, 201):
+            metrics.summarize("dvpn_provider_rtt_seconds", value / 1000, {"provider": "p1"})
+        text = metrics.render_prometheus()
+        self.assertIn("# TYPE dvpn_provider_rtt_seconds summary", text)
+        self.assertIn('dvpn_provider_rtt_seconds{provider="p1",quantile="0.5"} 0.151', text)
+        self.assertIn('dvpn_provider_rtt_seconds{provider="p1",quantile="0.99"} 0.2', text)
+        self.assertIn('dvpn_provider_rtt_seconds_count{provider="p1"} 200', text)
+
+    def test_series_beyond_the_cap_fold_into_other(self):
+        metrics = Metrics(max_series=2)
+        for index in range(5):
+            metrics.summarize("dvpn_provider_rtt_seconds", 0.01, {"provider": f"p{index}"})
+        text = metrics.render_prometheus()
+        self.assertIn('dvpn_provider_rtt_seconds_count{provider="p1"} 1', text)
+        self.assertNotIn('provider="p2"', text)
+        self.assertIn('dvpn_provider_rtt_seconds_count{provider="other"} 3', text)
+        self.assertIn("dvpn_metric_series_overflow_total 3", text)
+
+    def test_timer_as_context_manager_and_decorator(self):
+        metrics = Metrics()
+        with metrics.timer("dvpn_call_seconds", {"call": "block"}) as timer:
+            pass
+        self.assertGreaterEqual(timer.elapsed, 0)
+
+        @metrics.timer("dvpn_call_seconds", {"call": "decorated"})
+        def work(value):
+            return value * 2
+
+        self.assertEqual(work(2), 4)
+        self.assertEqual(work(3), 6)
+        with self.assertRaises(ValueError):
+            with metrics.timer("dvpn_call_seconds", {"call": "failing"}):
+                raise ValueError("boom")
+        text = metrics.render_prometheus()
+        self.assertIn('dvpn_call_seconds_count{call="block"} 1', text)
+        self.assertIn('dvpn_call_seconds_count{call="decorated"} 2', text)
+        self.assertIn('dvpn_call_seconds_count{call="failing"} 1', text)
+
+    def test_concurrent_writers_are_aggregated_at_scrape(self):
+        metrics = Metrics()
+
+        def work(index):
+            for _ in range(1000):
+                metrics.inc("dvpn_rotation_total")
+                metrics.inc("dvpn_peer_rx_bytes_total", 2, {"peer": f"p{index % 2}"})
+                metrics.observe("dvpn_call_seconds", 0.01, {"call": "work"})
+
+        threads = [threading.Thread(target=work, args=(index,)) for index in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        text = metrics.render_prometheus()
+        self.assertIn("dvpn_rotation_total 4000", text)
+        self.assertIn('dvpn_peer_rx_bytes_total{peer="p0"} 4000', text)
+        self.assertIn('dvpn_peer_rx_bytes_total{peer="p1"} 4000', text)
+        self.assertIn('dvpn_call_seconds_count{call="work"} 4000', text)
+
+    def test_latest_gauge_write_wins_across_threads(self):
+        metrics = Metrics()
+        metrics.set_gauge("dvpn_active_connections", 3)
+        writer = threading.Thread(target=metrics.set_gauge, args=("dvpn_active_connections", 5))
+        writer.start()
+        writer.join()
+        self.assertIn("dvpn_active_connections 5\n", metrics.render_prometheus())
+        metrics.set_gauge("dvpn_active_connections", 1)
+        self.assertIn("dvpn_active_connections 1\n", metrics.render_prometheus())
+
+    def test_exposition_is_cached_until_a_value_changes(self):
+        metrics = Metrics()
+        first = metrics.render_prometheus()
+        self.assertIs(metrics.render_prometheus(), first)
+        metrics.inc("dvpn_rotation_total")
+        second = metrics.render_prometheus()
+        self.assertIsNot(second, first)
+        self.assertIn("dvpn_rotation_total 1", second)
+        self.assertIs(metrics.render_prometheus(), second)
+
+    def test_shards_of_exited_threads_are_folded_into_one(self):
+        metrics = Metrics()
+        for _ in range(50):
+            writer = threading.Thread(
+                target=lambda: (
+                    metrics.inc("dvpn_rotation_total"),
+                    metrics.set_gauge("dvpn_active_connections", 7),
+                    metrics.observe("dvpn_http_request_seconds", 0.2, {"host": "pool.example"}),
+                    metrics.summarize("dvpn_provider_rtt_seconds", 0.03, {"provider": "p1"}),
+                )
+            )
+            writer.start()
+            writer.join()
+        text = metrics.render_prometheus()
+        self.assertEqual(len(metrics._shards), 1)
+        self.assertIn("dvpn_rotation_total 50", text)
+        self.assertIn("dvpn_active_connections 7", text)
+        self.assertIn('dvpn_http_request_seconds_count{host="pool.example"} 50', text)
+        self.assertIn('dvpn_provider_rtt_seconds_count{provider="p1"} 50', text)
+        metrics.inc("dvpn_rotation_total")
+        self.assertIn("dvpn_rotation_total 51", metrics.render_prometheus())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,100 @@
+import json
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from app.network import PublicIPDetector, parse_public_ip, race_public_ip
+from fixtures.clock import FakeClock
+
+
+class _IPSources:
+    def __init__(self) -> None:
+        self.hits: dict[str, int] = {}
+        self.answer = "203.0.113.7"
+        sources = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                sources.hits[self.path] = sources.hits.get(self.path, 0) + 1
+                if self.path == "/slow":
+                    time.sleep(2)
+                    body = json.dumps({"ip": "198.51.100.1"})
+                elif self.path == "/trace":
+                    body = f"fl=1\nip={sources.answer}\nts=1\n"
+                elif self.path == "/json":
+                    body = json.dumps({"ip": sources.answer})
+                else:
+                    body = "<html>not an address</html>"
+                payload = body.encode("utf-8")
+                try:
+                    self.send_response(200)
+                    self.send_header("Content-Length", str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload)
+                except (BrokenPipeError, ConnectionResetError):
+                    # The race already finished and the client hung up.
+                    pass
+
+            def log_message(self, format, *args):
+                return
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def url(self, path: str) -> str:
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}{path}"
+
+    def close(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class TestPublicIPDetection(unittest.TestCase):
+    def setUp(self):
+        self.sources = _IPSources()
+        self.addCleanup(self.sources.close)
+
+    def test_parse_public_ip_formats(self):
+        self.assertEqual(parse_public_ip('{"ip": "2001:db8::1"}'), "2001:db8::1")
+        self.assertEqual(parse_public_ip("fl=1\nip=203.0.113.7\n"), "203.0.113.7")
+        self.assertIsNone(parse_public_ip('{"ip": "not-an-ip"}'))
+        self.assertIsNone(parse_public_ip("<html></html>"))
+
+    def test_race_returns_first_valid_answer_without_waiting_for_slow_source(self):
+        started = time.monotonic()
+        ip = race_public_ip([self.sources.url("/slow"), self.sources.url("/bad"), self.sources.url("/trace")], timeout=3)
+        self.assertEqual(ip, "203.0.113.7")
+        self.assertLess(time.monotonic() - started, 1.5)
+
+    def test_race_gives_up_at_timeout(self):
+        started = time.monotonic()
+        self.assertIsNone(race_public_ip([self.sources.url("/slow"), self.sources.url("/bad")], timeout=0.5))
+        self.assertLess(time.monotonic() - started, 1.5)
+
+    def test_detector_caches_until_ttl_or_local_ip_change(self):
+        clock = FakeClock(0.0)
+        detector = PublicIPDetector(urls=[self.sources.url("/json")], timeout=2, ttl_seconds=60, clock=clock)
+        self.assertEqual(detector.detect("192.168.1.5"), "203.0.113.7")
+        self.sources.answer = "203.0.113.8"
+        self.assertEqual(detector.detect("192.168.1.5"), "203.0.113.7")
+        self.assertEqual(self.sources.hits["/json"], 1)
+
+        self.assertEqual(detector.detect("10.1.0.9"), "203.0.113.8")
+        self.assertEqual(self.sources.hits["/json"], 2)
+
+        self.sources.answer = "203.0.113.9"
+        clock.now = 61.0
+        self.assertEqual(detector.detect("10.1.0.9"), "203.0.113.9")
+        self.assertEqual(self.sources.hits["/json"], 3)
+
+    def test_detector_does_not_cache_failures(self):
+        detector = PublicIPDetector(urls=[self.sources.url("/bad")], timeout=2, local_ip_fn=lambda: "192.168.1.5")
+        self.assertIsNone(detector.detect())
+        self.assertIsNone(detector.detect())
+        self.assertEqual(self.sources.hits["/bad"], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
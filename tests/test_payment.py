@@ -1,23 +1,15 @@
-import io
 import json
+import time
 import unittest
 from unittest.mock import patch
 
-from app.payment import PaymentVerifier
+from app.http_session import HTTPResponse
+from app.payment import CachedPaymentVerifier, PaymentVerifier
+from fixtures.clock import FakeClock
 
 
-class FakeHTTPResponse:
-    def __init__(self, payload: dict):
-        self._bytes = io.BytesIO(json.dumps(payload).encode("utf-8"))
-
-    def read(self) -> bytes:
-        return self._bytes.read()
-
-    def __enter__(self):
-        return self
-
-    def __exit__(self, exc_type, exc, tb):
-        return False
+def fake_response(payload: dict) -> HTTPResponse:
+    return HTTPResponse(status=200, headers={}, body=json.dumps(payload).encode("utf-8"))
 
 
 class TestPaymentVerifier(unittest.TestCase):
@@ -25,8 +17,8 @@ class TestPaymentVerifier(unittest.TestCase):
         verifier = PaymentVerifier("https://payments.local/verify", "tok", timeout=1)
 
         with patch(
-            "urllib.request.urlopen",
-            return_value=FakeHTTPResponse(
+            "app.http_session.HTTPSession.request",
+            return_value=fake_response(
                 {
                     "active": True,
                     "wallet": "1MUss4jmaRJ2sMtS9gyZqeRw8WrhWTsrxn",
@@ -41,8 +33,8 @@ class TestPaymentVerifier(unittest.TestCase):
         verifier = PaymentVerifier("https://payments.local/verify", "tok", timeout=1)
 
         with patch(
-            "urllib.request.urlopen",
-            return_value=FakeHTTPResponse(
+            "app.http_session.HTTPSession.request",
+            return_value=fake_response(
                 {
                     "active": True,
                     "wallet": "bc1wrongwallet",
@@ -54,5 +46,96 @@ class TestPaymentVerifier(unittest.TestCase):
             self.assertFalse(verifier.is_active("provider-a"))
 
 
+class FakeVerifier:
+    def __init__(self, active: bool = True):
+        self.token = "tok"
+        self.active = active
+        self.calls = 0
+        self.tokens: list[str] = []
+
+    def is_active(self, provider_id: str, token: str | None = None) -> bool:
+        self.calls += 1
+        self.tokens.append(self.token if token is None else token)
+        return self.active
+
+
+class TestCachedPaymentVerifier(unittest.TestCase):
+    def _cache(self, verifier, clock, events):
+        return CachedPaymentVerifier(
+            verifier,
+            ttl_seconds=100,
+            grace_seconds=50,
+            refresh_ahead_seconds=10,
+            on_event=events.append,
+            clock=clock,
+        )
+
+    def test_positive_result_is_served_from_cache(self):
+        verifier, clock, events = FakeVerifier(), FakeClock(0.0), []
+        cache = self._cache(verifier, clock, events)
+        self.assertTrue(cache.is_active("pool-access"))
+        clock.now = 50
+        self.assertTrue(cache.is_active("pool-access"))
+        self.assertEqual(verifier.calls, 1)
+        self.assertEqual(events, ["miss", "hit"])
+
+    def test_negative_result_is_never_cached(self):
+        verifier, clock, events = FakeVerifier(active=False), FakeClock(0.0), []
+        cache = self._cache(verifier, clock, events)
+        self.assertFalse(cache.is_active("pool-access"))
+        self.assertFalse(cache.is_active("pool-access"))
+        self.assertEqual(verifier.calls, 2)
+
+    def test_stale_result_served_during_grace_and_refreshed(self):
+        verifier, clock, events = FakeVerifier(), FakeClock(0.0), []
+        cache = self._cache(verifier, clock, events)
+        cache.is_active("pool-access")
+        clock.now = 120
+        verifier.active = False
+        self.assertTrue(cache.is_active("pool-access"))
+        self.assertEqual(events[-1], "stale")
+        for _ in range(100):
+            if verifier.calls == 2 and not cache._refreshing:
+                break
+            time.sleep(0.01)
+        self.assertFalse(cache.is_active("pool-access"))
+
+    def test_expired_past_grace_is_a_miss(self):
+        verifier, clock, events = FakeVerifier(), FakeClock(0.0), []
+        cache = self._cache(verifier, clock, events)
+        cache.is_active("pool-access")
+        clock.now = 200
+        self.assertTrue(cache.is_active("pool-access"))
+        self.assertEqual(events, ["miss", "miss"])
+
+    def test_token_change_misses(self):
+        verifier, clock, events = FakeVerifier(), FakeClock(0.0), []
+        cache = self._cache(verifier, clock, events)
+        cache.is_active("pool-access")
+        verifier.token = "other"
+        cache.is_active("pool-access")
+        self.assertEqual(verifier.calls, 2)
+        self.assertEqual(list(cache._verified_at), [("other", "pool-access")])
+
+    def test_refresh_for_a_replaced_token_is_not_cached(self):
+        verifier, clock, events = FakeVerifier(), FakeClock(0.0), []
+        cache = self._cache(verifier, clock, events)
+        cache.is_active("pool-access")
+        verifier.token = "other"
+        cache.is_active("pool-access")
+        # A refresh that was already in flight for the old token still asks about that token.
+        self.assertTrue(cache._fetch(("tok", "pool-access")))
+        self.assertEqual(verifier.tokens, ["tok", "other", "tok"])
+        self.assertEqual(list(cache._verified_at), [("other", "pool-access")])
+
+    def test_entries_past_grace_are_pruned(self):
+        verifier, clock, events = FakeVerifier(), FakeClock(0.0), []
+        cache = self._cache(verifier, clock, events)
+        cache.is_active("provider-a")
+        clock.now = 200
+        cache.is_active("provider-b")
+        self.assertEqual(list(cache._verified_at), [("tok", "provider-b")])
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,97 @@
+import unittest
+
+from app.peers import NonceWindow, PeerLifecycle
+from fixtures.clock import FakeClock
+
+KEY_A = "A" * 43 + "="
+KEY_B = "B" * 43 + "="
+KEY_C = "C" * 43 + "="
+
+
+def claim(nonce: str, key: str, expires_at: float, client_ip: str = "10.66.0.2/32") -> dict:
+    return {"lease_nonce": nonce, "client_public_key": key, "client_ip": client_ip, "lease_exp": expires_at * 1000}
+
+
+class TestNonceWindow(unittest.TestCase):
+    def test_nonces_expire_with_their_lease(self):
+        clock = FakeClock()
+        window = NonceWindow(clock=clock)
+        window.add("a", clock.now + 10)
+        window.add("b", clock.now + 20)
+        self.assertIn("a", window)
+        clock.now += 15
+        self.assertNotIn("a", window)
+        self.assertEqual(window.purge(), 1)
+        self.assertEqual(len(window), 1)
+
+    def test_window_is_bounded(self):
+        clock = FakeClock()
+        window = NonceWindow(max_size=3, clock=clock)
+        for index in range(10):
+            window.add(f"n{index}", clock.now + 100 + index)
+        self.assertEqual(len(window), 3)
+        # The nonces closest to expiry are dropped first.
+        self.assertIn("n9", window)
+        self.assertNotIn("n0", window)
+
+
+class TestPeerLifecycle(unittest.TestCase):
+    def test_rejects_replays_and_expired_leases(self):
+        clock = FakeClock()
+        lifecycle = PeerLifecycle(clock=clock)
+        leases = lifecycle.admissible(
+            [
+                claim("n1", KEY_A, clock.now + 60),
+                claim("n1", KEY_B, clock.now + 60),
+                claim("n2", KEY_C, clock.now - 1),
+                {"lease_nonce": "n3", "client_ip": "10.66.0.9/32"},
+            ]
+        )
+        self.assertEqual([lease.public_key for lease in leases], [KEY_A])
+        lifecycle.track(leases)
+        # Malformed keys and addresses never reach `wg set`.
+        malformed = [
+            claim("n4", "not-a-key", clock.now + 60),
+            claim("n5", KEY_B, clock.now + 60, client_ip="10.66.0.300/32"),
+        ]
+        self.assertEqual(lifecycle.admissible(malformed), [])
+        self.assertEqual(lifecycle.admissible([claim("n1", KEY_A, clock.now + 60)]), [])
+
+    def test_expired_peers_come_out_in_expiry_order_until_forgotten(self):
+        clock = FakeClock()
+        lifecycle = PeerLifecycle(clock=clock)
+        lifecycle.track(
+            lifecycle.admissible(
+                [claim("n1", KEY_A, clock.now + 30), claim("n2", KEY_B, clock.now + 10), claim("n3", KEY_C, clock.now + 90)]
+            )
+        )
+        self.assertEqual(lifecycle.next_expiry(), clock.now + 10)
+        clock.now += 40
+        self.assertEqual(lifecycle.expired(), [KEY_B, KEY_A])
+        # Still queued until removal succeeds.
+        self.assertEqual(lifecycle.expired(), [KEY_B, KEY_A])
+        lifecycle.forget([KEY_B, KEY_A])
+        self.assertEqual(lifecycle.expired(), [])
+        self.assertEqual(lifecycle.next_expiry(), clock.now + 50)
+        self.assertEqual(len(lifecycle), 1)
+
+    def test_renewal_moves_expiry(self):
+        clock = FakeClock()
+        lifecycle = PeerLifecycle(clock=clock)
+        lifecycle.track(lifecycle.admissible([claim("n1", KEY_A, clock.now + 10)]))
+        lifecycle.track(lifecycle.admissible([claim("n2", KEY_A, clock.now + 100)]))
+        clock.now += 20
+        self.assertEqual(lifecycle.expired(), [])
+        self.assertEqual(lifecycle.next_expiry(), clock.now + 80)
+
+    def test_idle_peers_need_a_recent_handshake(self):
+        clock = FakeClock()
+        lifecycle = PeerLifecycle(idle_seconds=60, clock=clock)
+        lifecycle.track(lifecycle.admissible([claim("n1", KEY_A, clock.now + 3600), claim("n2", KEY_B, clock.now + 3600)]))
+        self.assertEqual(lifecycle.idle({}), [])
+        clock.now += 120
+        self.assertEqual(lifecycle.idle({KEY_A: int(clock.now - 5)}), [KEY_B])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,7 +1,21 @@
-import random
+import socket
+import time
 import unittest
+from unittest.mock import patch
 
-from app.pool import Provider, mesh_cycle, validate_provider, validate_public_key
+from app.main import provider_rejection
+from app.pool import (
+    Provider,
+    check_provider,
+    fastest_provider,
+    measure_latency,
+    provider_check,
+    validate_provider,
+    validate_public_key,
+)
+from app.probe import EchoResponder
+
+KEY = "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA="
 
 
 class TestPoolSecurityAndMesh(unittest.TestCase):
@@ -30,15 +44,132 @@ class TestPoolSecurityAndMesh(unittest.TestCase):
         with self.assertRaises(ValueError):
             validate_provider(provider)
 
-    def test_mesh_cycle_deprioritizes_previous_provider(self):
-        providers = [
-            Provider("a", "8.8.8.8:51820", "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA=", "0.0.0.0/0"),
-            Provider("b", "1.1.1.1:51820", "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA=", "0.0.0.0/0"),
-            Provider("c", "9.9.9.9:51820", "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA=", "0.0.0.0/0"),
+    def test_provider_check_is_shared_and_cached(self):
+        check_provider.cache_clear()
+        first = Provider("a", "8.8.8.8:51820", KEY, "0.0.0.0/0,::/0")
+        moved = Provider("a", "9.9.9.9:51820", KEY, "0.0.0.0/0,::/0")
+        self.assertIs(provider_check(first), provider_check(Provider("b", "8.8.8.8:51820", KEY, "0.0.0.0/0,::/0")))
+        self.assertIsNot(provider_check(first), provider_check(moved))
+        validate_provider(first)
+        self.assertIsNone(provider_rejection(first, None, None))
+        info = check_provider.cache_info()
+        self.assertEqual((info.misses, info.hits), (2, 4))
+
+    def test_provider_check_classifies_endpoints(self):
+        private = Provider("p", "10.0.0.1:51820", KEY, "0.0.0.0/0")
+        self.assertEqual(provider_rejection(private, None, None), "non_public_ip")
+        public = Provider("q", "8.8.8.8:51820", KEY, "0.0.0.0/0")
+        self.assertEqual(provider_rejection(public, "8.8.8.8", None), "same_public_ip")
+        self.assertIsNone(provider_rejection(Provider("h", "vpn.example.com:51820", KEY, "0.0.0.0/0"), None, None))
+        with self.assertRaises(ValueError):
+            validate_provider(Provider("c", "8.8.8.8:51820", KEY, "0.0.0.0/33"))
+        with self.assertRaises(ValueError):
+            validate_provider(Provider("e", "8.8.8.8:99999", KEY, "0.0.0.0/0"))
+        with patch.dict("os.environ", {"ALLOW_PRIVATE_ENDPOINTS": "true"}):
+            validate_provider(private)
+
+
+class TestFastestProvider(unittest.TestCase):
+    def _providers(self, count: int) -> list[Provider]:
+        return [
+            Provider(f"p{i}", f"8.8.{i // 250}.{i % 250 + 1}:51820", KEY, "0.0.0.0/0", probe_port=51821)
+            for i in range(count)
         ]
-        ordered = mesh_cycle(providers, previous_provider_id="b", rng=random.Random(0))
-        self.assertEqual({p.id for p in ordered}, {"a", "b", "c"})
-        self.assertNotEqual(ordered[0].id, "b")
+
+    def test_probes_run_concurrently(self):
+        providers = self._providers(20)
+        latencies = {p.endpoint: 50.0 + i for i, p in enumerate(providers)}
+
+        def fake_latency(endpoint: str, **kwargs) -> float:
+            time.sleep(0.2)
+            return latencies[endpoint]
+
+        with patch("app.pool.measure_latency", side_effect=fake_latency):
+            start = time.monotonic()
+            chosen = fastest_provider(providers, max_workers=20, deadline_seconds=5)
+            elapsed = time.monotonic() - start
+        self.assertEqual(chosen.id, "p0")
+        self.assertLess(elapsed, 1.5)
+
+    def test_deadline_bounds_blackholed_endpoints(self):
+        providers = self._providers(4)
+
+        def fake_latency(endpoint: str, **kwargs) -> float:
+            if endpoint == providers[1].endpoint:
+                return 12.0
+            time.sleep(2)
+            return 1.0
+
+        with patch("app.pool.measure_latency", side_effect=fake_latency):
+            start = time.monotonic()
+            chosen = fastest_provider(providers, deadline_seconds=0.3)
+            elapsed = time.monotonic() - start
+        self.assertEqual(chosen.id, "p1")
+        self.assertLess(elapsed, 1.0)
+
+    def test_good_enough_returns_early(self):
+        providers = self._providers(3)
+
+        def fake_latency(endpoint: str, **kwargs) -> float:
+            if endpoint == providers[2].endpoint:
+                return 5.0
+            time.sleep(1)
+            return 1.0
+
+        with patch("app.pool.measure_latency", side_effect=fake_latency):
+            start = time.monotonic()
+            chosen = fastest_provider(providers, deadline_seconds=5, good_enough_ms=10)
+            elapsed = time.monotonic() - start
+        self.assertEqual(chosen.id, "p2")
+        self.assertLess(elapsed, 0.8)
+
+    def test_silent_providers_rank_behind_measured_ones(self):
+        providers = self._providers(2)
+
+        def fake_latency(endpoint: str, **kwargs) -> float:
+            if endpoint == providers[0].endpoint:
+                raise TimeoutError("no echo reply")
+            return 80.0
+
+        with patch("app.pool.measure_latency", side_effect=fake_latency):
+            self.assertEqual(fastest_provider(providers).id, "p1")
+
+    def test_pool_without_probe_ports_is_still_ranked_by_latency(self):
+        # Nothing in this pool runs an echo responder: one endpoint refuses TCP, the other accepts it.
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as listener, socket.socket() as closed:
+            listener.bind(("127.0.0.1", 0))
+            listener.listen()
+            closed.bind(("127.0.0.1", 0))
+            providers = [
+                Provider("p1", f"127.0.0.1:{closed.getsockname()[1]}", KEY, "0.0.0.0/0"),
+                Provider("p2", f"127.0.0.1:{listener.getsockname()[1]}", KEY, "0.0.0.0/0"),
+            ]
+            measured = {}
+            with (
+                patch.dict("os.environ", {"ALLOW_PRIVATE_ENDPOINTS": "true"}),
+                patch("app.pool.probe_rtt", side_effect=AssertionError("echo probe without a probe port")),
+            ):
+                chosen = fastest_provider(
+                    providers,
+                    timeout=1,
+                    on_result=lambda provider, latency: measured.__setitem__(provider.id, latency),
+                )
+        self.assertIn(chosen.id, ("p1", "p2"))
+        self.assertEqual(set(measured), {"p1", "p2"})
+
+    def test_measure_latency_uses_probe_port_echo(self):
+        responder = EchoResponder("127.0.0.1", 0)
+        responder.start()
+        try:
+            latency = measure_latency("127.0.0.1:9", timeout=1, samples=3, probe_port=responder.port)
+        finally:
+            responder.stop()
+        self.assertLess(latency, 1000)
+
+    def test_no_reachable_providers_raises(self):
+        with patch("app.pool.measure_latency", side_effect=OSError("unreachable")):
+            with self.assertRaises(RuntimeError):
+                fastest_provider(self._providers(3))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,79 @@
+import importlib.util
+import threading
+import unittest
+from http.server import ThreadingHTTPServer
+from pathlib import Path
+
+from app.pool import PoolClient
+
+MOCK_PATH = Path(__file__).resolve().parent.parent / "scripts" / "mock_orchestrator.py"
+KEY = "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA="
+
+
+def load_mock():
+    spec = importlib.util.spec_from_file_location("mock_orchestrator", MOCK_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class TestProviderListRevalidation(unittest.TestCase):
+    def setUp(self):
+        self.mock = load_mock()
+        self.mock.Handler.log_message = lambda *args: None
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.mock.Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        base = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.client = PoolClient(base + "/providers", timeout=2, pool_token="tok")
+
+    def tearDown(self):
+        self.client.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_unchanged_list_revalidates_with_304(self):
+        first = self.client.fetch_providers()
+        self.assertEqual(self.client.last_fetch, "full")
+        second = self.client.fetch_providers()
+        self.assertEqual(self.client.last_fetch, "not_modified")
+        self.assertEqual([p.id for p in first], [p.id for p in second])
+
+    def test_changes_arrive_as_delta(self):
+        self.client.fetch_providers()
+        self.mock.PROVIDERS.upsert({"id": "new-node", "endpoint": "203.0.113.7:51820", "public_key": KEY, "health": "ok"})
+        self.mock.PROVIDERS.remove("mock-0")
+        providers = self.client.fetch_providers()
+        self.assertEqual(self.client.last_fetch, "delta")
+        ids = {p.id for p in providers}
+        self.assertIn("new-node", ids)
+        self.assertNotIn("mock-0", ids)
+        self.assertEqual(len(ids), len(self.mock.ENDPOINTS))
+
+    def test_unhealthy_update_drops_provider(self):
+        self.client.fetch_providers()
+        self.mock.PROVIDERS.upsert({"id": "mock-1", "endpoint": "198.51.100.11:51820", "public_key": KEY, "health": "down"})
+        ids = {p.id for p in self.client.fetch_providers()}
+        self.assertNotIn("mock-1", ids)
+
+    def test_full_list_streams_as_ndjson(self):
+        providers = self.client.fetch_providers()
+        self.assertEqual(len(providers), len(self.mock.ENDPOINTS))
+        self.assertEqual(providers[0].public_key, KEY)
+
+    def test_token_change_forces_full_fetch(self):
+        self.client.fetch_providers()
+        self.client.set_token("other")
+        self.client.fetch_providers()
+        self.assertEqual(self.client.last_fetch, "full")
+
+    def test_expiring_leases_force_full_fetch(self):
+        self.client.fetch_providers()
+        for provider in self.client._providers.values():
+            provider.lease_exp = 1
+        self.client.fetch_providers()
+        self.assertEqual(self.client.last_fetch, "full")
+
+
+if __name__ == "__main__":
+    unittest.main()
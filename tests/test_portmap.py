@@ -0,0 +1,113 @@
+import socket
+import tempfile
+import threading
+import unittest
+
+from app.portmap import PortMapper, default_gateway, lan_address, natpmp_map
+from fixtures.fake_igd import FakeIGD, FakeNatPmp
+
+
+def closed_udp_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class TestNatPmp(unittest.TestCase):
+    def test_maps_and_reports_granted_port_and_lifetime(self):
+        gateway = FakeNatPmp(external_port=40001, lifetime=600).start()
+        self.addCleanup(gateway.stop)
+        mapping = natpmp_map("127.0.0.1", 51820, 51820, lifetime=3600, timeout=1, port=gateway.port)
+        self.assertEqual((mapping.method, mapping.external_port, mapping.lifetime), ("natpmp", 40001, 600))
+        self.assertEqual(gateway.requests, [(51820, 51820, 3600)])
+
+    def test_default_gateway_parses_route_table(self):
+        with tempfile.NamedTemporaryFile("w", suffix="route") as handle:
+            handle.write("Iface\tDestination\tGateway\tFlags\n")
+            handle.write("eth0\t0000A8C0\t00000000\t0001\n")
+            handle.write("eth0\t00000000\t0101A8C0\t0003\n")
+            handle.flush()
+            self.assertEqual(default_gateway(handle.name), "192.168.1.1")
+
+    def test_lan_address_is_the_source_toward_the_gateway(self):
+        self.assertEqual(lan_address("127.0.0.1"), "127.0.0.1")
+        self.assertIsNone(lan_address(None))
+
+
+class TestPortMapper(unittest.TestCase):
+    def mapper(self, igd: FakeIGD | None = None, natpmp: FakeNatPmp | None = None, **kwargs) -> PortMapper:
+        mapper = PortMapper(
+            51820,
+            timeout=0.5,
+            local_ip_fn=lambda: "192.168.1.20",
+            gateway_fn=lambda: "127.0.0.1",
+            ssdp_address=igd.ssdp_address if igd else ("127.0.0.1", closed_udp_port()),
+            natpmp_port=natpmp.port if natpmp else closed_udp_port(),
+            **kwargs,
+        )
+        self.addCleanup(mapper.stop, remove=False)
+        return mapper
+
+    def test_upnp_mapping_discovers_once_and_renews_with_cached_control_url(self):
+        igd = FakeIGD().start()
+        self.addCleanup(igd.stop)
+        mapper = self.mapper(igd, lease_seconds=120)
+        mapping = mapper.map_once()
+        self.assertEqual((mapping.method, mapping.external_port, mapping.lifetime), ("upnp", 51820, 120))
+        self.assertEqual(mapping.external_ip, "203.0.113.7")
+        self.assertEqual(igd.mappings[(51820, "UDP")]["NewInternalClient"], "192.168.1.20")
+        self.assertEqual(mapper.next_refresh_delay(), 60)
+
+        mapper.map_once()
+        self.assertEqual(igd.searches, 1)
+        self.assertEqual(igd.actions.count("AddPortMapping"), 2)
+
+        mapper.remove()
+        self.assertEqual(igd.mappings, {})
+
+    def test_falls_back_to_permanent_lease(self):
+        igd = FakeIGD(permanent_only=True).start()
+        self.addCleanup(igd.stop)
+        mapping = self.mapper(igd, lease_seconds=120).map_once()
+        self.assertEqual(mapping.lifetime, 0)
+        self.assertEqual(igd.mappings[(51820, "UDP")]["NewLeaseDuration"], "0")
+
+    def test_gateway_failure_drops_mapping_and_rediscovers(self):
+        igd = FakeIGD().start()
+        self.addCleanup(igd.stop)
+        changes = []
+        mapper = self.mapper(igd, on_change=changes.append)
+        mapper.map_once()
+        igd.fail = True
+        self.assertIsNone(mapper.map_once())
+        self.assertIsNone(mapper.igd)
+        igd.fail = False
+        self.assertIsNotNone(mapper.map_once())
+        self.assertEqual(igd.searches, 2)
+        self.assertEqual([change is not None for change in changes], [True, False, True])
+
+    def test_prefers_natpmp_and_keeps_external_port_on_renewal(self):
+        gateway = FakeNatPmp(external_port=40001, lifetime=60).start()
+        self.addCleanup(gateway.stop)
+        mapper = self.mapper(natpmp=gateway)
+        self.assertEqual(mapper.map_once().external_port, 40001)
+        mapper.map_once()
+        self.assertEqual(gateway.requests[1][1], 40001)
+        self.assertEqual(mapper.next_refresh_delay(), 30)
+        mapper.remove()
+        self.assertEqual(gateway.requests[-1][2], 0)
+
+    def test_background_start_does_not_block(self):
+        igd = FakeIGD().start()
+        self.addCleanup(igd.stop)
+        mapped = threading.Event()
+        mapper = self.mapper(igd, on_change=lambda mapping: mapped.set())
+        mapper.start()
+        self.assertTrue(mapped.wait(timeout=3))
+        self.assertEqual(mapper.wait(0).method, "upnp")
+        mapper.stop()
+        self.assertEqual(igd.mappings, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
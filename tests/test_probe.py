@@ -0,0 +1,65 @@
+import socket
+import unittest
+
+from app.probe import PROBE_MAGIC, PROBE_PACKET, EchoResponder, RTTStats, probe_connect_rtt, probe_rtt
+
+
+class TestRTTStats(unittest.TestCase):
+    def test_summary_statistics(self):
+        stats = RTTStats(sent=4, samples_ms=[10.0, 14.0, 12.0])
+        self.assertEqual(stats.received, 3)
+        self.assertAlmostEqual(stats.loss, 0.25)
+        self.assertEqual(stats.min_ms, 10.0)
+        self.assertEqual(stats.median_ms, 12.0)
+        self.assertAlmostEqual(stats.jitter_ms, 3.0)
+
+
+class TestProbeRTT(unittest.TestCase):
+    def setUp(self):
+        self.responder = EchoResponder("127.0.0.1", 0)
+        self.responder.start()
+
+    def tearDown(self):
+        self.responder.stop()
+
+    def test_collects_samples_from_local_responder(self):
+        stats = probe_rtt("127.0.0.1", self.responder.port, samples=5, timeout=1.0)
+        self.assertEqual(stats.sent, 5)
+        self.assertEqual(stats.received, 5)
+        self.assertGreater(stats.median_ms, 0.0)
+        self.assertLessEqual(stats.min_ms, stats.median_ms)
+
+    def test_silent_endpoint_times_out(self):
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as silent:
+            silent.bind(("127.0.0.1", 0))
+            port = silent.getsockname()[1]
+            with self.assertRaises(TimeoutError):
+                probe_rtt("127.0.0.1", port, samples=2, timeout=0.2)
+
+    def test_responder_ignores_foreign_packets(self):
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.settimeout(0.3)
+            sock.sendto(b"\x01" * PROBE_PACKET.size, ("127.0.0.1", self.responder.port))
+            with self.assertRaises(socket.timeout):
+                sock.recvfrom(64)
+            packet = PROBE_PACKET.pack(PROBE_MAGIC, b"12345678", 7)
+            sock.sendto(packet, ("127.0.0.1", self.responder.port))
+            data, _ = sock.recvfrom(64)
+        self.assertEqual(data, packet)
+
+
+class TestProbeConnectRTT(unittest.TestCase):
+    def test_accepted_and_refused_connects_both_count(self):
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as listener, socket.socket() as closed:
+            listener.bind(("127.0.0.1", 0))
+            listener.listen()
+            closed.bind(("127.0.0.1", 0))
+            accepted = probe_connect_rtt("127.0.0.1", listener.getsockname()[1], samples=3, timeout=1.0)
+            refused = probe_connect_rtt("127.0.0.1", closed.getsockname()[1], samples=3, timeout=1.0)
+        self.assertEqual(accepted.received, 3)
+        self.assertEqual(refused.received, 3)
+        self.assertLess(refused.median_ms, 1000)
+
+
+if __name__ == "__main__":
+    unittest.main()
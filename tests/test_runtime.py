@@ -0,0 +1,347 @@
+import asyncio
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+from app.main import DVPNService
+from app.pool import Provider
+from app.portmap import PortMapping
+from app.runtime import ServiceRuntime, StartupTrace
+from fixtures.byte_source import ByteSource
+from fixtures.clock import FakeClock
+from fixtures.service import service_environ
+
+KEY = "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA="
+OFFLINE = {"ENABLE_WIREGUARD": "false", "ENABLE_SOCKS": "false", "STUN_ENABLED": "false"}
+
+
+class TestServiceRuntime(unittest.TestCase):
+    def test_interrupt_cancels_session_and_orders_cleanup(self):
+        runtime = ServiceRuntime()
+        events: list[str] = []
+        result: dict = {}
+
+        def slow_tunnel_step() -> None:
+            time.sleep(0.2)
+            events.append("tunnel_step_done")
+
+        async def session() -> None:
+            await runtime.exclusive(slow_tunnel_step)
+            await asyncio.sleep(30)
+
+        async def main() -> None:
+            threading.Timer(0.05, runtime.wake, kwargs={"interrupt": True}).start()
+            started = time.monotonic()
+            result["completed"] = await runtime.run_interruptible(session())
+            result["elapsed"] = time.monotonic() - started
+            await runtime.exclusive(events.append, "cleanup")
+
+        runtime.run(main)
+        self.assertFalse(result["completed"])
+        self.assertLess(result["elapsed"], 0.2)
+        self.assertEqual(events, ["tunnel_step_done", "cleanup"])
+
+    def test_control_thread_calls_queue_behind_the_tunnel_step(self):
+        runtime = ServiceRuntime()
+        events: list[str] = []
+
+        def slow_tunnel_step() -> None:
+            time.sleep(0.2)
+            events.append("tunnel_step_done")
+
+        async def main() -> None:
+            step = asyncio.ensure_future(runtime.exclusive(slow_tunnel_step))
+            await asyncio.sleep(0.05)
+            control = threading.Thread(target=runtime.call_exclusive, args=(events.append, "teardown"))
+            control.start()
+            await step
+            await runtime.blocking(control.join, 2)
+
+        runtime.run(main)
+        self.assertEqual(events, ["tunnel_step_done", "teardown"])
+        # Once the loop is gone the call runs inline.
+        runtime.call_exclusive(events.append, "after_exit")
+        self.assertEqual(events[-1], "after_exit")
+
+    def test_plain_wake_does_not_cancel_session(self):
+        runtime = ServiceRuntime()
+        result: dict = {}
+
+        async def session() -> None:
+            await asyncio.sleep(0.2)
+
+        async def main() -> None:
+            threading.Timer(0.05, runtime.wake).start()
+            result["completed"] = await runtime.run_interruptible(session())
+
+        runtime.run(main)
+        self.assertTrue(result["completed"])
+
+
+class TestStartupTrace(unittest.TestCase):
+    def test_records_steps_failures_and_first_mark(self):
+        clock = FakeClock(0.0)
+        trace = StartupTrace(clock=clock)
+
+        async def work(seconds: float, fail: bool = False) -> str:
+            clock.now += seconds
+            if fail:
+                raise RuntimeError("boom")
+            return "done"
+
+        async def main() -> None:
+            self.assertEqual(await trace.step("network", work(0.5)), "done")
+            with self.assertRaises(RuntimeError):
+                await trace.step("upnp", work(1.0, fail=True))
+
+        asyncio.run(main())
+        self.assertEqual(trace.mark("first_tunnel"), 1.5)
+        clock.now = 9.0
+        self.assertEqual(trace.mark("first_tunnel"), 1.5)
+        snapshot = trace.snapshot()
+        self.assertEqual(snapshot["steps"][0], {"name": "network", "start": 0.0, "end": 0.5, "error": None})
+        self.assertEqual(snapshot["steps"][1]["error"], "boom")
+        self.assertIn("first_tunnel@1.50s", trace.render())
+
+
+class TestParallelStartup(unittest.TestCase):
+    def test_first_tunnel_does_not_wait_for_slow_startup_steps(self):
+        def slow(seconds: float, value):
+            def run(*args, **kwargs):
+                time.sleep(seconds)
+                return value
+
+            return run
+
+        with tempfile.TemporaryDirectory() as tmp:
+            environ = service_environ(tmp) | OFFLINE | {
+                "AUTO_NETWORK_CONFIG": "true",
+                "UPNP_ENABLED": "true",
+                "BANDWIDTH_TOTAL_MBPS": "0",
+            }
+            with patch.dict(os.environ, environ):
+                service = DVPNService()
+            service.subscription_active = lambda: True
+            service.pay_cache.is_active = lambda provider_id: True
+            service.pool.fetch_providers = slow(0.1, [Provider("a", "8.8.8.8:51820", KEY, "0.0.0.0/0")])
+            service.pool.mark_approved = lambda provider, token: None
+            service.pool.prune_dead_endpoints = lambda: {"removed": 0, "remaining": 1}
+            endpoints = []
+            remapped = threading.Event()
+
+            def register_node(**kwargs):
+                endpoints.append(kwargs["endpoint"])
+                if len(endpoints) == 2:
+                    remapped.set()
+
+            service.pool.register_node = register_node
+            mapper = service.port_mapper
+            with (
+                patch("app.main.ensure_wg_private_key", return_value=KEY),
+                patch("app.main.detect_local_ip", return_value="192.168.1.5"),
+                patch.object(service.public_ip_detector, "detect", slow(0.2, "203.0.113.9")),
+                patch.object(mapper, "_map_natpmp", slow(1.0, PortMapping("natpmp", "UDP", 51820, 40123, 3600))),
+                patch.object(mapper, "_map_upnp", return_value=None),
+                patch.object(mapper, "remove"),
+                patch("app.main.measure_throughput_mbps", slow(1.0, 42.0)),
+                patch("app.main.fastest_provider", lambda providers, **kwargs: providers[0]),
+            ):
+                worker = threading.Thread(target=service.loop, daemon=True)
+                worker.start()
+                try:
+                    self.assertTrue(remapped.wait(timeout=3))
+                finally:
+                    service.exit()
+                    worker.join(timeout=2)
+
+        startup = service.status()["startup"]
+        steps = {step["name"]: step for step in startup["steps"]}
+        first_tunnel = startup["marks"]["first_tunnel"]
+        self.assertGreaterEqual(first_tunnel, steps["network"]["end"])
+        self.assertLess(first_tunnel, startup["marks"]["port_mapped"])
+        self.assertLess(first_tunnel, steps["bandwidth"]["end"])
+        # Registration does not wait for the gateway; the late mapping re-advertises the node.
+        self.assertEqual(endpoints, ["203.0.113.9:51820", "203.0.113.9:40123"])
+        self.assertEqual(service.bandwidth.total_mbps, 42.0)
+        self.assertEqual(service.wg_public_key, KEY)
+        gauge = next(
+            line for line in service.metrics_text().splitlines() if line.startswith("dvpn_time_to_first_tunnel_seconds ")
+        )
+        self.assertAlmostEqual(float(gauge.split()[1]), first_tunnel, places=2)
+
+
+class TestNodeRegistration(unittest.TestCase):
+    def test_mapping_that_lands_mid_registration_is_advertised(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            environ = service_environ(tmp) | OFFLINE | {"AUTO_NETWORK_CONFIG": "true", "UPNP_ENABLED": "false"}
+            with patch.dict(os.environ, environ):
+                service = DVPNService()
+        service.wg_public_key = KEY
+        service.network_detected = True
+        service.last_detected_public_ip = "203.0.113.9"
+        endpoints = []
+
+        def register_node(**kwargs):
+            endpoints.append(kwargs["endpoint"])
+            if len(endpoints) == 1:
+                service.on_port_mapping(PortMapping("natpmp", "UDP", 51820, 40123, 3600))
+
+        service.pool.register_node = register_node
+        service.maybe_register_node()
+        self.assertEqual(endpoints, ["203.0.113.9:51820", "203.0.113.9:40123"])
+        self.assertEqual(service.registered_endpoint, "203.0.113.9:40123")
+
+    def test_probe_port_is_advertised_once_mapped(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            environ = service_environ(tmp) | OFFLINE | {"AUTO_NETWORK_CONFIG": "true", "UPNP_ENABLED": "true"}
+            with patch.dict(os.environ, environ):
+                service = DVPNService()
+        service.wg_public_key = KEY
+        service.network_detected = True
+        service.last_detected_public_ip = "203.0.113.9"
+        probe_ports = []
+        service.pool.register_node = lambda **kwargs: probe_ports.append(kwargs["metadata"]["probe_port"])
+        service.maybe_register_node()
+        service.on_probe_port_mapping(PortMapping("natpmp", "UDP", 51821, 40999, 3600))
+        service.on_probe_port_mapping(PortMapping("natpmp", "UDP", 51821, 40999, 3600))
+        # Behind the gateway the unmapped port is not advertised; the mapping re-registers once.
+        self.assertEqual(probe_ports, [None, 40999])
+
+
+class TestProviderStandby(unittest.TestCase):
+    def test_server_config_waits_for_the_generated_key(self):
+        def generate_key():
+            time.sleep(0.2)
+            os.environ["WG_PRIVATE_KEY"] = "generated-private-key"
+            return KEY
+
+        with tempfile.TemporaryDirectory() as tmp:
+            environ = service_environ(tmp) | OFFLINE | {
+                "AUTO_NETWORK_CONFIG": "false",
+                "BANDWIDTH_TOTAL_MBPS": "100",
+                "PROVIDER_STANDBY_SECONDS": "1",
+            }
+            with patch.dict(os.environ, environ):
+                os.environ.pop("WG_PRIVATE_KEY", None)
+                service = DVPNService()
+                keys_seen = []
+                service.ensure_provider_forwarding = lambda: None
+                service.ensure_probe_responder = lambda: None
+                service.ensure_provider_server_up = lambda: keys_seen.append(os.environ.get("WG_PRIVATE_KEY"))
+                service.fetch_provider_claims = lambda wait_seconds: 0
+
+                async def main() -> None:
+                    service.start_local_startup()
+                    await service.provider_standby()
+
+                with patch("app.main.ensure_wg_private_key", generate_key):
+                    service.runtime.run(main)
+        self.assertEqual(keys_seen, ["generated-private-key"])
+
+
+class TestServiceControl(unittest.TestCase):
+    def test_control_actions_take_effect_immediately(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            environ = service_environ(tmp) | OFFLINE | {
+                "BANDWIDTH_TOTAL_MBPS": "100",
+                "RETRY_SECONDS": "30",
+                "AUTO_NETWORK_CONFIG": "false",
+                "NODE_REGISTER_ENABLED": "false",
+            }
+            with patch.dict(os.environ, environ):
+                service = DVPNService()
+            checks = threading.Semaphore(0)
+
+            def inactive() -> bool:
+                checks.release()
+                return False
+
+            service.subscription_active = inactive
+            worker = threading.Thread(target=service.loop, daemon=True)
+            worker.start()
+            try:
+                self.assertTrue(checks.acquire(timeout=2))
+                started = time.monotonic()
+                service.stop()
+                service.start()
+                # A fresh payment check means the 30 s retry sleep was cancelled, not waited out.
+                self.assertTrue(checks.acquire(timeout=2))
+                self.assertLess(time.monotonic() - started, 2)
+            finally:
+                service.exit()
+                worker.join(timeout=2)
+            self.assertFalse(worker.is_alive())
+
+
+class TestBandwidthRemeasure(unittest.TestCase):
+    def test_background_remeasure_updates_the_allocator(self):
+        source = ByteSource(rate=500_000)
+        source.start()
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                environ = service_environ(tmp) | OFFLINE | {
+                    "AUTO_NETWORK_CONFIG": "false",
+                    "BANDWIDTH_TOTAL_MBPS": "0",
+                    "BANDWIDTH_TEST_URL": source.url,
+                    "BANDWIDTH_SAMPLE_SECONDS": "3",
+                    "BANDWIDTH_STREAMS": "2",
+                    "BANDWIDTH_REMEASURE_SECONDS": "0.2",
+                }
+                with patch.dict(os.environ, environ):
+                    service = DVPNService()
+                service.desired_connected = False
+                service.bandwidth.open_connection("a")
+                worker = threading.Thread(target=service.loop, daemon=True)
+                worker.start()
+                try:
+                    deadline = time.monotonic() + 8
+                    while service.bandwidth.total_mbps > 12 and time.monotonic() < deadline:
+                        time.sleep(0.05)
+                    self.assertAlmostEqual(service.bandwidth.total_mbps, 8.0, delta=1.6)
+                    source.rate = 1_000_000
+                    while service.bandwidth.total_mbps < 13 and time.monotonic() < deadline:
+                        time.sleep(0.05)
+                    self.assertAlmostEqual(service.bandwidth.total_mbps, 16.0, delta=3.2)
+                    self.assertAlmostEqual(service.bandwidth.grants()["a"], service.bandwidth.total_mbps / 2)
+                finally:
+                    service.exit()
+                    worker.join(timeout=2)
+        finally:
+            source.stop()
+
+    def test_remeasure_waits_for_an_idle_link(self):
+        calls = []
+
+        def measure(*args, **kwargs):
+            calls.append(time.monotonic())
+            return 50.0
+
+        with tempfile.TemporaryDirectory() as tmp:
+            environ = service_environ(tmp) | OFFLINE | {
+                "AUTO_NETWORK_CONFIG": "false",
+                "BANDWIDTH_TOTAL_MBPS": "100",
+                "BANDWIDTH_REMEASURE_SECONDS": "0.05",
+            }
+            with patch.dict(os.environ, environ):
+                service = DVPNService()
+        service.current_provider = Provider("a", "8.8.8.8:51820", KEY, "0.0.0.0/0")
+
+        async def main() -> None:
+            task = asyncio.ensure_future(service.remeasure_bandwidth())
+            await asyncio.sleep(0.3)
+            self.assertEqual(calls, [])
+            service.current_provider = None
+            await asyncio.sleep(0.3)
+            task.cancel()
+
+        with patch("app.main.measure_throughput_mbps", measure):
+            service.runtime.run(main)
+        self.assertTrue(calls)
+        self.assertEqual(service.bandwidth.total_mbps, 50.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
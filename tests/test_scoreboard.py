@@ -0,0 +1,77 @@
+import random
+import tempfile
+import unittest
+from pathlib import Path
+
+from app.pool import Provider
+from app.scoreboard import ProviderScoreboard
+from fixtures.clock import FakeClock
+
+KEY = "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA="
+
+
+class TestProviderScoreboard(unittest.TestCase):
+    def test_rtt_is_exponentially_weighted(self):
+        board = ProviderScoreboard(alpha=0.5)
+        board.record_rtt("a", 100.0)
+        board.record_rtt("a", 50.0)
+        self.assertAlmostEqual(board.get("a").rtt_ms, 75.0)
+
+    def test_failures_decay_with_half_life(self):
+        clock = FakeClock()
+        board = ProviderScoreboard(half_life_seconds=100, clock=clock)
+        board.record_handshake("a", success=False)
+        board.record_handshake("a", success=False)
+        clock.now += 100
+        self.assertAlmostEqual(board.get("a").failures, 1.0)
+
+    def test_bounded_entries_evict_stalest(self):
+        clock = FakeClock()
+        board = ProviderScoreboard(max_entries=2, clock=clock)
+        board.record_rtt("a", 10.0)
+        clock.now += 1
+        board.record_rtt("b", 10.0)
+        clock.now += 1
+        board.record_rtt("c", 10.0)
+        self.assertEqual(len(board), 2)
+        self.assertIsNone(board.get("a"))
+
+    def test_persists_across_instances(self):
+        clock = FakeClock()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "scores.json"
+            board = ProviderScoreboard(path, clock=clock)
+            board.record_rtt("a", 42.0)
+            board.record_handshake("a", success=True, seconds=1.5)
+            board.save()
+
+            restored = ProviderScoreboard(path, clock=clock)
+            restored.load()
+        score = restored.get("a")
+        self.assertAlmostEqual(score.rtt_ms, 42.0)
+        self.assertAlmostEqual(score.handshake_s, 1.5)
+        self.assertAlmostEqual(score.successes, 1.0)
+
+    def test_weighted_sample_prefers_good_providers(self):
+        board = ProviderScoreboard()
+        providers = [Provider("bad", "8.8.8.8:51820", KEY, "0.0.0.0/0"), Provider("good", "1.1.1.1:51820", KEY, "0.0.0.0/0")]
+        for _ in range(10):
+            board.record_handshake("bad", success=False)
+            board.record_handshake("good", success=True, seconds=0.5)
+        board.record_rtt("bad", 400.0)
+        board.record_rtt("good", 20.0)
+        rng = random.Random(1)
+        firsts = [providers[board.weighted_sample(providers, 1, rng=rng)[0]].id for _ in range(200)]
+        self.assertGreater(firsts.count("good"), 180)
+
+    def test_weighted_sample_deprioritizes_previous_provider(self):
+        board = ProviderScoreboard()
+        providers = [Provider(name, "8.8.8.8:51820", KEY, "0.0.0.0/0") for name in ("a", "b", "c")]
+        picked = board.weighted_sample(providers, 3, previous_provider_id="a", rng=random.Random(0))
+        ordered = [providers[index] for index in picked]
+        self.assertEqual({p.id for p in ordered}, {"a", "b", "c"})
+        self.assertEqual(ordered[-1].id, "a")
+
+
+if __name__ == "__main__":
+    unittest.main()
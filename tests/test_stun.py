@@ -0,0 +1,135 @@
+import os
+import socket
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from app.main import DVPNService
+from app.stun import (
+    StunDetector,
+    binding_request,
+    binding_response,
+    classify_nat,
+    discover_nat,
+    parse_binding_response,
+)
+from fixtures.clock import FakeClock
+from fixtures.service import service_environ
+from fixtures.stun_server import StunResponder
+
+TRANSACTION = bytes(range(12))
+
+
+class TestStunMessages(unittest.TestCase):
+    def test_xor_mapped_address_round_trip(self):
+        for mapped in (("203.0.113.7", 51820), ("2001:db8::7", 40000)):
+            with self.subTest(mapped=mapped):
+                self.assertEqual(parse_binding_response(binding_response(TRANSACTION, mapped), TRANSACTION), mapped)
+
+    def test_rejects_foreign_transactions_and_requests(self):
+        response = binding_response(TRANSACTION, ("203.0.113.7", 51820))
+        self.assertIsNone(parse_binding_response(response, bytes(12)))
+        self.assertIsNone(parse_binding_response(binding_request(TRANSACTION), TRANSACTION))
+        self.assertIsNone(parse_binding_response(b"short", TRANSACTION))
+
+    def test_classify_nat(self):
+        self.assertEqual(classify_nat([], "10.0.0.2", 51820), "blocked")
+        self.assertEqual(classify_nat([("10.0.0.2", 51820)] * 2, "10.0.0.2", 51820), "open")
+        self.assertEqual(classify_nat([("203.0.113.7", 6000)], "10.0.0.2", 51820), "unknown")
+        self.assertEqual(classify_nat([("203.0.113.7", 6000)] * 2, "10.0.0.2", 51820), "endpoint_independent")
+        self.assertEqual(classify_nat([("203.0.113.7", 6000), ("203.0.113.7", 6001)], "10.0.0.2", 51820), "symmetric")
+
+
+class TestStunDiscovery(unittest.TestCase):
+    def responders(self, *mapped):
+        started = []
+        for mapping in mapped:
+            responder = StunResponder("127.0.0.1", 0, mapped=mapping)
+            responder.start()
+            self.addCleanup(responder.stop)
+            started.append(responder)
+        return started
+
+    def test_discovers_mapping_for_requested_port(self):
+        first, second = self.responders(None, None)
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+            probe.bind(("127.0.0.1", 0))
+            free_port = probe.getsockname()[1]
+        discovery = discover_nat([first.address, second.address], local_port=free_port, local_ip="127.0.0.1", timeout=2, bind_host="127.0.0.1")
+        self.assertEqual(discovery.local_port, free_port)
+        self.assertEqual(discovery.mapped, ("127.0.0.1", free_port))
+        self.assertEqual(discovery.nat_type, "open")
+
+    def test_classifies_endpoint_independent_and_symmetric_nat(self):
+        shared = self.responders(lambda source: ("203.0.113.7", 6000), lambda source: ("203.0.113.7", 6000))
+        discovery = discover_nat([r.address for r in shared], local_ip="10.0.0.2", timeout=2, bind_host="127.0.0.1")
+        self.assertEqual(discovery.nat_type, "endpoint_independent")
+        self.assertEqual((discovery.mapped_ip, discovery.mapped_port), ("203.0.113.7", 6000))
+
+        per_destination = self.responders(lambda source: ("203.0.113.7", 6001), lambda source: ("203.0.113.7", 6002))
+        discovery = discover_nat([r.address for r in per_destination], local_ip="10.0.0.2", timeout=2, bind_host="127.0.0.1")
+        self.assertEqual(discovery.nat_type, "symmetric")
+
+    def test_busy_port_falls_back_to_ephemeral(self):
+        (responder,) = self.responders(None)
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as busy:
+            busy.bind(("127.0.0.1", 0))
+            port = busy.getsockname()[1]
+            discovery = discover_nat([responder.address], local_port=port, timeout=2, bind_host="127.0.0.1")
+        self.assertNotEqual(discovery.local_port, port)
+        self.assertEqual(discovery.mapped_port, discovery.local_port)
+
+    def test_unanswered_servers_time_out(self):
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as silent:
+            silent.bind(("127.0.0.1", 0))
+            discovery = discover_nat([f"127.0.0.1:{silent.getsockname()[1]}"], timeout=0.3, bind_host="127.0.0.1")
+        self.assertEqual(discovery.nat_type, "blocked")
+        self.assertIsNone(discovery.mapped)
+
+    def test_detector_caches_per_local_ip(self):
+        (responder,) = self.responders(None)
+        clock = FakeClock(0.0)
+        detector = StunDetector([responder.address], timeout=2, ttl_seconds=60, bind_host="127.0.0.1", clock=clock)
+        self.assertIsNotNone(detector.discover("192.168.1.5"))
+        self.assertIsNotNone(detector.discover("192.168.1.5"))
+        self.assertEqual(responder.requests, 1)
+        detector.discover("10.1.0.9")
+        self.assertEqual(responder.requests, 2)
+        clock.now = 61.0
+        detector.discover("10.1.0.9")
+        self.assertEqual(responder.requests, 3)
+
+
+class TestStunRegistration(unittest.TestCase):
+    def test_registration_advertises_stun_mapping_without_https_lookup(self):
+        responders = []
+        for _ in range(2):
+            responder = StunResponder("127.0.0.1", 0, mapped=lambda source: ("203.0.113.7", 6000))
+            responder.start()
+            self.addCleanup(responder.stop)
+            responders.append(responder)
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+            probe.bind(("127.0.0.1", 0))
+            node_port = probe.getsockname()[1]
+        with tempfile.TemporaryDirectory() as tmp:
+            environ = service_environ(tmp) | {
+                "BANDWIDTH_TOTAL_MBPS": "100",
+                "NODE_PORT": str(node_port),
+                "STUN_SERVERS": ",".join(responder.address for responder in responders),
+            }
+            with patch.dict(os.environ, environ):
+                service = DVPNService()
+        service.wg_public_key = "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA="
+        registrations = []
+        service.pool.register_node = lambda **kwargs: registrations.append(kwargs)
+        with (
+            patch("app.main.detect_local_ip", return_value="10.0.0.2"),
+            patch.object(service.public_ip_detector, "detect", side_effect=AssertionError("HTTPS lookup used")),
+        ):
+            service.maybe_register_node()
+        self.assertEqual(registrations[0]["endpoint"], "203.0.113.7:6000")
+        self.assertEqual(registrations[0]["metadata"]["nat_type"], "endpoint_independent")
+
+
+if __name__ == "__main__":
+    unittest.main()
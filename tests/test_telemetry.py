@@ -0,0 +1,115 @@
+import json
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+from app.main import DVPNService
+from app.telemetry import TunnelTelemetry
+from app.wireguard import Peer, parse_dump
+from fixtures.clock import FakeClock
+from fixtures.service import fake_wg_environ
+
+KEY_A = "A" * 43 + "="
+KEY_B = "B" * 43 + "="
+
+
+class Counters:
+    def __init__(self) -> None:
+        self.peers: dict[str, tuple[int, int]] = {}
+
+    def __call__(self) -> dict[str, Peer]:
+        return {key: Peer(key, latest_handshake=1_700_000_000, rx_bytes=rx, tx_bytes=tx) for key, (rx, tx) in self.peers.items()}
+
+
+class TestParseDump(unittest.TestCase):
+    def test_dump_rows_carry_transfer_counters(self):
+        output = (
+            "PRIVATE\tPUBLIC\t51820\toff\n"
+            f"{KEY_A}\t(none)\t198.51.100.7:40000\t10.66.0.2/32\t1700000000\t1200\t3400\t25\n"
+            f"{KEY_B}\t(none)\t(none)\t10.66.0.3/32\t0\t0\t0\toff\n"
+        )
+        peers = parse_dump(output)
+        self.assertEqual(
+            peers[KEY_A], Peer(KEY_A, "10.66.0.2/32", "198.51.100.7:40000", 25, 1700000000, 1200, 3400)
+        )
+        self.assertEqual((peers[KEY_B].endpoint, peers[KEY_B].latest_handshake, peers[KEY_B].rx_bytes), (None, 0, 0))
+
+
+class TestTunnelTelemetry(unittest.TestCase):
+    def test_rates_come_from_counter_deltas(self):
+        clock = FakeClock()
+        counters = Counters()
+        telemetry = TunnelTelemetry(counters, clock=clock, wall=lambda: 1_700_000_030)
+        counters.peers[KEY_A] = (1_000_000, 0)
+        peers, _ = telemetry.sample()
+        self.assertIsNone(peers[KEY_A].latest)
+        clock.now += 2
+        counters.peers[KEY_A] = (3_500_000, 500_000)
+        peers, _ = telemetry.sample()
+        latest = peers[KEY_A].latest
+        self.assertEqual((latest.rx_bytes, latest.tx_bytes), (2_500_000, 500_000))
+        self.assertAlmostEqual(latest.rx_mbps, 10.0)
+        self.assertAlmostEqual(latest.tx_mbps, 2.0)
+        snapshot = telemetry.snapshot()[KEY_A]
+        self.assertEqual(snapshot["rx_mbps"], 10.0)
+        self.assertEqual(snapshot["handshake_age_seconds"], 30)
+
+    def test_counter_reset_counts_from_zero(self):
+        clock = FakeClock()
+        counters = Counters()
+        telemetry = TunnelTelemetry(counters, clock=clock)
+        counters.peers[KEY_A] = (9_000_000, 9_000_000)
+        telemetry.sample()
+        clock.now += 1
+        counters.peers[KEY_A] = (125_000, 0)
+        peers, _ = telemetry.sample()
+        self.assertEqual(peers[KEY_A].latest.rx_bytes, 125_000)
+        self.assertAlmostEqual(peers[KEY_A].latest.rx_mbps, 1.0)
+
+    def test_history_is_bounded_and_departed_peers_are_reported(self):
+        clock = FakeClock()
+        counters = Counters()
+        telemetry = TunnelTelemetry(counters, history=3, clock=clock)
+        counters.peers = {KEY_A: (0, 0), KEY_B: (0, 0)}
+        for step in range(1, 6):
+            clock.now += 1
+            counters.peers = {KEY_A: (step * 1000, 0), KEY_B: (0, 0)}
+            telemetry.sample()
+        self.assertEqual(len(telemetry.peers[KEY_A].history), 3)
+        del counters.peers[KEY_B]
+        peers, gone = telemetry.sample()
+        self.assertEqual(gone, [KEY_B])
+        self.assertEqual(list(peers), [KEY_A])
+
+
+class TestServiceTelemetry(unittest.TestCase):
+    def test_peer_series_follow_the_interface(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            state = Path(tmp) / "state.json"
+            environ = fake_wg_environ(tmp) | {"BANDWIDTH_TOTAL_MBPS": "40"}
+
+            def write(peers: dict) -> None:
+                state.write_text(json.dumps({"up": True, "addresses": [], "peers": peers}))
+
+            with patch.dict(os.environ, environ):
+                service = DVPNService()
+                service.bandwidth.open_connection(f"peer:{KEY_A}", "10.66.0.2/32")
+                write({KEY_A: {"endpoint": "198.51.100.7:40000", "rx": 1000, "tx": 2000}})
+                service.sample_tunnel_telemetry()
+                write({KEY_A: {"endpoint": "198.51.100.7:40000", "rx": 5000, "tx": 10000}})
+                service.sample_tunnel_telemetry()
+                text = service.metrics_text()
+                self.assertIn(f'dvpn_peer_rx_bytes_total{{peer="{KEY_A}"}} 4000', text)
+                self.assertIn(f'dvpn_peer_tx_bytes_total{{peer="{KEY_A}"}} 8000', text)
+                self.assertIn(f'dvpn_peer_grant_mbps{{peer="{KEY_A}"}} 20.0', text)
+                self.assertIn(KEY_A, service.status()["peers"])
+                write({})
+                service.sample_tunnel_telemetry()
+                self.assertNotIn(KEY_A, service.metrics_text())
+                self.assertIn("dvpn_tunnel_rx_mbps 0", service.metrics_text())
+
+
+if __name__ == "__main__":
+    unittest.main()
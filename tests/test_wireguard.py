@@ -0,0 +1,247 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+from app.main import DVPNService, RotationRequested
+from app.pool import Provider
+from app.wireguard import Peer, WireGuardInterface, diff_peers, parse_dump
+from fixtures.service import FAKE_WG, fake_wg_environ
+
+KEY_A = "A" * 43 + "="
+KEY_B = "B" * 43 + "="
+KEY_C = "C" * 43 + "="
+ROTATE_FROM = Provider("a", "8.8.8.8:51820", KEY_A, "0.0.0.0/0", client_ip="10.66.0.2/32")
+ROTATE_TO = Provider("b", "1.1.1.1:51820", KEY_B, "0.0.0.0/0", client_ip="10.66.0.3/32")
+
+
+class TestPeerDiff(unittest.TestCase):
+    def test_parse_dump_reads_peers(self):
+        dump = "priv\tpub\t51820\toff\n" + f"{KEY_A}\t(none)\t8.8.8.8:51820\t0.0.0.0/0,::/0\t0\t0\t0\t25\n"
+        peers = parse_dump(dump)
+        self.assertEqual(peers[KEY_A].endpoint, "8.8.8.8:51820")
+        self.assertEqual(peers[KEY_A].persistent_keepalive, 25)
+
+    def test_unchanged_peer_produces_no_args(self):
+        current = {KEY_A: Peer(KEY_A, "0.0.0.0/0,::/0", "8.8.8.8:51820", 25)}
+        self.assertEqual(diff_peers(current, [Peer(KEY_A, "::/0, 0.0.0.0/0", "8.8.8.8:51820", 25)]), [])
+
+    def test_replacing_peer_adds_new_and_removes_old(self):
+        current = {KEY_A: Peer(KEY_A, "0.0.0.0/0", "8.8.8.8:51820", 25)}
+        args = diff_peers(current, [Peer(KEY_B, "0.0.0.0/0", "1.1.1.1:51820", 25)])
+        self.assertEqual(
+            args,
+            ["peer", KEY_B, "endpoint", "1.1.1.1:51820", "allowed-ips", "0.0.0.0/0", "persistent-keepalive", "25", "peer", KEY_A, "remove"],
+        )
+
+    def test_endpoint_change_updates_only_endpoint(self):
+        current = {KEY_A: Peer(KEY_A, "0.0.0.0/0", "8.8.8.8:51820", 25)}
+        args = diff_peers(current, [Peer(KEY_A, "0.0.0.0/0", "8.8.4.4:51820", 25)])
+        self.assertEqual(args, ["peer", KEY_A, "endpoint", "8.8.4.4:51820"])
+
+    def test_keep_others_when_not_removing(self):
+        current = {KEY_A: Peer(KEY_A, "10.66.0.2/32")}
+        args = diff_peers(current, [Peer(KEY_B, "10.66.0.3/32", persistent_keepalive=25)], remove_others=False)
+        self.assertEqual(args, ["peer", KEY_B, "allowed-ips", "10.66.0.3/32", "persistent-keepalive", "25"])
+
+
+class TestWireGuardInterface(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.state = Path(self.tmp.name) / "state.json"
+        self.log = Path(self.tmp.name) / "calls.log"
+        self.env = patch.dict(os.environ, {"FAKE_WG_STATE": str(self.state), "FAKE_WG_LOG": str(self.log)})
+        self.env.start()
+        self.wg = WireGuardInterface("wg0", Path(self.tmp.name) / "wg0.conf", wg_cmd=FAKE_WG, wg_quick_cmd=FAKE_WG, ip_cmd=FAKE_WG)
+
+    def tearDown(self):
+        self.env.stop()
+        self.tmp.cleanup()
+
+    def calls(self) -> list[list[str]]:
+        return [json.loads(line) for line in self.log.read_text().splitlines()]
+
+    def test_peer_swap_is_a_single_set_without_interface_restart(self):
+        self.wg.up()
+        self.wg.set_peers([Peer(KEY_A, "0.0.0.0/0", "8.8.8.8:51820", 25)])
+        self.wg.set_peers([Peer(KEY_B, "0.0.0.0/0", "1.1.1.1:51820", 25)])
+        self.assertEqual(set(self.wg.peers()), {KEY_B})
+        sets = [call for call in self.calls() if call[0] == "set"]
+        self.assertEqual(len(sets), 2)
+        self.assertIn("remove", sets[1])
+        self.assertEqual([call[0] for call in self.calls()].count("up"), 1)
+
+    def test_noop_sync_skips_set(self):
+        self.wg.up()
+        peer = Peer(KEY_A, "0.0.0.0/0", "8.8.8.8:51820", 25)
+        self.wg.set_peers([peer])
+        self.assertEqual(self.wg.set_peers([peer]), [])
+        self.assertEqual(len([call for call in self.calls() if call[0] == "set"]), 1)
+
+    def test_wait_for_handshake_returns_once_peer_handshakes(self):
+        self.wg.up()
+        self.wg.set_peers([Peer(KEY_A, "0.0.0.0/0", "8.8.8.8:51820", 25)])
+        elapsed = self.wg.wait_for_handshake(KEY_A, timeout=2)
+        self.assertIsNotNone(elapsed)
+        self.assertLess(elapsed, 1.0)
+
+    def test_wait_for_handshake_times_out_for_silent_peer(self):
+        self.wg.up()
+        self.wg.set_peers([Peer(KEY_A, "10.66.0.2/32")])
+        self.assertIsNone(self.wg.wait_for_handshake(KEY_A, timeout=0.3))
+
+    def test_remove_peers_and_addresses(self):
+        self.wg.up()
+        self.wg.set_peers([Peer(KEY_A, "10.66.0.2/32"), Peer(KEY_C, "10.66.0.3/32")])
+        self.wg.remove_peers([KEY_A])
+        self.wg.add_address("10.66.0.9/32")
+        self.assertEqual(set(self.wg.peers()), {KEY_C})
+        self.assertIn(["address", "add", "10.66.0.9/32", "dev", "wg0"], self.calls())
+
+
+class TestServiceTunnel(unittest.TestCase):
+    def test_reconnect_updates_peers_in_place(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            log = Path(tmp) / "calls.log"
+            environ = fake_wg_environ(tmp, log) | {
+                "BANDWIDTH_TOTAL_MBPS": "100",
+                "WG_PRIVATE_KEY": KEY_C,
+                "WG_ADDRESS": "10.66.0.2/32",
+            }
+            with patch.dict(os.environ, environ):
+                service = DVPNService()
+                service.connect_tunnel(Provider("a", "8.8.8.8:51820", KEY_A, "0.0.0.0/0"))
+                service.connect_tunnel(Provider("b", "1.1.1.1:51820", KEY_B, "0.0.0.0/0"))
+                self.assertEqual(set(service.wg.peers()), {KEY_B})
+            commands = [json.loads(line)[0] for line in log.read_text().splitlines()]
+        self.assertEqual(commands.count("up"), 1)
+        self.assertIn("set", commands)
+
+    def test_handshake_from_before_the_change_does_not_verify(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            state = Path(tmp) / "state.json"
+            provider = Provider("a", "8.8.8.8:51820", KEY_A, "0.0.0.0/0")
+            earlier = int(time.time()) - 60
+            peer = {"endpoint": provider.endpoint, "allowed_ips": "0.0.0.0/0", "handshake": earlier}
+            state.write_text(json.dumps({"up": True, "peers": {KEY_A: peer}, "addresses": []}))
+            with patch.dict(os.environ, fake_wg_environ(tmp)):
+                service = DVPNService()
+                baseline = service.handshake_baseline(provider)
+                # Recent enough to sit inside the session lifetime, but older than the reconfiguration.
+                self.assertFalse(service.verify_handshake(provider, baseline, timeout_seconds=0.3))
+                state.write_text(json.dumps({"up": True, "peers": {KEY_A: peer | {"handshake": earlier + 61}}, "addresses": []}))
+                self.assertTrue(service.verify_handshake(provider, baseline, timeout_seconds=1))
+        self.assertEqual(baseline, earlier)
+
+    def rotation_environ(self, tmp: str, log: Path) -> dict[str, str]:
+        return fake_wg_environ(tmp, log) | {
+            "BANDWIDTH_TOTAL_MBPS": "100",
+            "WG_PRIVATE_KEY": KEY_C,
+            "AUTO_NETWORK_CONFIG": "true",
+            "UPNP_ENABLED": "false",
+        }
+
+    def rotation_service(self) -> DVPNService:
+        # Starts connected to `a`; the pool offers `b` as the next provider.
+        service = DVPNService()
+        service.wg.ip_cmd = FAKE_WG
+        service.pool.fetch_providers = lambda: [ROTATE_FROM, ROTATE_TO]
+        service.pool.mark_approved = lambda provider, token: None
+        service.pay_cache.is_active = lambda provider_id: True
+        service.detect_network = lambda: self.fail("network detection ran with the client tunnel up")
+        service.connect_tunnel(ROTATE_FROM)
+        # fake_wg's `up` does not read the config, so load the current peer the way wg-quick would.
+        service.wg.set_peers([service.client_peer(ROTATE_FROM)])
+        return service
+
+    def test_reconnecting_to_the_same_provider_keeps_the_live_session(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            log = Path(tmp) / "calls.log"
+            with patch.dict(os.environ, self.rotation_environ(tmp, log)):
+                service = self.rotation_service()
+                log.write_text("")
+                baseline = service.handshake_baseline(ROTATE_FROM)
+                reconfigured = service.connect_tunnel(ROTATE_FROM)
+                # No `wg set` went out, so no new handshake will arrive; the current one has to do.
+                self.assertTrue(service.verify_handshake(ROTATE_FROM, baseline, reconfigured, timeout_seconds=0.3))
+                state = json.loads((Path(tmp) / "state.json").read_text())
+                state["peers"][KEY_A]["handshake"] = int(time.time()) - 200
+                (Path(tmp) / "state.json").write_text(json.dumps(state))
+                stale = service.handshake_baseline(ROTATE_FROM)
+                self.assertFalse(service.verify_handshake(ROTATE_FROM, stale, reconfigured, timeout_seconds=0.3))
+            calls = [json.loads(line) for line in log.read_text().splitlines()]
+        self.assertGreater(baseline, 0)
+        self.assertFalse(reconfigured)
+        self.assertNotIn("set", [call[0] for call in calls])
+
+    def test_make_before_break_rotation_swaps_peers_in_one_set(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            log = Path(tmp) / "calls.log"
+            result = {}
+            with patch.dict(os.environ, self.rotation_environ(tmp, log)):
+                service = self.rotation_service()
+                log.write_text("")
+
+                async def main() -> None:
+                    result["rotated"] = await service.rotate_make_before_break(ROTATE_FROM)
+
+                with patch("app.main.fastest_provider", lambda providers, **kwargs: ROTATE_TO):
+                    service.runtime.run(main)
+                peers = service.wg.peers()
+            calls = [json.loads(line) for line in log.read_text().splitlines()]
+        self.assertEqual(result["rotated"].id, "b")
+        sets = [call for call in calls if call[0] == "set"]
+        self.assertEqual(len(sets), 2)
+        # Staged without allowed-ips, so the current peer keeps carrying traffic until the swap.
+        self.assertEqual(sets[0][2:4], ["peer", KEY_B])
+        self.assertNotIn("allowed-ips", sets[0])
+        self.assertNotIn("remove", sets[0])
+        # One `wg set` moves allowed-ips to the new peer and removes the old one.
+        self.assertIn("allowed-ips", sets[1])
+        self.assertEqual(sets[1][sets[1].index(KEY_A) + 1], "remove")
+        # The new address is added before the swap and the old one removed after it.
+        changes = [call[:3] if call[0] == "address" else call for call in calls if call[0] in ("set", "address")]
+        self.assertEqual(
+            changes,
+            [sets[0], ["address", "add", "10.66.0.3/32"], sets[1], ["address", "del", "10.66.0.2/32"]],
+        )
+        self.assertEqual(set(peers), {KEY_B})
+        self.assertEqual(peers[KEY_B].allowed_ips, "0.0.0.0/0")
+        self.assertEqual(service.wg_client_address, "10.66.0.3/32")
+        metrics = service.metrics_text()
+        self.assertIn("dvpn_rotation_total 1", metrics)
+        self.assertIn("dvpn_rotation_fallback_total 0", metrics)
+
+    def test_unconfirmed_handshake_unstages_and_falls_back(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            result = {}
+            with patch.dict(os.environ, self.rotation_environ(tmp, Path(tmp) / "calls.log")):
+                service = self.rotation_service()
+                service.desired_connected = True
+                service.next_rotation_deadline = lambda: 0
+
+                async def main() -> None:
+                    try:
+                        await service.supervise_tunnel(ROTATE_FROM)
+                    except RotationRequested as err:
+                        result["error"] = err
+
+                with (
+                    patch("app.main.fastest_provider", lambda providers, **kwargs: ROTATE_TO),
+                    patch.object(service, "verify_handshake", return_value=False),
+                ):
+                    service.runtime.run(main)
+                peers = service.wg.peers()
+        self.assertIn("make-before-break rotation failed", str(result["error"]))
+        self.assertEqual(set(peers), {KEY_A})
+        self.assertEqual(service.wg_client_address, "10.66.0.2/32")
+        metrics = service.metrics_text()
+        self.assertIn("dvpn_rotation_total 0", metrics)
+        self.assertIn("dvpn_rotation_fallback_total 1", metrics)
+
+
+if __name__ == "__main__":
+    unittest.main()